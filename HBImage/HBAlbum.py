@@ -1,17 +1,119 @@
+import io
 import os
 import threading
-from multiprocessing.dummy import Pool as ThreadPool
+import weakref
+import itertools
 
 from typing import List
 
+from PIL import Image
+
 from .HBImage import HBImage, HBCommon
+from .HBImageCache import HBImageCache, shared_image_cache, source_key
+from .HBLoadScheduler import HBLoadScheduler, priority_order
+from .HBAlbumLoadTask import HBAlbumLoadTask
+from .HBLoadPipeline import HBLoadPipeline
+from .HBProcessDecoder import shared_process_decoder
+
+
+
+#every entry added to any HBAlbum gets the next key.
+_entry_keys = itertools.count(1)
+
+
+class HBImageDescriptor:
+    """A lightweight placeholder of an image in a lazy HBAlbum.\n
+    It only keeps the path, size and format of the image.
+    Pixels are decoded when the image is accessed, and then kept in a HBImageCache.
+    """
+
+    def __init__(self, source:str):
+        self.source:str = source
+        self.key:tuple = source_key(source)
+        self.size:tuple = None
+        self.format:str = HBCommon.get_file_format(source).lower() or None
+        #the HBImage last returned by decode(), while someone still holds it.
+        self._decoded:weakref.ref = None
+
+        if HBCommon.is_url(source):
+            #the url is downloaded now (the shared HBFetcher keeps it in its cache for decode()),
+            #so an unreachable url or a file that is not an image fails while loading, not when it is shown.
+            with Image.open(io.BytesIO(HBImage.read_source(source))) as img:
+                self.size = img.size
+                self.format = img.format.lower()
+        else:
+            if not os.path.isfile(source):
+                raise FileNotFoundError(f"FileNotFoundError : {source}")
+            #Image.open only reads the file header.
+            with Image.open(source) as img:
+                self.size = img.size
+                self.format = img.format.lower()
+
+    @property
+    def is_decoded(self) -> bool:
+        return (self._decoded is not None) and (self._decoded() is not None)
+
+    def decode(self, cache:HBImageCache) -> HBImage:
+        """Return the HBImage of this descriptor, decode it if it is not in the cache."""
+        return self.lookup(cache)[0]
+
+    def lookup(self, cache:HBImageCache) -> tuple:
+        """Same as decode(), but also return whether the image was ready without decoding.
+
+        Returns:
+            tuple(HBImage, bool)
+        """
+        hb_image = self._decoded() if self._decoded else None
+        is_hit = hb_image is not None
+        if hb_image is None:
+            hb_image, is_hit = cache.get_or_load(self.key, self._load)
+
+        self._decoded = weakref.ref(hb_image)
+        return hb_image, is_hit
+
+    def _load(self) -> HBImage:
+        hb_image = HBImage(self.source)
+        hb_image.image.load()
+        return hb_image
+
+
 
 
 class HBAlbum:
     
-    def __init__(self,source = None,*args,**kwargs):
+    def __init__(self,source = None,*args,
+        lazy:bool=False,
+        cache:HBImageCache=None,
+        pipeline:HBLoadPipeline=None,
+        decode_backend:str="thread",
+        **kwargs
+    ):
+        """
+        Args:
+            source (str | list, optional): folder path, txt file path or a list of file paths/HBImages.
+            lazy (bool, optional): If True, the album only holds HBImageDescriptor of the loaded files,
+            and decodes an image when it is accessed. Defaults to False.
+            cache (HBImageCache, optional): The cache of decoded images in lazy mode.
+            Defaults to "shared_image_cache", which is shared by all HBAlbums.
+            pipeline (HBLoadPipeline, optional): the I/O and decode threads used to load files.
+            Defaults to a new HBLoadPipeline().
+            decode_backend (str, optional): "thread" decodes in the threads of the pipeline,
+            "process" decodes in worker processes (see HBProcessDecoder), which scales better
+            for big CPU-bound files. Not used in lazy mode. Defaults to "thread".
+        """
+        if decode_backend not in ("thread", "process"):
+            raise ValueError(f"decode_backend should be 'thread' or 'process', not {decode_backend}")
         self._album:List[HBImage] = []
+        #stable key of each entry, it does not change when entries are inserted or deleted before it.
+        self._keys:List[int] = []
         self._bookmark:int = 0
+        self._lazy:bool = lazy
+        self._cache:HBImageCache = cache if cache is not None else shared_image_cache
+        self._scheduler:HBLoadScheduler = None
+        self._pipeline:HBLoadPipeline = pipeline if pipeline is not None else HBLoadPipeline()
+        self._decode_backend:str = decode_backend
+        #1 if the bookmark moved forward last time, -1 if backward.
+        self._direction:int = 1
 
         if source:
             self.load(source)
@@ -30,15 +132,18 @@ class HBAlbum:
         return len(self._album)
     
     def __getitem__(self, key):
-        return self._album[key]
+        if isinstance(key, slice):
+            return [self._resolve(entry) for entry in self._album[key]]
+        return self._resolve(self._album[key])
     
     def __setitem__(self, key, value):
+        """Replace the image at index key (e.g. by its edited version), the entry keeps its key."""
         if not isinstance(value,HBImage):
             raise TypeError(f"{type(value)} cannot be added to the HBAlbum.")
         self._album[key] = value
 
     def __iter__(self):
-        return iter(self._album)
+        return (self._resolve(entry) for entry in self._album)
 
     @property
     def is_empty(self):
@@ -48,18 +153,50 @@ class HBAlbum:
     def length(self):
         return len(self._album)
 
+    @property
+    def is_lazy(self) -> bool:
+        return self._lazy
+
+    @property
+    def cache(self) -> HBImageCache:
+        return self._cache
+
+    @property
+    def pipeline(self) -> HBLoadPipeline:
+        """The pipeline used by load(), its metrics are the throughput of the last load."""
+        return self._pipeline
+
+    @property
+    def scheduler(self) -> HBLoadScheduler:
+        return self._scheduler
+
     @property
     def marked_image(self):
         if self.is_empty:
             return None
-        return self._album[self._bookmark]
+        entry = self._album[self._bookmark]
+        if not isinstance(entry, HBImageDescriptor):
+            return entry
+
+        hb_image, is_hit = entry.lookup(self._cache)
+        if self._scheduler:
+            self._scheduler.record_access(is_hit)
+        return hb_image
     
+    @property
+    def marked_key(self) -> int:
+        """Key of the marked image, see key_of()."""
+        if self.is_empty:
+            return None
+        return self._keys[self._bookmark]
+
     @property
     def bookmark(self):
         return self._bookmark
 
     @bookmark.setter
     def bookmark(self, index:int):
+        old_bookmark = self._bookmark
         if index<=0 or self.is_empty:
             self._bookmark = 0
         elif index>=self.length:
@@ -67,30 +204,85 @@ class HBAlbum:
         else:
             self._bookmark = index
 
+        if self._bookmark != old_bookmark:
+            self._direction = 1 if self._bookmark > old_bookmark else -1
+        self._refocus()
+
+    
+    def key_of(self, index:int) -> int:
+        """Return the key of the entry at index.\n
+        A key is unique among all albums, and stays with its entry when other entries are inserted or deleted,
+        so it can identify an image while the album changes (e.g. its edit history).
+        """
+        return self._keys[index]
+
+    def index_of(self, key:int) -> int:
+        """Return the index of the entry with this key, or -1 if it is not in the album."""
+        try:
+            return self._keys.index(key)
+        except ValueError:
+            return -1
+
+    
+    def start_prefetch(self, workers:int=2, ahead:int=4, behind:int=2) -> HBLoadScheduler:
+        """Decode images around the bookmark in background threads. Only works in lazy mode.\n
+        See HBLoadScheduler for the arguments.
+        """
+        if not self._lazy:
+            raise ValueError("Prefetch only works in lazy mode.")
+        if self._scheduler is None:
+            self._scheduler = HBLoadScheduler(self, workers, ahead, behind)
+            self._refocus()
+        return self._scheduler
+
+    def stop_prefetch(self):
+        if self._scheduler:
+            self._scheduler.stop()
+            self._scheduler = None
+
     
     def append(self, hb_image:HBImage):
         if hb_image.is_empty:
             raise ValueError(f"Append Nothing!")
         self._album.append(hb_image)
+        self._keys.append(next(_entry_keys))
+        self._refocus()
         
     def merge(self, hb_album:'HBAlbum'):
-        self._album.extend(hb_album)
+        self.extend(hb_album)
         
     def extend(self, hb_album:'HBAlbum'):
-        self._album.extend(hb_album)
+        if isinstance(hb_album, HBAlbum):
+            #take the entries directly, so descriptors of a lazy album are not decoded.
+            entries = hb_album._album
+        else:
+            entries = list(hb_album)
+        self._album.extend(entries)
+        self._keys.extend(self._new_keys(len(entries)))
+        self._refocus()
     
     def delete(self, index):
         if self.bookmark==(self.length-1):
             self.bookmark -= 1
-        self._album[index].image.close()
+        entry = self._album[index]
+        if isinstance(entry, HBImageDescriptor):
+            #The decoded image may be shared with other albums, so only drop it from the cache.
+            self._cache.discard(entry.key)
+        else:
+            entry.close()
         del self._album[index]
+        del self._keys[index]
+        self._refocus()
 
             
 
     def insert(self, index, hbimage):
         self._album.insert(index, hbimage)
+        self._keys.insert(index, next(_entry_keys))
         if index>=self.bookmark:
             self.bookmark += 1
+        else:
+            self._refocus()
 
     def save(self, folder_path:str, format:str=None, filename_prefix=None):
         if self.is_empty:
@@ -99,7 +291,7 @@ class HBAlbum:
 
         save_threads = []
         
-        for image in self._album:
+        for image in self:
             img_name = image.information.get("filename")
             if filename_prefix:
                 img_name += filename_prefix+'_'
@@ -121,7 +313,7 @@ class HBAlbum:
         if self.is_empty:
             raise IndexError("There is no image.")
         
-        pil_images = [hbimg.image for hbimg in self._album]
+        pil_images = [hbimg.image for hbimg in self]
 
         if len(self._album)>1:  
             pil_images[0].save(filepath, format="pdf", save_all=True, append_images=pil_images[1:])
@@ -159,23 +351,57 @@ class HBAlbum:
             self.load_from_filepaths(source)
         elif isinstance(source[0], HBImage):
             self._album = source
+            self._keys = self._new_keys(len(source))
+            self._refocus()
+        else:
+            raise TypeError(f"{type(source)} cannot be added to the HBAlbum.")
+
+
+    def load_async(self, source, callback) -> HBAlbumLoadTask:
+        """Loads images into the HBAlbum in background threads, without blocking.\n
+        Each loaded image is passed to callback in a background thread,
+        and added to the album by HBAlbumLoadTask.add() in the thread that uses the album
+        (see HBImageBox.HBAlbumLoader for a Qt GUI).
+
+        Args:
+            source (str | list[str]): folder path, txt file path, or a list of image files' path or url.
+            callback (function): callback(source_index, entry, error), see HBAlbumLoadTask.
+
+        Returns:
+            HBAlbumLoadTask: the started task, call its cancel() to stop loading.
+        """
+        if isinstance(source, str):
+            filepaths_list = self._filepaths_from_str(source)
+        elif isinstance(source, list):
+            filepaths_list = [filepath for filepath in source if filepath]
         else:
             raise TypeError(f"{type(source)} cannot be added to the HBAlbum.")
 
+        task = HBAlbumLoadTask(self, filepaths_list, callback)
+        task.start()
+        return task
+
 
     def _load_from_str(self, source:str):
         """Loads images into the HBAlbum from a string source. \n
         If source is a txt file, assume it contain the images' url.
         """
+        self.load_from_filepaths(self._filepaths_from_str(source))
+
+
+    def _filepaths_from_str(self, source:str) -> List[str]:
         if not os.path.exists(source):
             raise FileNotFoundError(f"FileNotFoundError : {source}")
         if HBCommon.get_file_format(source) == "txt":
-            self.load_from_filepaths(HBCommon.load_file_txt(source))
-        else:
-            self._load_from_folder(source)
+            return HBCommon.load_file_txt(source)
+        return self._folder_filepaths(source)
 
 
     def _load_from_folder(self, folder_path:str):
+        self.load_from_filepaths(self._folder_filepaths(folder_path))
+
+
+    def _folder_filepaths(self, folder_path:str) -> List[str]:
         if not isinstance(folder_path, str):
             raise TypeError(f"Folder path must be a string. Not {type(folder_path)}")
         if not os.path.exists(folder_path):
@@ -188,30 +414,84 @@ class HBAlbum:
         if not relative_filepaths_list:
             raise FileNotFoundError("No files found in the folder.")
 
-        filepaths_list = [f"{folder_path}/{filepath}" for filepath in relative_filepaths_list]
-        
-        self.load_from_filepaths(filepaths_list)
+        return [f"{folder_path}/{filepath}" for filepath in relative_filepaths_list]
     
 
     def load_from_filepaths(self, filepaths_list:List[str]):
+        filepaths_list = [filepath for filepath in filepaths_list if filepath]
         if not filepaths_list:
             return None
 
         self._load_fail = []
-        with ThreadPool() as p:
-            self._album = p.map(self._load_from_filepath, filepaths_list)
-
-
-
-    def _load_from_filepath(self, filepath:str) -> 'HBImage':
-        if not filepath:
-            return None
-
+        self._pipeline.reset()
+        #load the images around the bookmark first.
+        order = priority_order(len(filepaths_list), self._bookmark, self._direction)
+        ordered_filepaths = [filepaths_list[i] for i in order]
+        results = self._pipeline.run(ordered_filepaths, *self._pipeline_stages())
+
+        loaded = [None] * len(filepaths_list)
+        for i, result in zip(order, results):
+            if isinstance(result, FileNotFoundError):
+                print(result)
+                self._load_fail.append([filepaths_list[i], result])
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                loaded[i] = result
+        self._album = [entry for entry in loaded if entry is not None]
+        self._keys = self._new_keys(len(self._album))
+        self._refocus()
+
+
+
+    def _pipeline_stages(self) -> tuple:
+        """Return the (fetch, decode) functions of HBLoadPipeline.run().\n
+        In lazy mode, the I/O stage only reads the file header into a HBImageDescriptor.
+        """
+        if self._lazy:
+            return HBImageDescriptor, lambda source, entry: entry
+        if self._decode_backend == "process":
+            return self._fetch_for_process, shared_process_decoder().decode
+        return HBImage.read_source, lambda source, data: HBImage.load_from_bytes(data, source)
+
+
+    def _fetch_for_process(self, source:str):
+        """Worker processes read local files by themselves, only urls are downloaded in the I/O stage."""
+        if HBCommon.is_url(source):
+            return HBImage.read_source(source)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"FileNotFoundError : {source}")
+        return None
+
+    def _insert_entry(self, index:int, entry):
+        """Insert an entry and keep the bookmark on the same image."""
+        was_empty = self.is_empty
+        self._album.insert(index, entry)
+        self._keys.insert(index, next(_entry_keys))
+        if (not was_empty) and index<=self._bookmark:
+            self._bookmark += 1
+        if was_empty:
+            self._refocus()
+        elif self._scheduler:
+            #the queued entries are still valid, re-prioritizing all of them for each entry would be quadratic.
+            self._scheduler.add(index)
+
+    def _new_keys(self, count:int) -> List[int]:
+        return [next(_entry_keys) for _ in range(count)]
+
+    def _entry(self, index:int):
+        """Return the raw entry (HBImage or HBImageDescriptor) at index, or None if index is out of range."""
         try:
-            return HBImage(filepath)
-        except FileNotFoundError as err:
-            print(err)
-            self._load_fail.append([filepath, err])
+            return self._album[index]
+        except IndexError:
             return None
 
+    def _refocus(self):
+        if self._scheduler:
+            self._scheduler.focus(self._bookmark, self._direction)
 
+    def _resolve(self, entry) -> HBImage:
+        """Return the HBImage of an album entry, decode it if the entry is a HBImageDescriptor."""
+        if isinstance(entry, HBImageDescriptor):
+            return entry.decode(self._cache)
+        return entry
@@ -0,0 +1,136 @@
+"""
+HBAlbumLoadTask loads images into a HBAlbum in background, by a HBLoadPipeline (see HBAlbum.load_async()).\n
+Every image is inserted into the album as soon as it is loaded (in the order of the sources).
+The results arrive in the decode threads of the pipeline, the album is not thread safe,
+so the owner of the task passes each of them to add() in the thread that uses the album
+(HBImageBox.HBAlbumLoader does it with a Qt signal, so the GUI thread never waits for a whole batch).
+"""
+
+import bisect
+import threading
+
+from typing import Callable, List
+
+from .HBLoadPipeline import HBLoadPipeline
+
+
+
+class HBAlbumLoadTask:
+    """Use HBAlbum.load_async() to create and start a HBAlbumLoadTask.
+    """
+
+    def __init__(self, album, sources:List[str], callback:Callable):
+        """
+        Args:
+            album (HBAlbum): the album the images are added to.
+            sources (List[str]): image files' path or url.
+            callback (function): callback(source_index, entry, error) is called in a decode thread
+            when sources[source_index] is loaded (error is None) or failed (entry is None).
+            Pass the arguments to add() in the thread that uses the album.
+        """
+        self._album = album
+        self._sources:List[str] = list(sources)
+        self._callback:Callable = callback
+        #a pipeline of its own, with the same sizes as the album's pipeline.
+        album_pipeline = album.pipeline
+        self._pipeline = HBLoadPipeline(
+            album_pipeline.io_workers,
+            album_pipeline.decode_workers,
+            album_pipeline.queue_size
+        )
+
+        #the album length before loading, new images are inserted after it.
+        self._base_index:int = 0
+        #source indices of the images that are already in the album.
+        self._arrived:List[int] = []
+        self._failed:List[tuple] = []
+        self._finished_count:int = 0
+        self._is_cancelled:bool = False
+        self._is_finished:bool = False
+
+
+    @property
+    def total(self) -> int:
+        return len(self._sources)
+
+    @property
+    def finished_count(self) -> int:
+        return self._finished_count
+
+    @property
+    def failed(self) -> List[tuple]:
+        """List of (source, error message) of the images that could not be loaded."""
+        return list(self._failed)
+
+    @property
+    def pipeline(self) -> HBLoadPipeline:
+        return self._pipeline
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._is_cancelled
+
+    @property
+    def is_finished(self) -> bool:
+        return self._is_finished
+
+
+    def start(self):
+        self._base_index = len(self._album)
+        if not self._sources:
+            self._is_finished = True
+            return None
+
+        self._pipeline.reset()
+        threading.Thread(
+            target=self._pipeline.run,
+            args=(self._sources, *self._album._pipeline_stages(), self._on_item_done),
+            daemon=True,
+            name="HBAlbumLoadTask"
+        ).start()
+
+
+    def cancel(self):
+        """Stop loading the rest of the batch. The images already added stay in the album."""
+        if self._is_finished:
+            return None
+        self._is_cancelled = True
+        self._pipeline.cancel()
+        self._is_finished = True
+
+
+    def add(self, source_index:int, entry, error:Exception) -> int:
+        """Insert the result of callback() into the album, call it in the thread that uses the album.
+
+        Returns:
+            int: album index of the inserted image, None if the image failed or the task is finished.
+        """
+        if self._is_finished:
+            return None
+
+        self._finished_count += 1
+        if self._finished_count == self.total:
+            self._is_finished = True
+        if error is not None:
+            self._failed.append((self._sources[source_index], str(error)))
+            return None
+
+        position = bisect.bisect(self._arrived, source_index)
+        self._arrived.insert(position, source_index)
+        #the album may be edited while loading.
+        album_index = min(self._base_index + position, len(self._album))
+        self._album._insert_entry(album_index, entry)
+        return album_index
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _on_item_done(self, source_index:int, result):
+        """Called in the decode threads of the pipeline."""
+        if self._is_cancelled:
+            return None
+        if isinstance(result, Exception):
+            self._callback(source_index, None, result)
+        else:
+            self._callback(source_index, result, None)
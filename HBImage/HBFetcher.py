@@ -0,0 +1,318 @@
+"""
+HBFetcher downloads the bytes of image urls.\n
+Connections are kept alive and reused for every host (a pool per host),
+the number of concurrent requests to a host is limited,
+and failed requests are retried with exponential backoff.
+A single instance "shared_fetcher" is used by HBImage.load for all url sources,
+it keeps the downloaded images in a HBHttpCache (set "shared_fetcher.cache" to change the cache).\n
+The body can be received while it is downloaded (see fetch(on_data)), e.g. to decode an image progressively.
+"""
+
+import ssl
+import time
+import threading
+import http.client
+
+from typing import Callable, Dict
+from urllib.parse import urlsplit, urljoin
+
+from .HBHttpCache import HBHttpCache
+
+
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36"
+
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+#max bytes passed to on_data at a time, see HBFetcher.fetch().
+CHUNK_SIZE = 64*1024
+
+
+
+class HBFetchResponse:
+
+    def __init__(self, url:str, status:int, headers:dict, body:bytes):
+        self.url:str = url
+        self.status:int = status
+        #header names are lower case.
+        self.headers:Dict[str, str] = headers
+        self.body:bytes = body
+
+    def __len__(self):
+        return len(self.body)
+
+
+
+
+class _HBHostPool:
+    """Idle keep-alive connections of one host, and the limit of concurrent requests to it."""
+
+    def __init__(self, max_connections:int):
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.idle_connections:list = []
+        self.lock = threading.Lock()
+
+    def pop_idle(self):
+        with self.lock:
+            return self.idle_connections.pop() if self.idle_connections else None
+
+    def push_idle(self, connection):
+        with self.lock:
+            self.idle_connections.append(connection)
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle_connections:
+                connection.close()
+            self.idle_connections.clear()
+
+
+
+
+class HBFetcher:
+
+    def __init__(self,
+        max_connections_per_host:int = 6,
+        connect_timeout:float = 5.0,
+        read_timeout:float = 30.0,
+        retries:int = 3,
+        backoff:float = 0.5,
+        max_redirects:int = 5,
+        cache:HBHttpCache = None
+    ):
+        """
+        Args:
+            max_connections_per_host (int, optional): max concurrent requests to a host. Defaults to 6.
+            connect_timeout (float, optional): seconds to wait for a connection. Defaults to 5.0.
+            read_timeout (float, optional): seconds to wait for each read from the server. Defaults to 30.0.
+            retries (int, optional): how many times a failed request is retried. Defaults to 3.
+            backoff (float, optional): the n-th retry waits backoff * 2**(n-1) seconds. Defaults to 0.5.
+            max_redirects (int, optional): Defaults to 5.
+            cache (HBHttpCache, optional): on-disk cache of the responses. Defaults to None (no cache).
+        """
+        self.max_connections_per_host:int = max_connections_per_host
+        self.connect_timeout:float = connect_timeout
+        self.read_timeout:float = read_timeout
+        self.retries:int = retries
+        self.backoff:float = backoff
+        self.max_redirects:int = max_redirects
+        self.cache:HBHttpCache = cache
+
+        self._host_limits:Dict[str, int] = {}
+        self._pools:Dict[tuple, _HBHostPool] = {}
+        self._pools_lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+
+    def set_host_limit(self, host:str, max_connections:int):
+        """Set the max concurrent requests to a host (ex. "images.example.com").
+        Only affects the connections created after calling this.
+        """
+        self._host_limits[host.lower()] = max_connections
+
+
+    def fetch(self, url:str, headers:dict = None, on_data:Callable = None) -> HBFetchResponse:
+        """GET url and return the whole response.\n
+        If the fetcher has a HBHttpCache, a cached url is revalidated with a conditional request,
+        and its body is read from the cache when the server says it is not modified.
+
+        Args:
+            url (str)
+            headers (dict, optional): request headers.
+            on_data (function, optional): on_data(chunk) is called with the bytes of the body (status 200) 
+            as soon as they arrive, in the calling thread. on_data(None) is called before the first chunk of a body,
+            again if the body starts over (a download broken in the middle is retried).
+            An exception raised by on_data stops the download and is raised by fetch().
+
+        Raises:
+            FileNotFoundError: the server responds 404 or 410, or url is not cached in offline mode.
+            ConnectionError: other error status, or the request still fails after all retries.
+            TimeoutError: the server does not respond in time after all retries.
+        """
+        if self.cache is None:
+            return self._check_status(self._fetch_redirected(url, headers, on_data), url)
+
+        entry = self.cache.lookup(url)
+        if self.cache.offline:
+            body = self.cache.read(url)
+            if body is None:
+                raise FileNotFoundError(f"Not in the cache (offline mode) : {url}")
+            return self._cached_response(url, entry.headers, body, on_data)
+
+        request_headers = dict(headers or {})
+        if entry:
+            request_headers.update(entry.validators)
+        response = self._fetch_redirected(url, request_headers, on_data)
+
+        if response.status == 304:
+            body = self.cache.read(url)
+            if body is not None:
+                return self._cached_response(url, entry.headers, body, on_data)
+            #the cached file is lost, download it again.
+            response = self._fetch_redirected(url, headers, on_data)
+
+        self._check_status(response, url)
+        if response.status == 200:
+            self.cache.store(url, response.body, response.headers)
+        return response
+
+
+    def close(self):
+        """Close all idle connections."""
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _fetch_redirected(self, url:str, headers:dict, on_data:Callable=None) -> HBFetchResponse:
+        for _ in range(self.max_redirects+1):
+            response = self._fetch_with_retry(url, headers, on_data)
+            if response.status not in REDIRECT_STATUS:
+                return response
+            url = urljoin(url, response.headers.get("location", ""))
+        raise ConnectionError(f"Too many redirects : {url}")
+
+
+    def _check_status(self, response:HBFetchResponse, url:str) -> HBFetchResponse:
+        if response.status in (404, 410):
+            raise FileNotFoundError(f"HTTP {response.status} : {url}")
+        if response.status >= 400:
+            raise ConnectionError(f"HTTP {response.status} : {url}")
+        return response
+
+
+    def _cached_response(self, url:str, headers:dict, body:bytes, on_data:Callable) -> HBFetchResponse:
+        if on_data is not None:
+            on_data(None)
+            on_data(body)
+        return HBFetchResponse(url, 200, headers, body)
+
+
+    def _fetch_with_retry(self, url:str, headers:dict, on_data:Callable=None) -> HBFetchResponse:
+        error = None
+        for attempt in range(self.retries+1):
+            if attempt:
+                time.sleep(self._retry_delay(attempt, error))
+            try:
+                response = self._request(url, headers, on_data)
+            except (OSError, http.client.HTTPException) as err:
+                error = err
+                continue
+            if response.status not in RETRY_STATUS:
+                return response
+            error = response
+
+        if isinstance(error, HBFetchResponse):
+            return error
+        if isinstance(error, TimeoutError):
+            raise TimeoutError(f"Timeout : {url}") from error
+        raise ConnectionError(f"{error} : {url}") from error
+
+
+    def _retry_delay(self, attempt:int, error) -> float:
+        delay = self.backoff * 2**(attempt-1)
+        #respect "Retry-After: <seconds>" of 429/503, but never wait longer than the read timeout.
+        if isinstance(error, HBFetchResponse):
+            retry_after = error.headers.get("retry-after", "")
+            if retry_after.isdigit():
+                delay = max(delay, min(int(retry_after), self.read_timeout))
+        return delay
+
+
+    def _request(self, url:str, headers:dict, on_data:Callable=None) -> HBFetchResponse:
+        scheme, netloc, path, query, _ = urlsplit(url)
+        scheme = scheme.lower()
+        if scheme not in ("http", "https"):
+            raise ValueError(f"HBFetcher only supports http and https : {url}")
+        if query:
+            path = f"{path}?{query}"
+
+        request_headers = {"User-Agent":USER_AGENT, "Connection":"keep-alive"}
+        if headers:
+            request_headers.update(headers)
+
+        pool = self._get_pool(scheme, netloc)
+        with pool.semaphore:
+            #A reused connection may be closed by the server while it was idle,
+            #in that case retry once on a new connection.
+            connection = pool.pop_idle()
+            is_reused = connection is not None
+            try:
+                return self._send(
+                    pool, connection or self._connect(scheme, netloc), url, path or "/", request_headers, on_data
+                )
+            except (ConnectionError, http.client.BadStatusLine):
+                if not is_reused:
+                    raise
+            return self._send(pool, self._connect(scheme, netloc), url, path or "/", request_headers, on_data)
+
+
+    def _send(self, pool:_HBHostPool, connection, url:str, path:str, headers:dict, on_data:Callable=None) -> HBFetchResponse:
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            if on_data is not None and response.status == 200:
+                body = self._read_body(response, on_data)
+            else:
+                body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            pool.push_idle(connection)
+
+        response_headers = {name.lower(): value for name, value in response.getheaders()}
+        return HBFetchResponse(url, response.status, response_headers, body)
+
+
+    def _read_body(self, response:http.client.HTTPResponse, on_data:Callable) -> bytes:
+        """Read the body chunk by chunk, pass every chunk to on_data as soon as it arrives."""
+        on_data(None)
+        chunks = []
+        while True:
+            #returns the bytes that are available, without waiting for CHUNK_SIZE bytes.
+            chunk = response.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            on_data(chunk)
+        if response.length:
+            #the connection was closed before the end of the body.
+            raise http.client.IncompleteRead(b"".join(chunks), response.length)
+        #closes the response, so the connection can send the next request.
+        response.read()
+        return b"".join(chunks)
+
+
+    def _connect(self, scheme:str, netloc:str):
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(netloc, timeout=self.connect_timeout, context=self._ssl_context)
+        else:
+            connection = http.client.HTTPConnection(netloc, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+
+    def _get_pool(self, scheme:str, netloc:str) -> _HBHostPool:
+        key = (scheme, netloc.lower())
+        with self._pools_lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                host = urlsplit(f"//{netloc}").hostname or netloc
+                max_connections = self._host_limits.get(host.lower(), self.max_connections_per_host)
+                pool = self._pools[key] = _HBHostPool(max_connections)
+            return pool
+
+
+
+
+shared_fetcher = HBFetcher(cache=HBHttpCache())
@@ -0,0 +1,226 @@
+"""
+HBHttpCache is a persistent on-disk cache of downloaded images, used by HBFetcher.\n
+Each url is stored as two files in the cache directory:
+"<hash>.body" is the response body, and "<hash>.json" keeps the url, ETag, Last-Modified and the last access time.
+A cached url is revalidated with a conditional request (If-None-Match / If-Modified-Since),
+so an unchanged image is never downloaded again.
+When the cache is larger than max_bytes, the least recently used urls are removed,
+a body larger than max_bytes is never stored.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from typing import Dict
+
+
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "HBImageEditor", "http")
+
+
+
+class HBHttpCacheEntry:
+
+    def __init__(self, url:str, size:int, etag:str=None, last_modified:str=None, content_type:str=None, last_access:float=None):
+        self.url:str = url
+        self.size:int = size
+        self.etag:str = etag
+        self.last_modified:str = last_modified
+        self.content_type:str = content_type
+        self.last_access:float = last_access or time.time()
+
+    @property
+    def validators(self) -> dict:
+        """Headers of the conditional request that revalidates this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    @property
+    def headers(self) -> dict:
+        headers = {"content-length":str(self.size)}
+        if self.etag:
+            headers["etag"] = self.etag
+        if self.last_modified:
+            headers["last-modified"] = self.last_modified
+        if self.content_type:
+            headers["content-type"] = self.content_type
+        return headers
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+
+
+class HBHttpCache:
+
+    def __init__(self, directory:str=None, max_bytes:int=1024*1024*1024, offline:bool=False):
+        """
+        Args:
+            directory (str, optional): where the cached files are saved. Defaults to "~/.cache/HBImageEditor/http".
+            max_bytes (int, optional): max total size of the cached bodies. Defaults to 1 GB.
+            offline (bool, optional): If True, HBFetcher only serves urls from the cache and never connects. Defaults to False.
+        """
+        self.directory:str = directory or DEFAULT_CACHE_DIRECTORY
+        self.max_bytes:int = max_bytes
+        self.offline:bool = offline
+
+        self._entries:Dict[str, HBHttpCacheEntry] = None
+        self._nbytes:int = 0
+        self._lock = threading.RLock()
+
+
+    def __contains__(self, url:str):
+        return self.lookup(url) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._get_entries())
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            self._get_entries()
+            return self._nbytes
+
+
+    def lookup(self, url:str) -> HBHttpCacheEntry:
+        """Return the entry of url, or None if url is not cached."""
+        with self._lock:
+            return self._get_entries().get(url)
+
+    def read(self, url:str) -> bytes:
+        """Return the cached body of url and mark it as recently used.
+        Return None if url is not cached or its file is lost.
+        """
+        with self._lock:
+            entry = self.lookup(url)
+            if entry is None:
+                return None
+            try:
+                with open(self._body_path(url), "rb") as f:
+                    body = f.read()
+            except OSError:
+                self._remove(url)
+                return None
+            entry.last_access = time.time()
+            self._write_meta(entry)
+            return body
+
+    def store(self, url:str, body:bytes, headers:dict):
+        """Save a 200 response of url. A body larger than max_bytes is not saved
+        (it would evict every other url), and the previous body of url is removed.
+
+        Args:
+            url (str)
+            body (bytes)
+            headers (dict): response headers with lower case names.
+        """
+        if "no-store" in headers.get("cache-control", ""):
+            return None
+        entry = HBHttpCacheEntry(
+            url, len(body),
+            etag = headers.get("etag"),
+            last_modified = headers.get("last-modified"),
+            content_type = headers.get("content-type")
+        )
+        with self._lock:
+            entries = self._get_entries()
+            if url in entries:
+                self._remove(url)
+            if entry.size > self.max_bytes:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            self._write_file(self._body_path(url), body)
+            self._write_meta(entry)
+            entries[url] = entry
+            self._nbytes += entry.size
+            self._evict()
+
+    def discard(self, url:str):
+        with self._lock:
+            if self.lookup(url):
+                self._remove(url)
+
+    def clear(self):
+        with self._lock:
+            for url in list(self._get_entries()):
+                self._remove(url)
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _get_entries(self) -> Dict[str, HBHttpCacheEntry]:
+        """Read the index from the cache directory the first time it is needed."""
+        if self._entries is not None:
+            return self._entries
+
+        self._entries = {}
+        self._nbytes = 0
+        if not os.path.isdir(self.directory):
+            return self._entries
+
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    entry = HBHttpCacheEntry(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                continue
+            if not os.path.isfile(self._body_path(entry.url)):
+                continue
+            self._entries[entry.url] = entry
+            self._nbytes += entry.size
+        return self._entries
+
+
+    def _evict(self):
+        entries = self._get_entries()
+        if self._nbytes <= self.max_bytes:
+            return None
+        for entry in sorted(entries.values(), key=lambda e: e.last_access):
+            if self._nbytes <= self.max_bytes:
+                break
+            self._remove(entry.url)
+
+
+    def _remove(self, url:str):
+        entry = self._entries.pop(url, None)
+        if entry:
+            self._nbytes -= entry.size
+        for filepath in (self._body_path(url), self._meta_path(url)):
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+
+    def _write_meta(self, entry:HBHttpCacheEntry):
+        self._write_file(self._meta_path(entry.url), json.dumps(entry.to_dict()).encode())
+
+
+    def _write_file(self, filepath:str, data:bytes):
+        """Write to a temporary file first, so a crash never leaves a half written file."""
+        temp_filepath = f"{filepath}.{threading.get_ident()}.tmp"
+        with open(temp_filepath, "wb") as f:
+            f.write(data)
+        os.replace(temp_filepath, filepath)
+
+
+    def _hash(self, url:str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def _body_path(self, url:str) -> str:
+        return os.path.join(self.directory, f"{self._hash(url)}.body")
+
+    def _meta_path(self, url:str) -> str:
+        return os.path.join(self.directory, f"{self._hash(url)}.json")
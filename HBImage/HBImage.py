@@ -1,28 +1,86 @@
+import io
+import os
+import time
+import weakref
+import threading
+import functools
+import itertools
 from os import path
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 from urllib.request import urlopen,Request
 
 from PIL import (
     Image,
     ImageGrab,
-    ImageQt,
     ImageDraw,
     ImageChops
 )
 
 from . import HBCommon
+from .HBFetcher import shared_fetcher, USER_AGENT, CHUNK_SIZE
+from .HBSharedBuffer import HBSharedBuffer
+from .HBImagePatch import HBImagePatch
+from .HBTransform import HBTransform
+from .HBOpChain import HBOpChain
+from .HBPyramid import HBPyramid, REDUCE_MODES
+from .HBMappedFile import HBMappedFile, KEEP_MAPPED
+from .HBRegionDecoder import HBRegionDecoder
+from .HBProgressiveDecoder import HBProgressiveDecoder
+
+
+
+#operation name: {"calls":int, "copies":int, "bytes":int}
+_copy_stats:dict = {}
+_copy_stats_lock = threading.Lock()
+#name of the outermost counted operation running in this thread.
+_current_operation = threading.local()
+#every new content of any HBImage gets the next generation, so a generation is never reused for other pixels.
+_generations = itertools.count(1)
+#decodes the full resolution of the images in the background, see HBImage.decode_async().
+_decoder = ThreadPoolExecutor(1, thread_name_prefix="HBImageDecoder")
 
 
 
 #Decorator define
+def count_copies(operation_function):
+    """Decorator.\n
+    Count the calls of the function and the physical pixel copies made while it runs,
+    see HBImage.copy_stats(). Copies made by nested counted functions belong to the outermost one.
+
+    Args:
+        operation_function (function): Decorated
+    """
+    @functools.wraps(operation_function)
+    def do_count(*args, **kwargs):
+        if getattr(_current_operation, "name", None):
+            return operation_function(*args, **kwargs)
+
+        _current_operation.name = operation_function.__name__
+        with _copy_stats_lock:
+            stats = _copy_stats.setdefault(operation_function.__name__, {"calls":0, "copies":0, "bytes":0})
+            stats["calls"] += 1
+        try:
+            return operation_function(*args, **kwargs)
+        finally:
+            _current_operation.name = None
+
+    return do_count
+
+
 def image_process(image_process_function):
     """Decorator.\n
-    If ROI is set, the function only modified this region.
+    If ROI is set, the function only modified this region.\n
+    The decorated function returns a new HBImage, 
+    or with "in_place=True", modifies self and returns the HBImagePatch that undoes it (see HBImage.process_in_place()).
 
     Args:
         image_process_function (function): Decorated
     """
-    def do_process(self:'HBImage'):
+    @functools.wraps(image_process_function)
+    def do_process(self:'HBImage', in_place:bool=False):
         
+        if in_place:
+            return self.process_in_place(image_process_function)
         if self.is_ROI_empty:
             return image_process_function(self)
         else:
@@ -30,7 +88,28 @@ def image_process(image_process_function):
             process_image = image_process_function(process_image)
             return self.paste(process_image)
 
-    return do_process
+    return count_copies(do_process)
+
+
+
+
+class _HBPixelSharers:
+    """The PIL.Images that read the same pixel buffer."""
+
+    def __init__(self, is_readonly_memory:bool=False):
+        #id : PIL.Image, PIL.Image is not hashable.
+        self._images = weakref.WeakValueDictionary()
+        #True if the buffer must never be written (shared memory, memory mapped file).
+        self.is_readonly_memory:bool = is_readonly_memory
+
+    def __len__(self):
+        return len(self._images)
+
+    def add(self, pil_image:Image.Image):
+        self._images[id(pil_image)] = pil_image
+
+    def discard(self, pil_image:Image.Image):
+        self._images.pop(id(pil_image), None)
 
 
 
@@ -42,9 +121,28 @@ def image_process(image_process_function):
 
 class HBImage:
 
-    def __init__(self, source,**kwargs):
+    def __init__(self, source, lazy:bool=False, **kwargs):
+        """
+        Args:
+            source: see load().
+            lazy (bool, optional): If True, crop, flips, 90 degree rotations, gray and invert are only recorded,
+            and run (optimized, see HBOpChain) when the pixels are needed. 
+            The images they return are also lazy. Defaults to False.
+        """
         self._is_empty = True
         self._image = None
+        self._is_lazy:bool = lazy
+        #recorded operations of a lazy image, self._image is the image they start from.
+        self._ops:HBOpChain = None
+        #set if self._image reads its pixels from shared memory.
+        self._shared_buffer:HBSharedBuffer = None
+        #the images sharing the pixels of self._image, see _writable_image().
+        self._sharers:_HBPixelSharers = None
+        self._generation:int = 0
+        #mip pyramid of the pixels of a generation, built when a resized image is needed, see pyramid.
+        self._pyramid:HBPyramid = None
+        #the pixels of a file are decoded once, by the first thread that needs them, see decode().
+        self._decode_lock = threading.Lock()
         self._roi = (0, 0, 0, 0)
         self._information = dict.fromkeys([
             "filename","filepath","format","size"
@@ -95,10 +193,13 @@ class HBImage:
 
     @property
     def size(self):
+        if self._ops:
+            return self._ops.size
         return self._image.size
 
     @property
     def image(self):
+        self._materialize()
         return self._image
 
     @property
@@ -106,7 +207,7 @@ class HBImage:
         if self._is_empty:
             return None
 
-        self._information["size"] = (self._image.width, self._image.height)
+        self._information["size"] = self.size
 
         return self._information
 
@@ -119,6 +220,57 @@ class HBImage:
     def is_empty(self):
         return self._is_empty
 
+    @property
+    def is_lazy(self) -> bool:
+        return self._is_lazy
+
+    @property
+    def has_pending_ops(self) -> bool:
+        """True if a lazy image has recorded operations that have not run yet."""
+        return bool(self._ops)
+
+    @property
+    def is_decoded(self) -> bool:
+        """False while the pixels of the file are not decoded (PIL decodes a file when its pixels are used).
+        A pyramid level may be decoded already, see decode_for_size().
+        """
+        return not getattr(self._image, "tile", None)
+
+    @property
+    def generation(self) -> int:
+        """Changes every time the pixels are modified in place, 
+        and goes back to the previous value when the modification is undone by restore().\n
+        Every pixel state gets a generation of its own, copies share it while they share the pixels,
+        so generation can be used as the key of anything computed from the pixels (e.g. HBRenderCache).
+        """
+        return self._generation
+
+    @property
+    def pyramid(self) -> HBPyramid:
+        """Mip pyramid of the current pixels (see HBPyramid), built lazily and kept until the pixels change.
+        Copies share it while they share the pixels.
+        """
+        pyramid = self._pyramid
+        if pyramid is None or pyramid.generation != self._generation:
+            self._materialize()
+            #level 0 is not decoded until it is used.
+            pyramid = self._pyramid = HBPyramid(self._image, self._generation, self.decode)
+        return pyramid
+
+    @property
+    def shared_name(self) -> str:
+        """Name of the shared memory segment that holds the pixels, 
+        pass it to HBImage.attach_shared() in another process.
+        None if the pixels are not in shared memory (or were modified after to_shared()).
+        """
+        if self._shared_buffer is None or self._ops:
+            return None
+        if not self._image.readonly:
+            #PIL copied the pixels to private memory before modifying them.
+            self._release_shared_buffer()
+            return None
+        return self._shared_buffer.name
+
     @property
     def is_ROI_empty(self):
         return self.ROI == (0,0,0,0)
@@ -192,16 +344,274 @@ class HBImage:
 
     @staticmethod
     def load_from_qimage(source, **image_infos):
-        """load image from pyside/pyqt QImage."""
-        hb_qt_img = HBImage(ImageQt.fromqimage(source), **image_infos)
+        """load image from pyside/pyqt QImage.\n
+        The pixels are read in place if the QImage layout matches (see HBQtBridge), until the image is modified.
+        """
+        #PySide is only needed here, HBImage can be used without it.
+        from . import HBQtBridge
+        hb_qt_img = HBImage(HBQtBridge.qimage_to_pil(source), **image_infos)
             
 
         return hb_qt_img
 
 
+    @staticmethod
+    def attach_shared(name:str, **image_infos):
+        """Load image from a shared memory segment created by "to_shared()",
+        the pixels are read in place, without copying.
+        The image information saved by to_shared() is used unless image_infos are given.
+        """
+        return HBImage(HBSharedBuffer(name), **image_infos)
+
+
+    @staticmethod
+    def read_source(source:str) -> bytes:
+        """Return the encoded bytes of an image file path or url, without decoding it."""
+        if HBCommon.is_url(source):
+            return HBImage._fetch_url(source)
+        with open(source, "rb") as f:
+            return f.read()
+
+
+    @staticmethod
+    def load_from_bytes(data:bytes, source:str):
+        """Decode the encoded bytes of an image, which were read from source(file path or url)."""
+        pil_image = Image.open(io.BytesIO(data))
+        pil_image.load()
+        infos = {
+            "filename":HBCommon.get_file_basename(source),
+            "filepath":source,
+            "format":pil_image.format.lower()
+        }
+        return HBImage(pil_image, **infos)
+
+
+    @staticmethod
+    def load_region(source:str, box:tuple, reduce:int=1):
+        """Load only the region box of an image file (crop-on-load), 
+        the rest of the file is not decoded if its layout allows it (see HBRegionDecoder).
+
+        Args:
+            source (str): image file path.
+            box (tuple(int,int,int,int)): the region, limited to the size of the image.
+            reduce (int, optional): the region is loaded 1/reduce of its size. Defaults to 1.
+        """
+        pil_image = HBRegionDecoder.decode(source, box, reduce)
+        with Image.open(source) as file_image:
+            file_format = file_image.format.lower()
+        infos = {
+            "filename":HBCommon.get_file_basename(source),
+            "filepath":source,
+            "format":file_format
+        }
+        return HBImage(pil_image, **infos)
+
+
+
+    @staticmethod
+    def load_progressive(url:str, on_preview, preview_size:tuple=None, preview_interval:float=0.25, is_cancelled=None):
+        """Load an image url, and show it while it is downloaded:
+        on_preview(pil_image) is called with the pixels decoded from the bytes received so far
+        (see HBProgressiveDecoder, JPEG and PNG), at most once every preview_interval seconds, in the calling thread.
+
+        Args:
+            url (str)
+            on_preview (function): on_preview(pil_image), pil_image has the size of the image.
+            preview_size (tuple(int,int), optional): size the previews are shown at. Defaults to None.
+            preview_interval (float, optional): min seconds between two previews. Defaults to 0.25.
+            is_cancelled (function, optional): the download stops if is_cancelled() returns True. Defaults to None.
+
+        Raises:
+            CancelledError: is_cancelled() returned True.
+        """
+        pil_image = HBImage._open_url(url, on_preview, preview_size, preview_interval, is_cancelled)
+        infos = {
+            "filename":HBCommon.get_file_basename(url),
+            "filepath":url,
+            "format":pil_image.format.lower()
+        }
+        return HBImage(pil_image, **infos)
+
+
+
+    @staticmethod
+    def copy_stats() -> dict:
+        """Return how many times each operation was called and how many physical pixel copies
+        (and bytes) it made, e.g. {"filp_horizontal": {"calls":3, "copies":0, "bytes":0}}.\n
+        Copies are counted since the last HBImage.reset_copy_stats().
+        """
+        with _copy_stats_lock:
+            return {name:dict(stats) for name, stats in _copy_stats.items()}
+
+
+    @staticmethod
+    def reset_copy_stats():
+        with _copy_stats_lock:
+            _copy_stats.clear()
+
+
 
     #--------------private fuctions------------------------------
 
+    @staticmethod
+    def _fetch_url(url:str, on_data=None) -> bytes:
+        """Download url by the shared HBFetcher, ftp urls use urlopen.
+        on_data receives the bytes as they arrive (see HBFetcher.fetch).
+        """
+        if not url.lower().startswith("ftp"):
+            return shared_fetcher.fetch(url, on_data=on_data).body
+        req = Request(url, headers={"User-Agent":USER_AGENT})
+        with urlopen(req, timeout=shared_fetcher.read_timeout) as response:
+            if on_data is None:
+                return response.read()
+            on_data(None)
+            chunks = []
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                on_data(chunk)
+            return b"".join(chunks)
+
+    @staticmethod
+    def _open_url(url:str, on_preview=None, preview_size:tuple=None, preview_interval:float=0.25, is_cancelled=None) -> Image.Image:
+        """Download url and decode it while the bytes arrive (see load_progressive)."""
+        decoder = HBProgressiveDecoder(preview_size)
+        last_preview = 0.0
+
+        def on_data(chunk:bytes):
+            nonlocal last_preview
+            if is_cancelled is not None and is_cancelled():
+                raise CancelledError()
+            decoder.feed(chunk)
+            if on_preview is None or not decoder.has_new_preview:
+                return None
+            if time.perf_counter() - last_preview < preview_interval:
+                return None
+            preview = decoder.preview()
+            #the interval starts after the decoding, a slow preview does not take all the time.
+            last_preview = time.perf_counter()
+            if preview is not None:
+                on_preview(preview)
+
+        HBImage._fetch_url(url, on_data)
+        return decoder.close()
+
+    @staticmethod
+    def _save_pil(pil_image:Image.Image, filepath:str, *args):
+        if not HBMappedFile.is_mapped(filepath):
+            pil_image.save(filepath, *args)
+            return None
+        #PIL truncates the file it writes, the images that read the mapped pixels (maybe pil_image) 
+        #would read past its end (SIGBUS). The new file replaces it once written, the mapping keeps the old one.
+        folder, filename = path.split(path.abspath(filepath))
+        saving_path = path.join(folder, f".saving_{filename}")
+        try:
+            pil_image.save(saving_path, *args)
+            os.replace(saving_path, filepath)
+        finally:
+            if path.exists(saving_path):
+                os.remove(saving_path)
+
+    def _share(self, pil_image:Image.Image, sharers:_HBPixelSharers=None):
+        """Let self.image read the pixels of pil_image without copying them.\n
+        All the images that share the pixels are read-only,
+        the first one that is modified copies them (copy-on-write).
+        """
+        pil_image.load()
+        if sharers is None:
+            sharers = _HBPixelSharers(is_readonly_memory=bool(pil_image.readonly))
+            sharers.add(pil_image)
+        pil_image.readonly = 1
+
+        self._image = pil_image._new(pil_image.im)
+        self._image.readonly = 1
+        self._sharers = sharers
+        sharers.add(self._image)
+
+
+    def _writable_image(self) -> Image.Image:
+        """Return self.image, ready to be modified in place.\n
+        The pixels are copied only if other images still read them, or they are read-only memory.
+        """
+        self._materialize()
+        if not isinstance(self._image, Image.Image):
+            return self._image
+        self.decode()
+        self._image.load()
+        if not self._image.readonly:
+            return self._image
+
+        sharers = self._sharers
+        if sharers is not None:
+            sharers.discard(self._image)
+        if sharers is not None and not len(sharers) and not sharers.is_readonly_memory:
+            #the other images are gone, the pixels are owned by self only.
+            self._image.readonly = 0
+        else:
+            self._image = self._image.copy()
+            self._count_copy(self._image)
+            self._release_shared_buffer()
+        self._sharers = None
+        return self._image
+
+
+    def _swap_image(self, pil_image:Image.Image, sharers:_HBPixelSharers) -> HBImagePatch:
+        """Replace self.image by pil_image without copying, return the patch of the old image."""
+        self._materialize()
+        patch = HBImagePatch(None, self._image, self._generation)
+        patch._sharers = self._sharers
+        self._release_shared_buffer()
+        #the pyramid keeps the old pixels alive.
+        self._pyramid = None
+        self._image = pil_image
+        self._sharers = sharers
+        return patch
+
+
+    def _materialize(self):
+        """Run the recorded operations of a lazy image, self.image becomes their result."""
+        if not self._ops:
+            return None
+        pil_image = self._ops.apply(self._image)
+        self._ops = None
+        if pil_image is not self._image:
+            self._release_shared_buffer()
+            self._share(pil_image)
+
+
+    def _rendered_image(self) -> Image.Image:
+        """Return the pixels without keeping the result of the recorded operations,
+        so saving many lazy images never holds all the results in memory."""
+        if self._ops:
+            return self._ops.apply(self._image)
+        return self._image
+
+
+    def _defer(self, op) -> 'HBImage':
+        """Return a lazy image that records op after the operations of self."""
+        hb_image = HBImage(self)
+        hb_image._ops = (self._ops or HBOpChain(self._image.size, self._image.mode)).then(op)
+        hb_image._generation = next(_generations)
+        hb_image.ROI_clear()
+        return hb_image
+
+
+    def _count_copy(self, pil_image:Image.Image):
+        operation = getattr(_current_operation, "name", None) or "untracked"
+        width, height = pil_image.size
+        with _copy_stats_lock:
+            stats = _copy_stats.setdefault(operation, {"calls":0, "copies":0, "bytes":0})
+            stats["copies"] += 1
+            stats["bytes"] += width * height * len(pil_image.getbands())
+
+
+    def _release_shared_buffer(self):
+        if self._shared_buffer:
+            self._shared_buffer.release()
+            self._shared_buffer = None
+
     def _limit_box(self, _box):
         """this function limit the box coordinates between [0, image.size).
 
@@ -228,56 +638,176 @@ class HBImage:
         """
         According to the type of the passed-in parameter, use a different load method:
         If the passed-in parameter type is...
-        - String, then it is determined to be an image file path.
-        - HBImage, then its image is copied to self.image.
-        - PIL.Image.Image or its subclass, then it is copied to self.image.
+        - String, then it is determined to be an image file path (or url). 
+        Uncompressed pixels that PIL can read in place are memory mapped (see HBMappedFile), not read.
+        Use load_progressive() to show an url while it is downloaded.
+        - HBImage, then self.image shares its pixels.
+        - PIL.Image.Image or its subclass, then self.image shares its pixels.
+        - HBSharedBuffer, then self.image reads the pixels in the shared memory.\n
+        Shared pixels are never copied until one of the images is modified (copy-on-write).
         """
         if isinstance(source, str):
+            mapped_file = None
             if HBCommon.is_url(source):
-                headers = {
-                    "User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36"
-                }
-                req = Request(source, headers=headers)
-                self._image = Image.open(urlopen(req))  
+                #PNG rows are decoded while they are downloaded.
+                self._image = HBImage._open_url(source)
             else: 
-                self._image = Image.open(source)
-
+                mapped_file = HBMappedFile.open(source) if KEEP_MAPPED else None
+                if mapped_file is not None and not mapped_file.is_mappable:
+                    mapped_file.close()
+                    mapped_file = None
+                if mapped_file is None:
+                    self._image = Image.open(source)
+
+            if mapped_file is not None:
+                #the pixels are read from the file in place, they are copied by the first modification.
+                self._image = mapped_file.image
+                self._sharers = _HBPixelSharers(is_readonly_memory=True)
+                self._sharers.add(self._image)
             self.information = {
                 "filename":HBCommon.get_file_basename(source),
                 "filepath":source,
-                "format":self._image.format.lower()
+                "format":mapped_file.format if mapped_file else self._image.format.lower()
             }
         elif isinstance(source, HBImage):
-            self._image = source.image.copy()
+            self._generation = source.generation
+            self._pyramid = source._pyramid
+            self._is_lazy = self._is_lazy or source.is_lazy
+            self._ops = source._ops
+            filepath = source._information.get("filepath")
+            if not source.is_decoded and filepath and path.isfile(filepath):
+                #the copy decodes the file by itself when its pixels are used, 
+                #until then it can be shown from the shared pyramid (see decode_for_size()).
+                self._image = Image.open(filepath)
+            elif isinstance(source._image, Image.Image):
+                source.decode()
+                self._share(source._image, source._sharers)
+                source._sharers = self._sharers
+            else:
+                self._image = source.image.copy()
             self._roi = source.ROI
             self.information = source.information
 
         elif isinstance(source, Image.Image):
-            self._image = source.copy()
+            self._share(source)
             self.information = kwargs
 
+        elif isinstance(source, HBSharedBuffer):
+            self._shared_buffer = source
+            self._image = source.image
+            self._sharers = _HBPixelSharers(is_readonly_memory=True)
+            self._sharers.add(self._image)
+            self.information = kwargs or source.information
+
         else:
             raise TypeError(f"Cannot Load {type(source)}.")
 
+        if not isinstance(source, HBImage) or not self._generation:
+            #new pixels, even if this image was loaded before.
+            self._generation = next(_generations)
         self._is_empty = False
 
 
 
+    def decode(self):
+        """Decode the pixels of the file, if they are not decoded yet. Thread safe."""
+        if self.is_decoded:
+            return None
+        with self._decode_lock:
+            if not self.is_decoded:
+                self._image.load()
+
+
+    def decode_async(self) -> Future:
+        """decode() in a background thread."""
+        return _decoder.submit(self.decode)
+
+
+    def decode_for_size(self, size:tuple) -> bool:
+        """Decode the image only as big as needed to be shown at size (not smaller than size),
+        by the DCT scaling of JPEG (PIL draft) or the resolution levels of JPEG 2000 (PIL reduce),
+        as the pyramid level of that size (see pyramid.seed()), so showing a big image does not decode it.
+        The full resolution is decoded when it is needed: the pixels are used (edits, crop, save ...),
+        or a bigger level is rendered (e.g. 1:1 view). Use decode_async() to decode it in the background.
+
+        Args:
+            size (tuple(int,int)): size the image is shown at.
+
+        Returns:
+            bool: True if a smaller image was decoded. False if the pixels are decoded already,
+            a pyramid level is built already, or the format cannot be decoded at a smaller scale.
+        """
+        filepath = self._information.get("filepath")
+        if self.is_decoded or self._ops or not filepath or HBCommon.is_url(filepath):
+            return False
+        if self._image.format not in ("JPEG", "JPEG2000") or self._image.mode not in REDUCE_MODES:
+            return False
+        pyramid = self.pyramid
+        index = pyramid.level_index_for(size)
+        if index == 0 or len(pyramid) > 1:
+            return False
+
+        with Image.open(filepath) as pil_image:
+            if pil_image.format == "JPEG":
+                #the DCT scaling is 1/2, 1/4 or 1/8, the biggest one that is not smaller than size.
+                pil_image.draft(self._image.mode, pyramid.level_size(index))
+                if pil_image.size == self._image.size:
+                    return False
+            else:
+                pil_image.reduce = index
+            pil_image.load()
+        index = round(self._image.width / pil_image.width).bit_length() - 1
+        if pil_image.size != pyramid.level_size(index) or pil_image.mode != self._image.mode:
+            return False
+        pyramid.seed(index, pil_image, decode=self.decode)
+        return True
+
+
+    def close(self):
+        """Close the image and release its shared memory."""
+        if self._image is not None:
+            self._image.close()
+        self._release_shared_buffer()
+
+
+    def to_shared(self) -> str:
+        """Move the pixels into a new shared memory segment, and return the segment name.\n
+        Other processes can attach it with HBImage.attach_shared(name) without copying the pixels.
+        The segment is unlinked when this image is closed (or garbage collected)
+        and no other HBImage in this process uses it.
+        """
+        if self.shared_name:
+            return self.shared_name
+        shared_buffer = HBSharedBuffer.create(self.image, self.information)
+        self._image = shared_buffer.image
+        self._shared_buffer = shared_buffer
+        self._sharers = _HBPixelSharers(is_readonly_memory=True)
+        self._sharers.add(self._image)
+        return shared_buffer.name
+
+
     def save(self, filepath, format = None, **kwargs):
+        if format is not None:
+            name, name_format = HBCommon.get_file_name_and_format(filepath)
+            filepath = f"{name}.{format}"
+        if HBMappedFile.is_mapped(filepath) and self._sharers is not None and self._sharers.is_readonly_memory:
+            #stop reading the pixels of the file that is replaced, its map is closed when nothing else reads it.
+            self._writable_image()
+            self._pyramid = None
+
         if format is None:
-            self._image.save(filepath)
-            return None
-        
-        name, name_format = HBCommon.get_file_name_and_format(filepath)
-        new_filename = f"{name}.{format}"
-        self._image.save(new_filename, format, kwargs)
+            HBImage._save_pil(self._rendered_image(), filepath)
+        else:
+            HBImage._save_pil(self._rendered_image(), filepath, format, kwargs)
 
         
 
+    @count_copies
     def copy(self):
-        """return HBImage(self)"""
+        """return HBImage(self), which shares the pixels until one of them is modified."""
         return HBImage(self)
 
+    @count_copies
     def crop(self, box=None):
         """Returns a rectangular region from this image.\n
         If ROI is set, then crop ROI. 
@@ -292,22 +822,33 @@ class HBImage:
             HBImage: _description_
         """
         if box:
-            return HBImage(self._image.crop(self._limit_box(box)), **self.information)
-        if self.is_ROI_empty:
+            box = self._limit_box(box)
+        elif self.is_ROI_empty:
             return self
+        else:
+            box = self.ROI
 
-        return HBImage(self._image.crop(self.ROI), **self.information)
+        filepath = self._information.get("filepath")
+        if not self.is_decoded and not self._ops and HBRegionDecoder.is_region_decodable(filepath):
+            #only the region is decoded from the file.
+            return HBImage(HBRegionDecoder.decode(filepath, box), **self.information)
+        if self.is_lazy:
+            return self._defer(HBOpChain.crop(box))
+        return HBImage(self.image.crop(box), **self.information)
 
 
+    @count_copies
     def draw_rect(self, rect=None, fill_color=None, outline_color="blue", outline_width=1):
         if rect is None:
             rect = self.ROI
         if self.is_ROI_empty:
             return None
-        draw = ImageDraw.Draw(self.image)
+        draw = ImageDraw.Draw(self._writable_image())
         draw.rectangle(rect, fill_color, outline_color, outline_width)
+        self._generation = next(_generations)
 
 
+    @count_copies
     def paste(self, other_hbimage):
         """Pastes another image into this image.
 
@@ -317,8 +858,106 @@ class HBImage:
             HBImage
         """
         hb_image = self.copy()
-        hb_image._image.paste(other_hbimage.image,self.ROI)
+        hb_image._writable_image().paste(other_hbimage.image,self.ROI)
+        hb_image._generation = next(_generations)
         return hb_image
+
+
+    @count_copies
+    def process_in_place(self, process_function) -> HBImagePatch:
+        """Run process_function on this image and write the result into this image, as a new generation.\n
+        If ROI is set, only the ROI is cropped, processed and written back, 
+        the other pixels are never copied, so the cost depends on the ROI size, not the image size.
+        (The pixels are copied once if other images still share them, see copy().)
+
+        Args:
+            process_function (function): process_function(hb_image) -> HBImage, e.g. HBImage.to_gray.
+
+        Returns:
+            HBImagePatch: the replaced pixels, pass it to restore() to undo.
+        """
+        if self.is_ROI_empty:
+            processed_image = process_function(self)
+            patch = self._swap_image(processed_image.image, processed_image._sharers)
+        else:
+            box = self.ROI
+            region_image = self.crop()
+            processed_image = process_function(region_image)
+            patch = HBImagePatch(box, region_image.image, self._generation)
+            self._writable_image().paste(processed_image.image, box)
+
+        self._generation = next(_generations)
+        return patch
+
+
+    @count_copies
+    def write(self, hb_image:'HBImage', box:tuple=None, generation:int=None, keep_patch:bool=True) -> HBImagePatch:
+        """Write the pixels of hb_image (e.g. processed in another thread) into box of this image, as a new generation.
+        If box is None, hb_image replaces the whole image (its pixels are not copied).
+
+        Args:
+            hb_image (HBImage)
+            box (tuple, optional): Defaults to None.
+            generation (int, optional): the generation these pixels had before, e.g. when an exact inverse
+            writes back the pixels of a previous state (undo). Defaults to None, a new generation.
+            keep_patch (bool, optional): If False, the replaced pixels are not kept (not copied). Defaults to True.
+
+        Returns:
+            HBImagePatch: the replaced pixels, pass it to restore() to undo. None if keep_patch is False.
+        """
+        if box is None:
+            patch = self._swap_image(hb_image.image, hb_image._sharers)
+        else:
+            patch = HBImagePatch(box, self.image.crop(box), self._generation) if keep_patch else None
+            self._writable_image().paste(hb_image.image, box)
+
+        self._generation = generation or next(_generations)
+        return patch if keep_patch else None
+
+
+    @count_copies
+    def restore(self, patch:HBImagePatch) -> HBImagePatch:
+        """Write the pixels of patch back into this image (undo).
+
+        Returns:
+            HBImagePatch: the replaced pixels, pass it to restore() to redo.
+        """
+        if patch.is_whole_image:
+            redo_patch = self._swap_image(patch.image, patch._sharers)
+        else:
+            redo_patch = HBImagePatch(patch.box, self.image.crop(patch.box), self._generation)
+            self._writable_image().paste(patch.image, patch.box)
+
+        self._generation = patch.generation
+        return redo_patch
+
+
+    def patch(self, box:tuple=None) -> HBImagePatch:
+        """Return a patch of the current pixels in box (default: ROI, or the whole image if ROI is not set),
+        take it before modifying the box in place, and restore() it to undo the modification.
+        """
+        if box is None and self.is_ROI_empty:
+            #the patch shares the pixels, they are copied if this image is modified (copy-on-write).
+            hb_image = self.copy()
+            patch = HBImagePatch(None, hb_image.image, self._generation)
+            patch._sharers = hb_image._sharers
+            return patch
+        box = box or self.ROI
+        return HBImagePatch(box, self.image.crop(box), self._generation)
+
+
+    @count_copies
+    def replace(self, hb_image:'HBImage') -> HBImagePatch:
+        """Replace the pixels of this image by the pixels of hb_image (not copied), as a new generation.
+        ROI is cleared.
+
+        Returns:
+            HBImagePatch: the replaced pixels, pass it to restore() to undo.
+        """
+        patch = self._swap_image(hb_image.image, hb_image._sharers)
+        self._generation = next(_generations)
+        self.ROI_clear()
+        return patch
         
 
     def split(self, pos:int, axis:str) -> list:
@@ -356,21 +995,35 @@ class HBImage:
             
         return [hbimage0, hbimage1]
 
+    @count_copies
     def to_qt(self):
         """
         This will return a HBImage object.\n
-        with the image that is converted to PIL.ImageQt.ImageQt class.
+        with the image that is converted to QImage (HBQtBridge.HBQImage), the pixels are packed once.
         """
+        from . import HBQtBridge
+        self._materialize()
         qt_hb_img = self.copy()
-        qt_hb_img._image = ImageQt.ImageQt(qt_hb_img.image)
+        qt_hb_img._image = HBQtBridge.pil_to_qimage(qt_hb_img.image)
         return qt_hb_img
 
 
 
+    @count_copies
     def to_fit_container(self, container_size: tuple):
         """
         Enlarge image until it width or height is the same as container_size.
         """
+        new_size = self.fit_container_size(container_size)
+        #resampled from the nearest pyramid level, not from the whole image.
+        return HBImage(self.pyramid.resize(new_size))
+
+
+    def fit_container_size(self, container_size: tuple) -> tuple:
+        """
+        Return the size of to_fit_container(container_size) without resizing the image,
+        fit_offset and the ratio used by box_fit_resized_image() are updated the same way.
+        """
         original_width, original_height = self.size
         container_width, container_height = container_size
 
@@ -391,7 +1044,7 @@ class HBImage:
         else:
             self._fit_offset = ((container_width-new_width)//2, 0)
 
-        return HBImage(self._image.resize(new_size, Image.BICUBIC))
+        return new_size
 
 
     def box_fit_resized_image(self, box):
@@ -430,29 +1083,69 @@ class HBImage:
 
 
     #---------------image process---------------------
+    @count_copies
     def rotate(self, angle):
+        """Rotate counterclockwise. Multiples of 90 degrees are exact transposes, without resampling."""
+        if angle % 90 == 0:
+            return self.transform(HBTransform.rotate(angle))
         rotate_img = self.image.rotate(angle, expand=True)
         return HBImage(rotate_img, **self.information)
 
 
+    @count_copies
+    def transform(self, hb_transform:HBTransform, in_place:bool=False):
+        """Apply a flip/90 degree rotation (or any combination of them) to the whole image, 
+        in a single transpose. The identity does not touch the pixels.
+
+        Args:
+            hb_transform (HBTransform)
+            in_place (bool, optional): If True, transform this image as a new generation (ROI is cleared),
+            and return None. Undo it with transform(hb_transform.inverse(), in_place=True). Defaults to False.
+
+        Returns:
+            HBImage: the transformed image.
+        """
+        if not in_place:
+            if hb_transform.is_identity:
+                return self.copy()
+            if self.is_lazy:
+                return self._defer(HBOpChain.transform(hb_transform))
+            return HBImage(hb_transform.apply(self.image), **self.information)
+
+        if hb_transform.is_identity:
+            return None
+        transformed_image = HBImage(hb_transform.apply(self.image))
+        self._swap_image(transformed_image.image, transformed_image._sharers)
+        self._generation = next(_generations)
+        self.ROI_clear()
+
+
     @image_process
     def filp_horizontal(self):
-        flip_img = self.image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        if self.is_lazy:
+            return self._defer(HBOpChain.transform(HBTransform.flip_horizontal()))
+        flip_img = HBTransform.flip_horizontal().apply(self.image)
         return HBImage(flip_img, **self.information)
 
     @image_process
     def filp_vertical(self):
-        flip_img = self.image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        if self.is_lazy:
+            return self._defer(HBOpChain.transform(HBTransform.flip_vertical()))
+        flip_img = HBTransform.flip_vertical().apply(self.image)
         return HBImage(flip_img, **self.information)
 
 
     @image_process
     def to_gray(self):
+        if self.is_lazy:
+            return self._defer(HBOpChain.gray())
         gray_img = self.image.convert('L')
         return HBImage(gray_img, **self.information)
 
     @image_process
     def color_invert(self):
+        if self.is_lazy:
+            return self._defer(HBOpChain.invert())
         inverted_img = ImageChops.invert(self.image)
         return HBImage(inverted_img, **self.information)
 
@@ -0,0 +1,155 @@
+"""
+HBImageCache is a thread-safe LRU cache of decoded HBImage objects.\n
+The cache is limited by the number of bytes the decoded pixels occupy, not by the number of images.
+A single instance "shared_image_cache" is shared by every lazy HBAlbum,
+so two albums that point at the same file only decode it once.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+
+def image_nbytes(pil_image) -> int:
+    """Estimate how many bytes the decoded pixels of a PIL.Image occupy."""
+    if pil_image is None:
+        return 0
+    width, height = pil_image.size
+    #PIL stores every multi-band pixel (include "RGB") in 4 bytes.
+    if pil_image.mode in ("1", "L", "P"):
+        pixel_size = 1
+    elif pil_image.mode.startswith("I;16"):
+        pixel_size = 2
+    else:
+        pixel_size = 4
+    return width * height * pixel_size
+
+
+def source_key(source:str):
+    """Key used to identify a decoded source in the cache.\n
+    Local files also use their modification time and size,
+    so an edited file on disk is not served from the cache.
+    """
+    try:
+        stat = os.stat(source)
+    except (OSError, ValueError):
+        return (source,)
+    return (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+
+
+
+
+class HBImageCache:
+
+    def __init__(self, max_bytes:int = 512*1024*1024):
+        self._entries:OrderedDict = OrderedDict()
+        self._entries_nbytes:dict = {}
+        self._nbytes:int = 0
+        self._max_bytes:int = max_bytes
+        self._lock = threading.RLock()
+        #keys which are being decoded now, and the event that is set when the decoding is finished.
+        self._loading:dict = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value:int):
+        with self._lock:
+            self._max_bytes = int(value)
+            self._evict()
+
+
+    def get(self, key):
+        """Return the cached HBImage of key and mark it as the most recently used.
+        If key is not cached, return None.
+        """
+        with self._lock:
+            hb_image = self._entries.get(key)
+            if hb_image is not None:
+                self._entries.move_to_end(key)
+            return hb_image
+
+    def get_or_load(self, key, loader) -> tuple:
+        """Return the cached HBImage of key. If key is not cached, call loader() to get it and cache it.\n
+        If another thread is loading the same key, wait for it instead of loading the key twice.
+
+        Args:
+            key: the cache key.
+            loader (function): return a HBImage.
+
+        Returns:
+            tuple(HBImage, bool): the image, and whether it was already in the cache.
+        """
+        while True:
+            with self._lock:
+                hb_image = self.get(key)
+                if hb_image is not None:
+                    return hb_image, True
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            loading.wait()
+            hb_image = self.get(key)
+            if hb_image is not None:
+                return hb_image, False
+
+        try:
+            hb_image = loader()
+            self.put(key, hb_image)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return hb_image, False
+
+    def put(self, key, hb_image):
+        nbytes = image_nbytes(hb_image.image)
+        with self._lock:
+            self.discard(key)
+            self._entries[key] = hb_image
+            self._entries_nbytes[key] = nbytes
+            self._nbytes += nbytes
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            del self._entries[key]
+            self._nbytes -= self._entries_nbytes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._entries_nbytes.clear()
+            self._nbytes = 0
+
+
+    def _evict(self):
+        """Drop the least recently used images until the cache fits in max_bytes.
+        The most recently used image is always kept, even if it alone exceeds the budget.
+        """
+        while self._nbytes > self._max_bytes and len(self._entries) > 1:
+            key, _ = self._entries.popitem(last=False)
+            self._nbytes -= self._entries_nbytes.pop(key)
+
+
+
+
+shared_image_cache = HBImageCache()
@@ -0,0 +1,170 @@
+"""
+HBImagePatch keeps the pixels of a region of an HBImage before it was modified in place,
+so the modification can be undone by writing the patch back with "HBImage.restore(patch)".\n
+A patch only holds the pixels of its region, so undoing a small ROI process on a big image
+costs memory (and time) in proportion to the ROI, not to the whole image.\n
+A patch that is not likely to be used soon (e.g. deep in the undo history) can be compressed with compress(),
+or moved to a file with spill(), it is read back and decompressed the next time its image is needed.
+"""
+
+import os
+import zlib
+import tempfile
+import threading
+
+from PIL import Image
+
+
+
+#rows compressed/decompressed at a time, to keep the temporary memory small.
+_STRIPE_ROWS = 256
+
+
+
+class HBImagePatch:
+
+    def __init__(self, box:tuple, image:Image.Image, generation:int):
+        """
+        Args:
+            box (tuple(int,int,int,int)): the region (x0, y0, x1, y1) the patch is written to.
+            None if the patch replaces the whole image (its size may be different).
+            image (PIL.Image.Image): pixels of the region.
+            generation (int): generation of the HBImage when it had these pixels.
+        """
+        self._box:tuple = box
+        self._image:Image.Image = image
+        self._generation:int = generation
+        #image sharers of a whole image patch, restored together with the pixels.
+        self._sharers = None
+
+        #compressed pixels: list of zlib compressed stripes.
+        self._compressed:list = None
+        self._mode:str = image.mode
+        self._size:tuple = image.size
+        self._palette:list = None
+        #file of the compressed stripes, and their lengths, after spill().
+        self._spill_path:str = None
+        self._stripe_lengths:list = None
+        self._lock = threading.Lock()
+
+
+    def __del__(self):
+        self._remove_spill_file()
+
+
+    @property
+    def box(self) -> tuple:
+        return self._box
+
+    @property
+    def image(self) -> Image.Image:
+        with self._lock:
+            if self._image is None:
+                if self._spill_path:
+                    self._compressed = self._read_spill_file()
+                self._image = self._decompress()
+                self._compressed = None
+            return self._image
+
+    @property
+    def size(self) -> tuple:
+        return self._size
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def is_whole_image(self) -> bool:
+        return self._box is None
+
+    @property
+    def is_compressed(self) -> bool:
+        return self._compressed is not None
+
+    @property
+    def is_spilled(self) -> bool:
+        return self._spill_path is not None
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the pixels of the patch."""
+        with self._lock:
+            if self._spill_path:
+                return 0
+            if self._compressed is not None:
+                return sum(len(stripe) for stripe in self._compressed)
+            width, height = self._size
+            return width * height * len(self._image.getbands())
+
+
+    def compress(self, level:int=1):
+        """Keep the pixels zlib compressed until the image is needed again. Thread safe.
+
+        Args:
+            level (int, optional): zlib compression level. Defaults to 1 (fastest).
+        """
+        with self._lock:
+            if self._image is None:
+                return None
+            image = self._image
+            width, height = image.size
+            self._compressed = [
+                zlib.compress(image.crop((0, y, width, min(y+_STRIPE_ROWS, height))).tobytes(), level)
+                for y in range(0, height, _STRIPE_ROWS)
+            ]
+            if image.mode in ("P", "PA"):
+                self._palette = image.getpalette()
+            self._image = None
+            #the decompressed image is not shared with any other image.
+            self._sharers = None
+
+
+
+    def spill(self, directory:str):
+        """Compress the pixels and move them to a file in directory, until the image is needed again. Thread safe."""
+        self.compress()
+        with self._lock:
+            if self._compressed is None:
+                #spilled already, or the image was needed again meanwhile.
+                return None
+            fd, self._spill_path = tempfile.mkstemp(suffix=".patch", dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                for stripe in self._compressed:
+                    f.write(stripe)
+            self._stripe_lengths = [len(stripe) for stripe in self._compressed]
+            self._compressed = None
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _read_spill_file(self) -> list:
+        stripes = []
+        with open(self._spill_path, "rb") as f:
+            for length in self._stripe_lengths:
+                stripes.append(f.read(length))
+        self._remove_spill_file()
+        return stripes
+
+
+    def _remove_spill_file(self):
+        spill_path = getattr(self, "_spill_path", None)
+        if spill_path:
+            self._spill_path = None
+            try:
+                os.remove(spill_path)
+            except OSError:
+                pass
+
+
+    def _decompress(self) -> Image.Image:
+        width, height = self._size
+        image = Image.new(self._mode, self._size)
+        for i, stripe in enumerate(self._compressed):
+            y = i * _STRIPE_ROWS
+            stripe_size = (width, min(_STRIPE_ROWS, height-y))
+            image.paste(Image.frombytes(self._mode, stripe_size, zlib.decompress(stripe)), (0, y))
+        if self._palette:
+            image.putpalette(self._palette)
+        return image
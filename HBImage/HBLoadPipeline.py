@@ -0,0 +1,184 @@
+"""
+HBLoadPipeline loads many images with two separate groups of threads:\n
+1. I/O stage: many threads read the encoded bytes of files and urls (mostly waiting for disk/network).
+2. Decode stage: about one thread per CPU core decodes the bytes into pixels.\n
+The stages are connected by a bounded queue, so the I/O stage can never read much further
+than the decode stage can handle, and the memory of the encoded bytes stays bounded.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from typing import Callable, List
+
+
+
+class HBLoadPipeline:
+
+    def __init__(self, io_workers:int=16, decode_workers:int=None, queue_size:int=None):
+        """
+        Args:
+            io_workers (int, optional): threads of the I/O stage. Defaults to 16.
+            decode_workers (int, optional): threads of the decode stage. Defaults to the number of CPU cores.
+            queue_size (int, optional): max items waiting between the stages. Defaults to 2*decode_workers.
+        """
+        self.io_workers:int = io_workers
+        self.decode_workers:int = decode_workers or os.cpu_count() or 1
+        self.queue_size:int = queue_size or 2*self.decode_workers
+
+        self._cancel_event = threading.Event()
+        self._metrics_lock = threading.Lock()
+        self._metrics:dict = {}
+        self._reset_metrics()
+
+
+    @property
+    def metrics(self) -> dict:
+        """Throughput metrics of the last run():\n
+        - items, failed: number of loaded/failed sources.
+        - io_bytes: encoded bytes read by the I/O stage.
+        - io_seconds, decode_seconds: total busy time of all threads of each stage.
+        - wall_seconds: elapsed time of the run.
+        - io_mb_per_second: io_bytes / wall_seconds, in MB.
+        - items_per_second: items / wall_seconds.
+        - queue_high_water: max items that waited between the stages.
+        """
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        wall_seconds = metrics["wall_seconds"]
+        metrics["io_mb_per_second"] = metrics["io_bytes"] / wall_seconds / 1e6 if wall_seconds else 0.0
+        metrics["items_per_second"] = metrics["items"] / wall_seconds if wall_seconds else 0.0
+        return metrics
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+
+    def cancel(self):
+        """Stop the running run(), or the next one if it has not started yet.
+        Sources not started yet are not loaded. The pipeline stays cancelled until reset().
+        """
+        self._cancel_event.set()
+
+    def reset(self):
+        """Clear the cancel flag, so the pipeline can run again.
+        Called when a job is created, before the thread that runs it starts:
+        a cancel() coming before run() is not lost.
+        """
+        self._cancel_event.clear()
+
+
+    def run(self, sources:List[str], fetch:Callable, decode:Callable, callback:Callable=None) -> list:
+        """Load all sources, block until finished or cancelled.
+
+        Args:
+            sources (List[str]): image files' path or url.
+            fetch (function): fetch(source) -> data, called in the I/O stage.
+            decode (function): decode(source, data) -> result, called in the decode stage.
+            callback (function, optional): callback(index, result) is called in a decode thread
+            as soon as sources[index] is finished. result is the Exception if it failed.
+
+        Returns:
+            list: results in the order of sources. Failed sources are Exceptions,
+            sources skipped by cancel() are None (all of them if the pipeline was cancelled before, see reset()).
+        """
+        self._reset_metrics()
+        start_time = time.perf_counter()
+
+        results = [None] * len(sources)
+        source_queue = queue.SimpleQueue()
+        for index_source in enumerate(sources):
+            source_queue.put(index_source)
+        decode_queue = queue.Queue(self.queue_size)
+
+        io_threads = [
+            threading.Thread(target=self._io_stage, args=(source_queue, decode_queue, fetch), daemon=True)
+            for _ in range(min(self.io_workers, len(sources)) or 1)
+        ]
+        decode_threads = [
+            threading.Thread(target=self._decode_stage, args=(decode_queue, decode, results, callback), daemon=True)
+            for _ in range(self.decode_workers)
+        ]
+        for t in io_threads + decode_threads:
+            t.start()
+
+        for t in io_threads:
+            t.join()
+        #one stop sign for each decode thread.
+        for _ in decode_threads:
+            decode_queue.put(None)
+        for t in decode_threads:
+            t.join()
+
+        with self._metrics_lock:
+            self._metrics["wall_seconds"] = time.perf_counter() - start_time
+        return results
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _reset_metrics(self):
+        with self._metrics_lock:
+            self._metrics = {
+                "items":0, "failed":0, "io_bytes":0,
+                "io_seconds":0.0, "decode_seconds":0.0, "wall_seconds":0.0,
+                "queue_high_water":0
+            }
+
+
+    def _io_stage(self, source_queue:queue.SimpleQueue, decode_queue:queue.Queue, fetch:Callable):
+        while not self.is_cancelled:
+            try:
+                index, source = source_queue.get_nowait()
+            except queue.Empty:
+                return None
+
+            start_time = time.perf_counter()
+            try:
+                data = fetch(source)
+            except Exception as err:
+                data = err
+            with self._metrics_lock:
+                self._metrics["io_seconds"] += time.perf_counter() - start_time
+                if isinstance(data, (bytes, bytearray)):
+                    self._metrics["io_bytes"] += len(data)
+
+            #blocks while the decode stage is behind.
+            while not self.is_cancelled:
+                try:
+                    decode_queue.put((index, source, data), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            with self._metrics_lock:
+                self._metrics["queue_high_water"] = max(self._metrics["queue_high_water"], decode_queue.qsize())
+
+
+    def _decode_stage(self, decode_queue:queue.Queue, decode:Callable, results:list, callback:Callable):
+        while True:
+            item = decode_queue.get()
+            if item is None:
+                return None
+            if self.is_cancelled:
+                continue
+            index, source, data = item
+
+            start_time = time.perf_counter()
+            if isinstance(data, Exception):
+                result = data
+            else:
+                try:
+                    result = decode(source, data)
+                except Exception as err:
+                    result = err
+            with self._metrics_lock:
+                self._metrics["decode_seconds"] += time.perf_counter() - start_time
+                self._metrics["failed" if isinstance(result, Exception) else "items"] += 1
+
+            results[index] = result
+            if callback:
+                callback(index, result)
@@ -0,0 +1,179 @@
+"""
+HBLoadScheduler decodes the images of a lazy HBAlbum in the background,
+in the order the user is most likely to look at them:\n
+1. the bookmarked image,
+2. its neighbours in the direction the user is moving, then the neighbours behind,
+3. everything else, only while the image cache still has room.\n
+When the bookmark moves, the queue is re-prioritized around the new bookmark.
+"""
+
+import heapq
+import itertools
+import threading
+
+from typing import List
+
+
+
+def priority_rank(index:int, focus:int, direction:int, ahead:int=4, behind:int=2) -> tuple:
+    """Return the sort key of an album index. A smaller key is loaded earlier.
+
+    Args:
+        index (int): the album index to rank.
+        focus (int): the bookmarked index.
+        direction (int): 1 if the user moves forward, -1 if backward.
+        ahead (int): how many images in the moving direction are neighbours.
+        behind (int): how many images against the moving direction are neighbours.
+    """
+    delta = (index - focus) * (direction or 1)
+    if delta == 0:
+        return (0, 0)
+    if 0 < delta <= ahead:
+        return (1, delta)
+    if -behind <= delta < 0:
+        return (2, -delta)
+    #the rest: nearest first, prefer the moving direction when the distance is the same.
+    return (3, abs(delta), delta < 0)
+
+
+def priority_order(length:int, focus:int, direction:int, ahead:int=4, behind:int=2) -> List[int]:
+    """Return all album indices [0, length) sorted by priority_rank."""
+    return sorted(
+        range(length),
+        key=lambda index: priority_rank(index, focus, direction, ahead, behind)
+    )
+
+
+
+
+class HBLoadScheduler:
+
+    def __init__(self, album, workers:int=2, ahead:int=4, behind:int=2):
+        """
+        Args:
+            album (HBAlbum): a lazy HBAlbum.
+            workers (int, optional): number of decoding threads. Defaults to 2.
+            ahead (int, optional): number of neighbours in the moving direction. Defaults to 4.
+            behind (int, optional): number of neighbours against the moving direction. Defaults to 2.
+        """
+        self._album = album
+        self._ahead = ahead
+        self._behind = behind
+
+        self._heap:list = []
+        self._counter = itertools.count()
+        self._generation:int = 0
+        self._condition = threading.Condition()
+        self._is_stopped:bool = False
+
+        self._stats = dict.fromkeys(["hits", "misses", "prefetched", "skipped"], 0)
+        self._stats_lock = threading.Lock()
+
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True, name=f"HBLoadScheduler-{i}")
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+
+    @property
+    def stats(self) -> dict:
+        """Counters of the scheduler:\n
+        - hits: the bookmarked image was already decoded when it was accessed.
+        - misses: the access had to wait for a decode.
+        - prefetched: images decoded in the background.
+        - skipped: images not prefetched because the cache had no room.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    @property
+    def hit_rate(self) -> float:
+        stats = self.stats
+        accesses = stats["hits"] + stats["misses"]
+        return stats["hits"] / accesses if accesses else 0.0
+
+    def reset_stats(self):
+        with self._stats_lock:
+            for key in self._stats:
+                self._stats[key] = 0
+
+
+    def focus(self, index:int, direction:int=1):
+        """Re-prioritize the queue around index.
+        Images that are queued for the old bookmark and not started yet are dropped.
+        """
+        with self._condition:
+            self._generation += 1
+            self._heap = [
+                (priority_rank(i, index, direction, self._ahead, self._behind),
+                 next(self._counter), self._generation, entry)
+                for i, entry in enumerate(self._album._album)
+            ]
+            heapq.heapify(self._heap)
+            self._condition.notify_all()
+
+    def add(self, index:int):
+        """Queue the entry inserted at index, ranked around the current bookmark.
+        The queue is not re-prioritized (see focus()), so adding N entries one by one costs O(N log N).
+        """
+        with self._condition:
+            rank = priority_rank(index, self._album.bookmark, self._album._direction, self._ahead, self._behind)
+            heapq.heappush(self._heap, (rank, next(self._counter), self._generation, self._album._entry(index)))
+            self._condition.notify()
+
+    def record_access(self, is_hit:bool):
+        with self._stats_lock:
+            self._stats["hits" if is_hit else "misses"] += 1
+
+    def stop(self):
+        with self._condition:
+            self._is_stopped = True
+            self._heap.clear()
+            self._condition.notify_all()
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap and not self._is_stopped:
+                    self._condition.wait()
+                if self._is_stopped:
+                    return None
+                rank, _, generation, entry = heapq.heappop(self._heap)
+                if generation != self._generation:
+                    continue
+            self._prefetch(entry, rank)
+
+
+    def _prefetch(self, entry, rank:tuple):
+        """entry is queued, not its index: inserting entries (see add()) does not change what is queued."""
+        cache = self._album.cache
+        if (entry is None) or (not hasattr(entry, "lookup")):
+            return None
+        if entry.is_decoded or (entry.key in cache):
+            return None
+        #Images far away from the bookmark must not evict the images around it.
+        if rank[0] == 3 and not self._fits(entry, cache):
+            with self._stats_lock:
+                self._stats["skipped"] += 1
+            return None
+
+        try:
+            entry.decode(cache)
+        except Exception:
+            #The error will be raised again when the image is accessed.
+            return None
+        with self._stats_lock:
+            self._stats["prefetched"] += 1
+
+
+    def _fits(self, entry, cache) -> bool:
+        if entry.size is None:
+            return cache.nbytes < cache.max_bytes
+        width, height = entry.size
+        return cache.nbytes + width*height*4 <= cache.max_bytes
@@ -0,0 +1,212 @@
+"""
+HBMappedFile maps an image file whose pixels are stored uncompressed (BMP, PPM/PGM, raw TIFF) with mmap,
+so the pixels are never read into process memory: the pages of the file are loaded by the OS when they are touched,
+and opening a file of any size only reads its header.\n
+If the pixels in the file have the same layout as PIL keeps them in memory ("L", "RGBA", "I;16" ..., see is_mappable),
+image is a read-only PIL.Image that reads the file pixels in place (HBImage copies them on the first modification).
+Other layouts (e.g. 24 bits "RGB", PIL keeps 4 bytes per pixel) can still be read region by region (see region()),
+only the bytes of the region are touched.
+"""
+
+import os
+import mmap
+import weakref
+import threading
+
+from collections import Counter
+
+from PIL import Image
+
+
+
+#bits per pixel of the raw modes whose rows can be located in a file.
+RAW_BITS = {
+    "1":1, "1;I":1, "L":8, "L;I":8, "P":8, "LA":16, "I;16":16, "I;16B":16, "I;16L":16,
+    "RGB":24, "BGR":24, "RGBX":32, "RGBA":32, "BGRX":32, "BGRA":32, "CMYK":32,
+    "I":32, "I;32":32, "F":32, "F;32F":32,
+}
+
+#modes PIL can read in place from a buffer, a palette image is not mapped (putpalette() would copy it).
+MAPPABLE_MODES = tuple(mode for mode in Image._MAPMODES if mode != "P")
+
+#Image.MAX_IMAGE_PIXELS is changed while a file is opened, see open_unchecked().
+_open_lock = threading.Lock()
+
+#Windows does not let a mapped file be replaced, renamed or deleted,
+#so the images do not keep files mapped there (see HBImage.load), a region is mapped only while it is read.
+KEEP_MAPPED = os.name != "nt"
+
+#(device, inode) : number of mappings of the file in this process, see HBMappedFile.is_mapped().
+_mapped_files = Counter()
+_mapped_files_lock = threading.RLock()
+
+
+
+def open_unchecked(path:str) -> Image.Image:
+    """Image.open() without the decompression bomb check,
+    for images that are never decoded as a whole (mapped, or decoded region by region)."""
+    with _open_lock:
+        max_image_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+
+def _unregister_mapped_file(file_key:tuple):
+    with _mapped_files_lock:
+        _mapped_files[file_key] -= 1
+        if _mapped_files[file_key] <= 0:
+            del _mapped_files[file_key]
+
+
+
+
+class HBMappedFile:
+
+    def __init__(self, path:str, layout:tuple, pil_image:Image.Image):
+        """Use HBMappedFile.open(path).
+
+        Args:
+            path (str)
+            layout (tuple): (offset, rawmode, stride, orientation) of the pixels in the file.
+            pil_image (PIL.Image.Image): the opened file, for its mode, size and palette.
+        """
+        self._path:str = path
+        self._offset, self.rawmode, self.stride, self.orientation = layout
+        self.size:tuple = pil_image.size
+        self.mode:str = pil_image.mode
+        self.format:str = pil_image.format.lower()
+        self.palette:list = pil_image.getpalette() if pil_image.mode in ("P", "PA") else None
+
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            file_stat = os.fstat(f.fileno())
+        file_key = (file_stat.st_dev, file_stat.st_ino)
+        with _mapped_files_lock:
+            _mapped_files[file_key] += 1
+        #the file is not mapped any more when the map is closed, or gone with the last image that reads it.
+        self._unregister = weakref.finalize(self._map, _unregister_mapped_file, file_key)
+        self._buffer = memoryview(self._map)
+
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def is_mappable(self) -> bool:
+        """True if image reads the pixels in the file without copying them."""
+        return self.rawmode == self.mode and self.mode in MAPPABLE_MODES
+
+    @property
+    def image(self) -> Image.Image:
+        """The whole image, read-only, in place if is_mappable, else unpacked from the mapped pixels."""
+        return self.region((0, 0, *self.size))
+
+
+    def region(self, box:tuple) -> Image.Image:
+        """Return the pixels of box, only the bytes of its rows are touched.\n
+        If is_mappable, the image reads the pixels in place (read-only), else they are unpacked (copied).
+        """
+        x0, y0, x1, y1 = box
+        #the rows are stored from the bottom if orientation is -1 (e.g. BMP).
+        first_row = y0 if self.orientation >= 0 else self.size[1]-y1
+        start = self._offset + first_row*self.stride
+        #PIL needs stride*rows bytes after start, so the rows are read whole and the columns are cropped after.
+        rows_size = (self.size[0], y1-y0)
+        if self.is_mappable:
+            pil_image = Image.frombuffer(
+                self.mode, rows_size, self._buffer[start:], "raw", self.rawmode, self.stride, self.orientation
+            )
+        else:
+            #unpacked into the mode the opened file has (frombuffer() would keep e.g. "I;16B" for a 16 bits PGM).
+            pil_image = Image.frombytes(
+                self.mode, rows_size, self._buffer[start:], "raw", self.rawmode, self.stride, self.orientation
+            )
+        if self.palette:
+            pil_image.putpalette(self.palette)
+        if (x0, x1) != (0, self.size[0]):
+            pil_image = pil_image.crop((x0, 0, x1, y1-y0))
+        return pil_image
+
+
+    def close(self):
+        """Close the mapping, if no image still reads it (else it is closed when they are gone)."""
+        self._buffer.release()
+        try:
+            self._map.close()
+        except BufferError:
+            return None
+        self._unregister()
+
+
+
+    #-----------------staticmethod-------------------------------
+
+    @staticmethod
+    def open(path:str) -> 'HBMappedFile':
+        """Return the mapped file, None if its pixels are not stored uncompressed (or it is truncated)."""
+        try:
+            pil_image = open_unchecked(path)
+        except OSError:
+            return None
+        with pil_image:
+            layout = HBMappedFile.raw_layout(pil_image)
+            if layout is None:
+                return None
+            offset, rawmode, stride, _ = layout
+            width, height = pil_image.size
+            try:
+                with open(path, "rb") as f:
+                    file_size = f.seek(0, 2)
+            except OSError:
+                return None
+            if file_size == 0 or offset + stride*(height-1) + (width*RAW_BITS[rawmode]+7)//8 > file_size:
+                return None
+            return HBMappedFile(path, layout, pil_image)
+
+
+    @staticmethod
+    def is_mapped(path:str) -> bool:
+        """True if the file at path is mapped by this process, images may still read its pixels in place:
+        it must not be truncated or rewritten (replace it by a new file, see HBImage.save)."""
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return False
+        with _mapped_files_lock:
+            return _mapped_files[(file_stat.st_dev, file_stat.st_ino)] > 0
+
+
+    @staticmethod
+    def raw_layout(pil_image:Image.Image) -> tuple:
+        """Return (offset, rawmode, stride, orientation) of the pixels of an opened (not loaded) image file,
+        None if they are not stored as uncompressed rows.
+        The strips of a TIFF are one layout if they follow each other in the file.
+        """
+        tiles = pil_image.tile
+        if not tiles:
+            return None
+        width, height = pil_image.size
+        layout = None
+        next_row = 0
+        for decoder_name, extents, offset, args in sorted(tiles, key=lambda tile: tile[1][1]):
+            if isinstance(args, str):
+                args = (args, 0, 1)
+            rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+            if decoder_name != "raw" or rawmode not in RAW_BITS:
+                return None
+            x0, y0, x1, y1 = extents
+            if (x0, x1) != (0, width) or y0 != next_row:
+                return None
+            stride = stride or (width*RAW_BITS[rawmode] + 7)//8
+            if layout is None:
+                layout = (offset, rawmode, stride, orientation)
+            elif (offset, rawmode, stride, orientation) != (layout[0] + y0*layout[2], *layout[1:]) or orientation < 0:
+                return None
+            next_row = y1
+        if next_row != height:
+            return None
+        return layout
@@ -0,0 +1,182 @@
+"""
+HBOpChain records the operations of a lazy HBImage, and runs them only when the pixels are needed.\n
+Before running, the chain is optimized, the result is the same pixels:
+1. All crops are merged into one crop, moved to the start, so the other operations only process the cropped pixels.
+2. Consecutive point operations (e.g. invert) are merged into one lookup table, applied in one pass.
+3. All flips and 90 degree rotations are merged into one transpose, moved to the end, or dropped if they cancel out.\n
+Crops, point operations and transposes can be reordered because point operations work on each pixel independently,
+and a crop box can be mapped through a transpose.
+"""
+
+from typing import List
+
+from PIL import Image, ImageChops
+
+from .HBTransform import HBTransform
+
+
+
+#modes whose bands are all 8 bit, so a point operation is a lookup table of 256 values per band.
+LUT_MODES = ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK")
+
+
+
+class HBOp:
+    """One operation of an HBOpChain."""
+
+    def __init__(self, kind:str, name:str, value=None):
+        """
+        Args:
+            kind (str): "crop", "point", "gray" or "transform".
+            name (str): readable name, e.g. "invert".
+            value: box of crop, lookup table (list of 256 int) of point, HBTransform of transform.
+        """
+        self.kind:str = kind
+        self.name:str = name
+        self.value = value
+
+    def __repr__(self):
+        return f"HBOp({self.name})"
+
+
+
+class HBOpChain:
+
+    def __init__(self, size:tuple, mode:str, ops:List[HBOp]=None):
+        """
+        Args:
+            size (tuple(int,int)): size of the image the chain starts from.
+            mode (str): mode of the image the chain starts from.
+            ops (List[HBOp], optional): recorded operations.
+        """
+        self._base_size:tuple = size
+        self._base_mode:str = mode
+        self._ops:List[HBOp] = list(ops or [])
+
+
+    def __len__(self):
+        return len(self._ops)
+
+    @property
+    def ops(self) -> List[HBOp]:
+        return list(self._ops)
+
+    @property
+    def size(self) -> tuple:
+        """Size of the result, without running the chain."""
+        size = self._base_size
+        for op in self._ops:
+            if op.kind == "crop":
+                x0, y0, x1, y1 = op.value
+                size = (x1-x0, y1-y0)
+            elif op.kind == "transform":
+                size = op.value.transform_size(size)
+        return size
+
+    @property
+    def mode(self) -> str:
+        """Mode of the result, without running the chain."""
+        for op in self._ops:
+            if op.kind == "gray":
+                return "L"
+        return self._base_mode
+
+
+    #-----------------staticmethod-------------------------------
+
+    @staticmethod
+    def crop(box:tuple) -> HBOp:
+        return HBOp("crop", "crop", tuple(int(v) for v in box))
+
+    @staticmethod
+    def invert() -> HBOp:
+        return HBOp("point", "invert", [255-i for i in range(256)])
+
+    @staticmethod
+    def gray() -> HBOp:
+        return HBOp("gray", "gray")
+
+    @staticmethod
+    def transform(hb_transform:HBTransform) -> HBOp:
+        return HBOp("transform", repr(hb_transform), hb_transform)
+
+
+
+    #------------------------------------------------
+
+    def then(self, op:HBOp) -> 'HBOpChain':
+        """Return a new chain with op appended, this chain is not changed (it may be shared by other images)."""
+        return HBOpChain(self._base_size, self._base_mode, self._ops + [op])
+
+
+    def optimized(self) -> List[HBOp]:
+        """Return the operations to run: one crop, the point operations (fused), one transpose."""
+        width, height = self._base_size
+        #crop box in the base image, and the transform applied after it.
+        crop_box = (0, 0, width, height)
+        hb_transform = HBTransform.identity()
+        point_ops:List[HBOp] = []
+
+        for op in self._ops:
+            if op.kind == "transform":
+                hb_transform = hb_transform.then(op.value)
+            elif op.kind == "crop":
+                #op.value is in the transformed image, map it back to the cropped base image.
+                cropped_size = (crop_box[2]-crop_box[0], crop_box[3]-crop_box[1])
+                transformed_size = hb_transform.transform_size(cropped_size)
+                x0, y0, x1, y1 = hb_transform.inverse().map_box(op.value, transformed_size)
+                crop_box = (crop_box[0]+x0, crop_box[1]+y0, crop_box[0]+x1, crop_box[1]+y1)
+            else:
+                point_ops.append(op)
+
+        ops = []
+        if crop_box != (0, 0, width, height):
+            ops.append(HBOpChain.crop(crop_box))
+        ops += self._fuse_point_ops(point_ops)
+        if not hb_transform.is_identity:
+            ops.append(HBOpChain.transform(hb_transform))
+        return ops
+
+
+    def apply(self, pil_image:Image.Image) -> Image.Image:
+        """Run the optimized chain on pil_image (the base image).
+        Return pil_image itself if the chain does nothing.
+        """
+        for op in self.optimized():
+            pil_image = self._apply_op(op, pil_image)
+        return pil_image
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _fuse_point_ops(self, point_ops:List[HBOp]) -> List[HBOp]:
+        fused_ops:List[HBOp] = []
+        mode = self._base_mode
+        for op in point_ops:
+            if op.kind == "gray":
+                mode = "L"
+            previous = fused_ops[-1] if fused_ops else None
+            if op.kind == "point" and previous and previous.kind == "point" and mode in LUT_MODES:
+                table = [op.value[v] for v in previous.value]
+                fused_ops[-1] = HBOp("point", f"{previous.name}+{op.name}", table)
+            else:
+                fused_ops.append(op)
+        return fused_ops
+
+
+    def _apply_op(self, op:HBOp, pil_image:Image.Image) -> Image.Image:
+        if op.kind == "crop":
+            return pil_image.crop(op.value)
+        if op.kind == "transform":
+            return op.value.apply(pil_image)
+        if op.kind == "gray":
+            return pil_image.convert("L")
+
+        if pil_image.mode in LUT_MODES:
+            return pil_image.point(op.value * len(pil_image.getbands()))
+        #not 8 bit pixels, only invert is defined for them.
+        for name in op.name.split("+"):
+            if name == "invert":
+                pil_image = ImageChops.invert(pil_image)
+        return pil_image
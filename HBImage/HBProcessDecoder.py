@@ -0,0 +1,113 @@
+"""
+HBProcessDecoder decodes images in worker processes, so CPU-bound decodes (big PNG/TIFF files)
+are not limited by the GIL.\n
+A worker writes the decoded pixels into a HBSharedBuffer (multiprocessing.shared_memory) segment
+and only returns the segment name, the parent process reads the pixels in place,
+so the pixel data is never pickled or copied between the processes.
+Images whose mode cannot be shared in place (see SHAREABLE_MODES, e.g. "P", "1", "LA")
+are decoded in the calling thread, so both backends return the same pixels and modes.
+"""
+
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from .HBImage import HBImage, HBCommon
+from .HBSharedBuffer import HBSharedBuffer, SHAREABLE_MODES
+
+
+def _decode_to_shared_memory(source:str, data:bytes=None) -> str:
+    """Run in a worker process: decode source (or its encoded bytes) into a new HBSharedBuffer segment.
+    The ownership of the segment is handed over to the parent process.
+
+    Returns:
+        str: the segment name, None if the mode of the image cannot be shared (it is not decoded).
+    """
+    with Image.open(io.BytesIO(data) if data else source) as pil_image:
+        if pil_image.mode in SHAREABLE_MODES:
+            pil_image.load()
+        #some plugins change the mode while loading.
+        if pil_image.mode not in SHAREABLE_MODES:
+            return None
+        infos = {
+            "filename":HBCommon.get_file_basename(source),
+            "filepath":source,
+            "format":(pil_image.format or "png").lower()
+        }
+        shared_buffer = HBSharedBuffer.create(pil_image, infos)
+
+    shared_buffer.disown()
+    shared_buffer.release()
+    return shared_buffer.name
+
+
+
+
+class HBProcessDecoder:
+
+    def __init__(self, workers:int=None):
+        """
+        Args:
+            workers (int, optional): number of worker processes. Defaults to the number of CPU cores.
+        """
+        self.workers:int = workers or os.cpu_count() or 1
+        self._executor:ProcessPoolExecutor = None
+        self._lock = threading.Lock()
+
+
+    def decode(self, source:str, data:bytes=None):
+        """Decode an image in a worker process, block until it is finished.
+
+        Args:
+            source (str): image file path or url.
+            data (bytes, optional): the encoded bytes of source. If None, the worker reads the file itself,
+            so only the file path is sent to the worker.
+
+        Returns:
+            HBImage
+        """
+        name = self._get_executor().submit(_decode_to_shared_memory, source, data).result()
+        if name is None:
+            #the mode cannot be shared, decoded here as the "thread" backend does (never converted).
+            return HBImage.load_from_bytes(data or HBImage.read_source(source), source)
+        #the pixels stay in the segment, the image reads them in place.
+        return HBImage(HBSharedBuffer(name, take_ownership=True))
+
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                #"spawn" never forks the Qt threads of the GUI process.
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+
+
+
+_shared_process_decoder:HBProcessDecoder = None
+_shared_process_decoder_lock = threading.Lock()
+
+def shared_process_decoder() -> HBProcessDecoder:
+    """Return the HBProcessDecoder shared by all HBAlbums. The worker processes start at the first decode."""
+    global _shared_process_decoder
+    with _shared_process_decoder_lock:
+        if _shared_process_decoder is None:
+            _shared_process_decoder = HBProcessDecoder()
+        return _shared_process_decoder
@@ -0,0 +1,213 @@
+"""
+HBProgressiveDecoder decodes an image while its bytes arrive (e.g. downloaded by HBFetcher),
+so the image can be shown long before the download is finished (see preview()).\n
+PIL.ImageFile.Parser cannot do it for JPEG and PNG (their plugins read the file by themselves,
+the Parser keeps all the bytes and decodes them at the end), so:
+1. PNG: the IDAT chunks are passed to the PIL decoder as they arrive, the rows are decoded once,
+and the preview is the rows decoded so far.
+2. JPEG: the preview decodes the received bytes (closed by an EOI marker) at the DCT scale of preview_size (PIL draft),
+which is fast. A progressive JPEG shows the whole image at low quality after its first scans,
+a baseline JPEG shows its first rows.
+3. Other formats have no preview, their bytes are only collected (the format is known from the first bytes),
+and they are opened when all the bytes have arrived (see close()).
+"""
+
+import io
+import struct
+
+from PIL import Image
+
+
+
+#JPEG start and end of image markers.
+_JPEG_SOI = b"\xff\xd8\xff"
+_JPEG_EOI = b"\xff\xd9"
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_IDAT = b"IDAT"
+
+
+
+class HBProgressiveDecoder:
+
+    def __init__(self, preview_size:tuple=None):
+        """
+        Args:
+            preview_size (tuple(int,int), optional): size the preview is shown at, a JPEG preview is decoded
+            not smaller than it (then scaled to the image size). Defaults to None (1/8 of the image size).
+        """
+        self._preview_size:tuple = tuple(preview_size) if preview_size else None
+        self.reset()
+
+
+    @property
+    def received(self) -> int:
+        """Number of bytes received."""
+        return len(self._data)
+
+    @property
+    def size(self) -> tuple:
+        """Size of the image, None until the header has arrived (until close() for the formats without preview)."""
+        return self._image.size if self._image is not None else None
+
+    @property
+    def format(self) -> str:
+        return self._image.format if self._image is not None else None
+
+    @property
+    def has_preview(self) -> bool:
+        """True if the header has arrived and the format has a preview."""
+        return self._image is not None and (
+            self._decoder is not None or self._is_decoded or self._image.format == "JPEG"
+        )
+
+    @property
+    def has_new_preview(self) -> bool:
+        """True if bytes arrived after the last preview()."""
+        return self.has_preview and len(self._data) > self._preview_received
+
+
+    def feed(self, data:bytes):
+        """Add the next bytes of the file. None starts the file over (see HBFetcher.fetch(on_data))."""
+        if data is None:
+            self.reset()
+            return None
+        self._data += data
+        if self._format is None and len(self._data) >= len(_PNG_SIGNATURE):
+            self._format = self._format_of(self._data)
+        #the header is parsed again only when the received bytes have doubled, so a big header costs linear time.
+        if self._image is None and self._format and len(self._data) >= self._next_open_size:
+            self._next_open_size = 2*len(self._data)
+            self._open()
+        if self._decoder is not None:
+            self._decode_rows()
+
+
+    def reset(self):
+        """Drop the received bytes, the file starts over."""
+        self._data:bytearray = bytearray()
+        #"PNG" or "JPEG" from the first bytes, "" for the formats without preview, None until they have arrived.
+        self._format:str = None
+        #bytes to receive before the header is parsed again.
+        self._next_open_size:int = 0
+        #the file opened from its header, None until the header has arrived.
+        self._image:Image.Image = None
+        #the PIL decoder that decodes the rows as they arrive (PNG), None if the format cannot.
+        self._decoder = None
+        #next byte of self._data to pass to the decoder, and bytes left in the current IDAT chunk.
+        self._position:int = 0
+        self._chunk_left:int = 0
+        #bytes passed to the decoder and not consumed by it yet.
+        self._pending:bytes = b""
+        self._is_decoded:bool = False
+        #len(self._data) when the last preview was made.
+        self._preview_received:int = 0
+
+
+    def preview(self) -> Image.Image:
+        """Return the pixels decoded from the bytes received so far, in the size of the image
+        (the rows that have not arrived are blank), None if the format has no preview or the header has not arrived.
+        """
+        if not self.has_preview:
+            return None
+        self._preview_received = len(self._data)
+        if self._decoder is not None or self._is_decoded:
+            return self._decoded_image().copy()
+
+        with Image.open(io.BytesIO(bytes(self._data) + _JPEG_EOI)) as pil_image:
+            size = pil_image.size
+            preview_size = self._preview_size or (size[0]//8, size[1]//8)
+            pil_image.draft(pil_image.mode, preview_size)
+            try:
+                pil_image.load()
+            except OSError:
+                #not enough of the image yet.
+                return None
+            if pil_image.size != size:
+                pil_image = pil_image.resize(size, Image.Resampling.BILINEAR)
+        return pil_image
+
+
+    def close(self) -> Image.Image:
+        """Return the image of all the received bytes.
+        It is decoded already if the rows were decoded while they arrived, else PIL decodes it when it is used.
+
+        Raises:
+            OSError: the bytes are not a complete image file.
+        """
+        if self._is_decoded:
+            pil_image = self._decoded_image()
+            #like an image opened from a file.
+            pil_image.format = self._image.format
+            return pil_image
+        return Image.open(io.BytesIO(bytes(self._data)))
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _open(self):
+        try:
+            pil_image = Image.open(io.BytesIO(bytes(self._data)), formats=[self._format])
+        except Exception:
+            #the header has not arrived yet.
+            return None
+        self._image = pil_image
+
+        tiles = pil_image.tile
+        if pil_image.format != "PNG" or len(tiles) != 1 or tiles[0][0] != "zip":
+            return None
+        #the rows are decoded into the image as the IDAT chunks arrive.
+        decoder_name, extents, offset, args = tiles[0]
+        pil_image.load_prepare()
+        pil_image.tile = []
+        self._decoder = Image._getdecoder(pil_image.mode, decoder_name, args, pil_image.decoderconfig)
+        self._decoder.setimage(pil_image.im, extents)
+        #offset is the first byte of the first IDAT chunk data, its length is in the chunk header before it.
+        self._position = offset
+        self._chunk_left = struct.unpack(">I", self._data[offset-8:offset-4])[0]
+
+
+    @staticmethod
+    def _format_of(data:bytes) -> str:
+        if data.startswith(_PNG_SIGNATURE):
+            return "PNG"
+        if data.startswith(_JPEG_SOI):
+            return "JPEG"
+        return ""
+
+
+    def _decode_rows(self):
+        data = self._data
+        while True:
+            if self._chunk_left == 0:
+                #CRC of the chunk, then the header of the next chunk.
+                if self._position + 12 > len(data):
+                    break
+                length, chunk_type = struct.unpack(">I4s", data[self._position+4:self._position+12])
+                if chunk_type != _PNG_IDAT:
+                    #all the image data has arrived, but the decoder did not finish.
+                    self._decoder = None
+                    break
+                self._position += 12
+                self._chunk_left = length
+                continue
+
+            chunk_end = min(self._position + self._chunk_left, len(data))
+            if chunk_end == self._position:
+                break
+            self._pending += bytes(data[self._position:chunk_end])
+            self._chunk_left -= chunk_end - self._position
+            self._position = chunk_end
+
+            consumed, error = self._decoder.decode(self._pending)
+            if consumed < 0:
+                #the last row is decoded (error < 0 if the data is broken, close() decodes it again to raise it).
+                self._is_decoded = error >= 0
+                self._decoder = None
+                self._pending = b""
+                break
+            self._pending = self._pending[consumed:]
+
+
+    def _decoded_image(self) -> Image.Image:
+        return self._image._new(self._image.im)
@@ -0,0 +1,162 @@
+"""
+HBPyramid is a mip pyramid of an image: level 0 is the image, each next level is the previous one halved.\n
+The levels are built lazily (by PIL.Image.reduce, a 2x2 box average) the first time a smaller size is asked,
+and kept, so zooming out only resamples a level at most twice as big as the displayed size,
+the cost depends on the displayed size instead of the image size.
+All the levels together use at most 1/3 more memory than the image.\n
+A level can also be decoded directly at its scale (e.g. JPEG DCT scaling, see seed()),
+then the image (level 0) is only decoded when a bigger level is asked.
+"""
+
+import weakref
+import threading
+
+from typing import List
+
+from PIL import Image
+
+
+
+#modes that PIL.Image.reduce() supports, an image of other modes only has level 0.
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "I", "F")
+
+
+
+class HBPyramid:
+
+    def __init__(self, pil_image:Image.Image, generation:int=0, decode=None):
+        """
+        Args:
+            pil_image (PIL.Image.Image): level 0, it is not copied and must not be modified.
+            generation (int, optional): generation of the HBImage that has pil_image.
+            decode (method, optional): decode() decodes the pixels of level 0 (thread safe),
+            called before level 0 is used, so it is never decoded by two threads at once.
+            The pyramid keeps a weak reference to it, so it does not keep the image of the method alive.
+        """
+        #None for the levels that are not built yet, between level 0 and a seeded level.
+        self._levels:List[Image.Image] = [pil_image]
+        self._generation:int = generation
+        #weak reference to the method that decodes level 0, if it is not decoded yet.
+        self._decode:weakref.WeakMethod = weakref.WeakMethod(decode) if decode else None
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        """Number of levels built."""
+        return sum(1 for level_image in self._levels if level_image is not None)
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def size(self) -> tuple:
+        return self._levels[0].size
+
+
+    def level(self, index:int) -> Image.Image:
+        """Return level index (built if needed), or the last level if the image cannot be halved that many times."""
+        with self._lock:
+            while len(self._levels) <= index:
+                halved = self._halve(self._build(len(self._levels)-1))
+                if halved is None:
+                    break
+                self._levels.append(halved)
+            return self._build(min(index, len(self._levels)-1))
+
+
+    def level_for(self, size:tuple) -> Image.Image:
+        """Return the smallest level that is not smaller than size, level 0 if size is bigger than the image."""
+        return self.level(self.level_index_for(size))
+
+
+    def level_index_for(self, size:tuple) -> int:
+        """Return the index of level_for(size), without building it."""
+        width, height = self.size
+        index = 0
+        while width > 1 and height > 1:
+            #size of the next level.
+            width, height = (width+1)//2, (height+1)//2
+            if width < size[0] or height < size[1]:
+                break
+            index += 1
+        return index
+
+
+    def level_size(self, index:int) -> tuple:
+        """Return the size of level index (PIL.Image.reduce(2) rounds up)."""
+        width, height = self.size
+        for _ in range(index):
+            width, height = (width+1)//2, (height+1)//2
+        return (width, height)
+
+
+    def seed(self, index:int, pil_image:Image.Image, decode=None):
+        """Set level index, decoded at its scale, before level 0 is decoded.
+        The levels between them are built from level 0 when they are asked.
+
+        Args:
+            index (int)
+            pil_image (PIL.Image.Image): its size must be level_size(index).
+            decode (method, optional): decode() decodes the pixels of level 0 (thread safe),
+            called before level 0 is used, see __init__().
+        """
+        if pil_image.size != self.level_size(index):
+            raise ValueError(f"level {index} size should be {self.level_size(index)}, not {pil_image.size}.")
+        with self._lock:
+            if len(self._levels) > 1:
+                return None
+            self._levels.extend([None] * index)
+            self._levels[index] = pil_image
+            if decode:
+                self._decode = weakref.WeakMethod(decode)
+
+
+    def resize(self, size:tuple, resample=Image.BICUBIC) -> Image.Image:
+        """Return the image resized to size, resampled from level_for(size)."""
+        size = tuple(int(v) for v in size)
+        return self.render(size, (0, 0, *size), resample)
+
+
+    def render(self, display_size:tuple, box:tuple, resample=Image.BICUBIC) -> Image.Image:
+        """Return the region box of the image resized to display_size, without resizing the rest of the image.\n
+        The region is resampled from level_for(display_size), the regions of adjacent boxes fit without seams.
+
+        Args:
+            display_size (tuple(int,int)): size of the whole resized image.
+            box (tuple(int,int,int,int)): the region (x0, y0, x1, y1), in the resized image.
+        """
+        level_image = self.level_for(display_size)
+        x_scale = level_image.width / display_size[0]
+        y_scale = level_image.height / display_size[1]
+        x0, y0, x1, y1 = box
+        if x_scale == 1 and y_scale == 1:
+            return level_image.crop(box)
+        source_box = (x0*x_scale, y0*y_scale, x1*x_scale, y1*y_scale)
+        return level_image.resize((x1-x0, y1-y0), resample, box=source_box)
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _build(self, index:int) -> Image.Image:
+        """Return level index, built from the previous levels if it is not built. Called with the lock."""
+        if index == 0 and self._decode is not None:
+            decode = self._decode()
+            if decode is not None:
+                decode()
+            else:
+                #the image is gone, nobody else decodes level 0.
+                self._levels[0].load()
+            self._decode = None
+        level_image = self._levels[index]
+        if level_image is None:
+            level_image = self._levels[index] = self._halve(self._build(index-1))
+        return level_image
+
+
+    def _halve(self, pil_image:Image.Image) -> Image.Image:
+        width, height = pil_image.size
+        if pil_image.mode not in REDUCE_MODES or width <= 1 or height <= 1:
+            return None
+        return pil_image.reduce(2)
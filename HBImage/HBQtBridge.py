@@ -0,0 +1,91 @@
+"""
+HBQtBridge converts between PIL.Image and QImage through their raw pixel buffers.\n
+PIL.ImageQt converts a QImage to PIL.Image by encoding it as PNG and decoding it again,
+and converts a PIL.Image to QImage through an extra copy and mode conversion.
+Here the pixel rows are read in the layout of the other side:
+1. QImage -> PIL.Image: if the QImage layout is a PIL layout ("RGBA", "L"), the PIL.Image reads the QImage memory in place
+(it is read-only, HBImage copies it before the first modification).
+The other common formats are unpacked once, the rest is converted once by Qt to RGBA8888, then read in place.
+2. PIL.Image -> QImage: the pixels are packed once (tobytes) in a QImage format, and QImage reads that buffer.
+"RGB", "RGBA" and "L" are packed without mode conversion, the other modes are converted to one of them first.
+
+Require package:
+1. Pyside
+2. PIL
+"""
+
+import sys
+import ctypes
+
+from PIL import Image
+from PySide6.QtGui import QImage
+
+
+
+#PIL mode: (rawmode, QImage format, bytes per pixel)
+_PIL_TO_QT = {
+    "RGB": ("RGBX", QImage.Format_RGBX8888, 4),
+    "RGBA": ("RGBA", QImage.Format_RGBA8888, 4),
+    "L": ("L", QImage.Format_Grayscale8, 1),
+}
+
+#QImage format: (PIL mode, rawmode), the formats whose PIL mode is the rawmode are read in place.
+_QT_TO_PIL = {
+    QImage.Format_RGBA8888: ("RGBA", "RGBA"),
+    QImage.Format_Grayscale8: ("L", "L"),
+    QImage.Format_RGBX8888: ("RGB", "RGBX"),
+    QImage.Format_RGB888: ("RGB", "RGB"),
+}
+if sys.byteorder == "little":
+    #32 bit pixels 0xAARRGGBB, stored as B, G, R, A.
+    _QT_TO_PIL[QImage.Format_ARGB32] = ("RGBA", "BGRA")
+    _QT_TO_PIL[QImage.Format_RGB32] = ("RGB", "BGRX")
+
+
+
+class HBQImage(QImage):
+    """QImage that reads the pixels of a buffer packed from a PIL.Image, and keeps the buffer alive."""
+
+    def __init__(self, buffer:bytes, size:tuple, bytes_per_line:int, format:QImage.Format):
+        super().__init__(buffer, size[0], size[1], bytes_per_line, format)
+        self._buffer:bytes = buffer
+
+
+
+def pil_to_qimage(pil_image:Image.Image) -> QImage:
+    """Return a QImage of pil_image, the pixels are packed once."""
+    if pil_image.mode not in _PIL_TO_QT:
+        has_alpha = "A" in pil_image.getbands() or "transparency" in pil_image.info
+        pil_image = pil_image.convert("RGBA" if has_alpha else "RGB")
+
+    rawmode, qt_format, pixel_size = _PIL_TO_QT[pil_image.mode]
+    width, height = pil_image.size
+    buffer = pil_image.tobytes("raw", rawmode)
+    return HBQImage(buffer, (width, height), width*pixel_size, qt_format)
+
+
+def qimage_to_pil(qimage:QImage) -> Image.Image:
+    """Return a PIL.Image of qimage.\n
+    If the layout of qimage is a PIL layout, the PIL.Image reads the memory of qimage in place, and is read-only.
+    """
+    if qimage.format() not in _QT_TO_PIL:
+        qimage = qimage.convertToFormat(QImage.Format_RGBA8888)
+
+    mode, rawmode = _QT_TO_PIL[qimage.format()]
+    size = (qimage.width(), qimage.height())
+    if mode != rawmode:
+        #unpacked (copied) by PIL, qimage is not needed after.
+        return Image.frombytes(mode, size, qimage.constBits(), "raw", rawmode, qimage.bytesPerLine(), 1)
+    return Image.frombuffer(mode, size, _qimage_buffer(qimage), "raw", rawmode, qimage.bytesPerLine(), 1)
+
+
+
+
+def _qimage_buffer(qimage:QImage) -> ctypes.Array:
+    """Return the pixel buffer of qimage, which keeps qimage alive as long as PIL reads it."""
+    #bits() (not constBits()) so the buffer is the memory of this QImage only,
+    #Qt copies it first if it is shared with other QImages.
+    bits = qimage.bits()
+    buffer = (ctypes.c_char * bits.nbytes).from_buffer(bits)
+    buffer.qimage = qimage
+    return buffer
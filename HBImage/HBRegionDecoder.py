@@ -0,0 +1,430 @@
+"""
+HBRegionDecoder decodes a region (box) of an image file without decoding the rest of the file when its layout allows it
+(crop-on-load), e.g. to crop the same small region out of thousands of big scans (see crop_files()).\n
+The region is decoded by the first of these that the file allows:
+1. Uncompressed BMP, PPM/PGM and TIFF: the rows of the region are read from the mapped file (see HBMappedFile).
+2. TIFF stored in strips or tiles (any compression libtiff decodes): only the strips/tiles that intersect
+the region are read, and decoded by libtiff as a small TIFF of their own.
+3. Non-interlaced PNG: the rows are decoded down to the last row of the region, the rows below are never decoded.
+4. Anything else: the whole file is decoded, then cropped.\n
+A non-interlaced PNG can also be decoded band by band from the top (see decode_bands()),
+only one band is in memory at a time.\n
+With reduce > 1 the region is returned 1/reduce of its size, JPEG is decoded at the DCT scale (PIL draft)
+and JPEG 2000 at the resolution level (PIL reduce) that is closest to it, so a big JPEG is never decoded at full size.
+"""
+
+import io
+import zlib
+import struct
+
+from typing import Callable, Iterator, List
+
+from PIL import Image
+from PIL.TiffImagePlugin import ImageFileDirectory_v2
+
+from . import HBCommon
+from .HBMappedFile import HBMappedFile, open_unchecked
+from .HBLoadPipeline import HBLoadPipeline
+
+
+
+#TIFF tags
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_SAMPLES_PER_PIXEL = 277
+_ROWS_PER_STRIP = 278
+_PLANAR_CONFIGURATION = 284
+_STRIP_OFFSETS = 273
+_STRIP_BYTE_COUNTS = 279
+_TILE_WIDTH = 322
+_TILE_LENGTH = 323
+_TILE_OFFSETS = 324
+_TILE_BYTE_COUNTS = 325
+_LONG = 4
+
+#PNG raw modes that PIL can pack again (see HBRegionDecoder.decode_bands()).
+_BAND_RAWMODES = ("1", "L", "I;16B", "RGB", "P;1", "P;2", "P;4", "P", "LA", "RGBA")
+#PNG color type : samples per pixel.
+_PNG_SAMPLES = {0:1, 2:3, 3:1, 4:2, 6:4}
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+#the tags that libtiff needs to decode the strips/tiles, copied to the TIFF of the region.
+_DECODE_TAGS = (
+    258, 259, 262, 266, 277, 278, 284, 317, 320, 322, 323, 338, 339, 347, 529, 530, 531, 532
+)
+
+
+
+def intersect_box(box0:tuple, box1:tuple) -> tuple:
+    """Return the intersection of two boxes (x0, y0, x1, y1), None if they do not overlap."""
+    x0, y0 = max(box0[0], box1[0]), max(box0[1], box1[1])
+    x1, y1 = min(box0[2], box1[2]), min(box0[3], box1[3])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (x0, y0, x1, y1)
+
+
+
+
+class HBRegionDecoder:
+
+    def __init__(self, pipeline:HBLoadPipeline=None):
+        """
+        Args:
+            pipeline (HBLoadPipeline, optional): the threads that decode the files of crop_files().
+            Defaults to a new HBLoadPipeline(), the I/O stage has nothing to do, the decode stage reads the regions.
+        """
+        self._pipeline:HBLoadPipeline = pipeline if pipeline is not None else HBLoadPipeline(io_workers=1)
+
+    @property
+    def pipeline(self) -> HBLoadPipeline:
+        return self._pipeline
+
+
+    def crop_files(self, paths:List[str], box:tuple, reduce:int=1, callback:Callable=None) -> list:
+        """Decode the same region of many files in parallel, block until finished or cancel().
+
+        Args:
+            paths (List[str]): image files' path.
+            box (tuple(int,int,int,int)): the region, limited to the size of each file.
+            reduce (int, optional): see decode(). Defaults to 1.
+            callback (function, optional): callback(index, result) is called in a decode thread
+            as soon as paths[index] is finished, e.g. to save the region and drop it.
+
+        Returns:
+            list: PIL.Images in the order of paths, see HBLoadPipeline.run().
+        """
+        def decode(path:str, _):
+            return HBRegionDecoder.decode(path, box, reduce)
+
+        self._pipeline.reset()
+        #nothing is fetched, only the region is read, by the decode stage.
+        return self._pipeline.run(paths, lambda path: None, decode, callback)
+
+
+    def cancel(self):
+        """Stop the running crop_files(), the files not started yet are not decoded."""
+        self._pipeline.cancel()
+
+
+
+    #-----------------staticmethod-------------------------------
+
+    @staticmethod
+    def decode(path:str, box:tuple, reduce:int=1) -> Image.Image:
+        """Return the pixels of box in the file, decoding as little of the file as its layout allows.
+
+        Args:
+            path (str): image file path.
+            box (tuple(int,int,int,int)): the region, limited to the size of the image.
+            reduce (int, optional): the region is returned 1/reduce of its size (as PIL.Image.reduce()). Defaults to 1.
+        """
+        mapped_file = HBMappedFile.open(path)
+        if mapped_file is not None:
+            try:
+                box = HBRegionDecoder._limit_box(box, mapped_file.size)
+                pil_image = mapped_file.region(box)
+                if reduce > 1:
+                    pil_image = pil_image.reduce(reduce)
+                elif mapped_file.is_mappable:
+                    #not read from the file any more, so it can be closed.
+                    pil_image = pil_image.copy()
+            finally:
+                mapped_file.close()
+            return pil_image
+
+        with open_unchecked(path) as pil_image:
+            box = HBRegionDecoder._limit_box(box, pil_image.size)
+            if reduce > 1 and pil_image.format in ("JPEG", "JPEG2000"):
+                return HBRegionDecoder._decode_scaled(pil_image, box, reduce)
+
+            if len(pil_image.tile) > 1:
+                #a TIFF that PIL decodes strip by strip (or tile by tile) by itself.
+                tiles = [tile for tile in pil_image.tile if intersect_box(tile[1], box)]
+                x0 = min(tile[1][0] for tile in tiles)
+                y0 = min(tile[1][1] for tile in tiles)
+                x1 = max(tile[1][2] for tile in tiles)
+                y1 = max(tile[1][3] for tile in tiles)
+                moved_tiles = []
+                for tile in tiles:
+                    ex0, ey0, ex1, ey1 = tile[1]
+                    moved_tiles.append(tile._replace(extents=(ex0-x0, ey0-y0, ex1-x0, ey1-y0)))
+                #decode the tiles into an image of the size of their bounding box.
+                HBRegionDecoder._set_tiles(pil_image, (x1-x0, y1-y0), moved_tiles)
+                box = (box[0]-x0, box[1]-y0, box[2]-x0, box[3]-y0)
+            elif HBRegionDecoder.block_layout(pil_image) is not None:
+                pil_image, box = HBRegionDecoder._blocks_tiff(pil_image, box)
+            elif HBRegionDecoder.is_row_bounded(pil_image):
+                #the decoder stops after the last row of box.
+                width = pil_image.width
+                HBRegionDecoder._set_tiles(
+                    pil_image, (width, box[3]), [pil_image.tile[0]._replace(extents=(0, 0, width, box[3]))]
+                )
+            else:
+                Image._decompression_bomb_check(pil_image.size)
+
+            pil_image.load()
+            pil_image = pil_image.crop(box)
+        return pil_image.reduce(reduce) if reduce > 1 else pil_image
+
+
+    @staticmethod
+    def is_region_decodable(path:str) -> bool:
+        """True if decode() does not decode the whole file."""
+        if not path or HBCommon.is_url(path):
+            return False
+        try:
+            pil_image = open_unchecked(path)
+        except OSError:
+            return False
+        with pil_image:
+            return (
+                len(pil_image.tile) > 1
+                or HBMappedFile.raw_layout(pil_image) is not None
+                or HBRegionDecoder.block_layout(pil_image) is not None
+                or HBRegionDecoder.is_row_bounded(pil_image)
+            )
+
+
+    @staticmethod
+    def block_layout(pil_image:Image.Image) -> tuple:
+        """Return (is_strips, block_size, offsets, byte_counts) of the strips (or tiles) of an opened (not loaded) TIFF
+        that PIL decodes with libtiff as one image, None if the file is not a TIFF or it has only one strip.
+        """
+        tiles = pil_image.tile
+        if pil_image.format != "TIFF" or len(tiles) != 1 or tiles[0][0] != "libtiff":
+            return None
+        tags = pil_image.tag_v2
+        width, height = pil_image.size
+        is_strips = _STRIP_OFFSETS in tags
+        if is_strips:
+            block_size = (width, tags.get(_ROWS_PER_STRIP, height))
+            offsets, byte_counts = tags.get(_STRIP_OFFSETS), tags.get(_STRIP_BYTE_COUNTS)
+        else:
+            block_size = (tags.get(_TILE_WIDTH), tags.get(_TILE_LENGTH))
+            offsets, byte_counts = tags.get(_TILE_OFFSETS), tags.get(_TILE_BYTE_COUNTS)
+        if not isinstance(offsets, tuple) or not isinstance(byte_counts, tuple):
+            return None
+        block_width, block_height = block_size
+        if not isinstance(block_width, int) or not isinstance(block_height, int) or block_width <= 0 or block_height <= 0:
+            return None
+
+        planes = tags.get(_SAMPLES_PER_PIXEL, 1) if tags.get(_PLANAR_CONFIGURATION, 1) == 2 else 1
+        block_count = -(-width//block_width) * -(-height//block_height) * planes
+        if len(offsets) < 2 or len(offsets) != block_count or len(byte_counts) != block_count:
+            return None
+        return (is_strips, (block_width, min(block_height, height) if is_strips else block_height), offsets, byte_counts)
+
+
+    @staticmethod
+    def is_row_bounded(pil_image:Image.Image) -> bool:
+        """True if the rows of an opened (not loaded) file are decoded from the top, one after another,
+        so the decoding can stop after the last needed row (non-interlaced PNG)."""
+        tiles = pil_image.tile
+        return (
+            pil_image.format == "PNG" and len(tiles) == 1 and tiles[0][0] == "zip"
+            and not pil_image.info.get("interlace")
+        )
+
+
+
+    @staticmethod
+    def is_band_decodable(pil_image:Image.Image) -> bool:
+        """True if decode_bands() can decode an opened (not loaded) file."""
+        return HBRegionDecoder.is_row_bounded(pil_image) and pil_image.tile[0][3] in _BAND_RAWMODES
+
+
+    @staticmethod
+    def decode_bands(path:str, band_height:int) -> Iterator[tuple]:
+        """Decode a non-interlaced PNG (see is_band_decodable()) band by band from the top.\n
+        The rows of each band are inflated from the file and decoded as a PNG of their own,
+        after the last row of the previous band that their filters refer to.
+
+        Args:
+            path (str): PNG file path.
+            band_height (int): rows of a band, the last band has the remaining rows.
+
+        Yields:
+            tuple: (y, PIL.Image) of each band, y is its first row.
+        """
+        with open(path, "rb") as file:
+            if file.read(8) != _PNG_SIGNATURE:
+                raise ValueError(f"{path} is not a PNG file")
+            chunk_type, ihdr = HBRegionDecoder._read_png_chunk(file)
+            width, height, bit_depth, color_type = struct.unpack(">IIBB", ihdr[:10])
+            row_size = 1 + (width*bit_depth*_PNG_SAMPLES[color_type] + 7)//8
+            #the chunks between IHDR and the first IDAT (PLTE, tRNS, ...) are copied to every band.
+            header_chunks = []
+            chunk_type, data = HBRegionDecoder._read_png_chunk(file)
+            while chunk_type != b"IDAT":
+                header_chunks.append(HBRegionDecoder._png_chunk(chunk_type, data))
+                chunk_type, data = HBRegionDecoder._read_png_chunk(file)
+
+            inflater = zlib.decompressobj()
+            #the compressed bytes not inflated yet.
+            pending = b""
+            rows = bytearray()
+            previous_row:bytes = None
+            for y in range(0, height, band_height):
+                band_size = min(band_height, height-y) * row_size
+                while len(rows) < band_size:
+                    if not pending and chunk_type != b"IDAT":
+                        #the rows that zlib still holds.
+                        remaining = inflater.flush()
+                        if not remaining:
+                            raise ValueError(f"{path} is truncated")
+                        rows += remaining
+                        continue
+                    if not pending:
+                        pending = data
+                        chunk_type, data = HBRegionDecoder._read_png_chunk(file)
+                    #inflate no more than the band, a small chunk may inflate to a huge number of rows.
+                    rows += inflater.decompress(pending, band_size-len(rows))
+                    pending = inflater.unconsumed_tail
+                band_rows, rows = rows[:band_size], rows[band_size:]
+
+                if previous_row is not None:
+                    #filter type 0, the row is stored as it is.
+                    band_rows[:0] = b"\0" + previous_row
+                band_png = b"".join((
+                    _PNG_SIGNATURE,
+                    HBRegionDecoder._png_chunk(b"IHDR", struct.pack(">II", width, len(band_rows)//row_size) + ihdr[8:]),
+                    *header_chunks,
+                    HBRegionDecoder._png_chunk(b"IDAT", zlib.compress(band_rows, 1)),
+                    HBRegionDecoder._png_chunk(b"IEND", b""),
+                ))
+                with Image.open(io.BytesIO(band_png)) as pil_image:
+                    rawmode = pil_image.tile[0][3]
+                    pil_image.load()
+                    band = pil_image if previous_row is None else pil_image.crop((0, 1, width, pil_image.height))
+                previous_row = band.crop((0, band.height-1, width, band.height)).tobytes("raw", rawmode)
+                yield y, band
+
+
+
+    #--------------private fuctions------------------------------
+
+    @staticmethod
+    def _read_png_chunk(file) -> tuple:
+        """Return (type, data) of the next chunk of a PNG file, (b"", b"") at the end of the file."""
+        header = file.read(8)
+        if len(header) < 8:
+            return (b"", b"")
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = file.read(length)
+        file.read(4)
+        return (chunk_type, data)
+
+
+    @staticmethod
+    def _png_chunk(chunk_type:bytes, data:bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+    @staticmethod
+    def _blocks_tiff(pil_image:Image.Image, box:tuple) -> tuple:
+        """Read the strips (or tiles) of a TIFF that intersect box, and open them as a TIFF of their own,
+        which libtiff decodes as fast as the original file (the compressed bytes are copied, not decoded).
+
+        Returns:
+            tuple: (opened PIL.Image, box moved to it).
+        """
+        is_strips, (block_width, block_height), offsets, byte_counts = HBRegionDecoder.block_layout(pil_image)
+        tags = pil_image.tag_v2
+        width, height = pil_image.size
+        columns, rows = -(-width//block_width), -(-height//block_height)
+        x0, y0, x1, y1 = box
+        column0, row0 = x0//block_width, y0//block_height
+        column1, row1 = -(-x1//block_width), -(-y1//block_height)
+        planes = len(offsets) // (columns*rows)
+
+        blocks = []
+        for plane in range(planes):
+            for row in range(row0, row1):
+                for column in range(column0, column1):
+                    index = (plane*rows + row)*columns + column
+                    pil_image.fp.seek(offsets[index])
+                    blocks.append(pil_image.fp.read(byte_counts[index]))
+
+        ifd = ImageFileDirectory_v2(prefix=b"II")
+        for tag in _DECODE_TAGS:
+            if tag in tags:
+                ifd[tag] = tags[tag]
+                ifd.tagtype[tag] = tags.tagtype[tag]
+        if is_strips:
+            ifd[_IMAGE_WIDTH] = width
+            ifd[_IMAGE_LENGTH] = min(row1*block_height, height) - row0*block_height
+            offsets_tag, byte_counts_tag = _STRIP_OFFSETS, _STRIP_BYTE_COUNTS
+        else:
+            #the tiles on the right and bottom edges are full tiles in the file.
+            ifd[_IMAGE_WIDTH] = (column1-column0) * block_width
+            ifd[_IMAGE_LENGTH] = (row1-row0) * block_height
+            offsets_tag, byte_counts_tag = _TILE_OFFSETS, _TILE_BYTE_COUNTS
+        block_offsets = []
+        position = 0
+        for block in blocks:
+            block_offsets.append(position)
+            position += len(block)
+        ifd[offsets_tag] = tuple(block_offsets)
+        ifd[byte_counts_tag] = tuple(len(block) for block in blocks)
+        for tag in (_IMAGE_WIDTH, _IMAGE_LENGTH, offsets_tag, byte_counts_tag):
+            ifd.tagtype[tag] = _LONG
+
+        #the blocks follow the directory, PIL moves the strip offsets there by itself, not the tile offsets.
+        header_size = 8
+        if not is_strips:
+            directory_size = len(ifd.tobytes(header_size))
+            ifd[offsets_tag] = tuple(header_size + directory_size + offset for offset in block_offsets)
+        data = b"II*\0" + header_size.to_bytes(4, "little") + ifd.tobytes(header_size) + b"".join(blocks)
+
+        x_offset = 0 if is_strips else column0*block_width
+        y_offset = row0*block_height
+        return Image.open(io.BytesIO(data)), (x0-x_offset, y0-y_offset, x1-x_offset, y1-y_offset)
+
+
+    @staticmethod
+    def _decode_scaled(pil_image:Image.Image, box:tuple, reduce:int) -> Image.Image:
+        """Decode a JPEG or JPEG 2000 file at the smallest scale that is not smaller than 1/reduce,
+        then crop box (scaled) and resize it to 1/reduce of its size."""
+        width, height = pil_image.size
+        x0, y0, x1, y1 = box
+        size = (-(-(x1-x0)//reduce), -(-(y1-y0)//reduce))
+        if pil_image.format == "JPEG":
+            pil_image.draft(pil_image.mode, (-(-width//reduce), -(-height//reduce)))
+        else:
+            #JPEG 2000 resolution levels are 1/2**n.
+            pil_image.reduce = reduce.bit_length() - 1
+        Image._decompression_bomb_check(pil_image.size)
+        pil_image.load()
+
+        x_scale, y_scale = pil_image.width / width, pil_image.height / height
+        scaled_box = (
+            int(x0*x_scale), int(y0*y_scale),
+            max(int(x0*x_scale)+1, round(x1*x_scale)), max(int(y0*y_scale)+1, round(y1*y_scale))
+        )
+        pil_image = pil_image.crop(scaled_box)
+        if pil_image.size != size:
+            pil_image = pil_image.resize(size, Image.Resampling.BOX)
+        return pil_image
+
+
+    @staticmethod
+    def _set_tiles(pil_image:Image.Image, size:tuple, tiles:list):
+        """Let an opened (not loaded) file decode tiles only, into an image of size."""
+        pil_image._size = size
+        pil_image.tile = tiles
+        if pil_image.format == "TIFF":
+            #TIFF allocates the image by its own size, and decodes with libtiff unless it is told not to.
+            pil_image._tile_size = size
+            pil_image.use_load_libtiff = False
+
+
+    @staticmethod
+    def _limit_box(box:tuple, size:tuple) -> tuple:
+        width, height = size
+        x0, y0, x1, y1 = box
+        x0 = HBCommon.limit_number(int(x0), 0, width-1)
+        y0 = HBCommon.limit_number(int(y0), 0, height-1)
+        x1 = HBCommon.limit_number(int(x1), x0+1, width)
+        y1 = HBCommon.limit_number(int(y1), y0+1, height)
+        return (x0, y0, x1, y1)
@@ -0,0 +1,254 @@
+"""
+HBSharedBuffer keeps the pixels of an image in a multiprocessing.shared_memory segment,
+so another process can attach the same pixels by the segment name without copying them.\n
+Segment layout:
+- the first HEADER_SIZE bytes: a magic word, the header length and a json header (mode, size, image information).
+- then the pixels, in the same layout PIL stores them in memory, so PIL reads them in place.\n
+Every HBSharedBuffer object is one reference of its segment in this process.
+When the last reference is released, the segment is closed,
+and if this process created (or took the ownership of) the segment, it is also unlinked.
+"""
+
+import json
+import struct
+import threading
+
+from typing import Dict
+from multiprocessing import resource_tracker, shared_memory
+
+from PIL import Image
+
+
+
+MAGIC = b"HBSM"
+HEADER_SIZE = 4096
+_HEADER_PREFIX = struct.Struct("<4sI")
+
+#mode : raw mode that has the same layout as PIL's memory.
+SHAREABLE_MODES = {
+    "L":"L",
+    "I;16":"I;16",
+    "I":"I",
+    "F":"F",
+    "RGB":"RGBX",    #PIL stores "RGB" pixels in 4 bytes.
+    "RGBX":"RGBX",
+    "RGBA":"RGBA",
+    "CMYK":"CMYK",
+}
+
+#rows copied into the segment at a time, to keep the temporary memory small.
+_COPY_ROWS = 256
+
+
+
+class _HBSharedMemory(shared_memory.SharedMemory):
+
+    def __del__(self):
+        #A PIL.Image that still reads the segment keeps the memory mapped, closing it is not possible yet.
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+    def track(self):
+        """Let the resource tracker of this process unlink the segment if the process exits without unlinking it."""
+        if shared_memory._USE_POSIX:
+            resource_tracker.register(self._name, "shared_memory")
+
+    def untrack(self):
+        """Python tracks every attached segment (POSIX), so the first attaching process that exits
+        would unlink the segment for all the others: only the owner tracks it."""
+        if shared_memory._USE_POSIX:
+            resource_tracker.unregister(self._name, "shared_memory")
+
+
+
+
+class _HBSegment:
+    """A shared memory segment opened in this process, and how many HBSharedBuffers use it."""
+
+    def __init__(self, memory:_HBSharedMemory, is_owner:bool):
+        self.memory = memory
+        self.is_owner:bool = is_owner
+        #True if the resource tracker of this process would unlink the segment, see _HBSharedMemory.untrack().
+        self.is_tracked:bool = True
+        self.refcount:int = 0
+
+    def set_owner(self, is_owner:bool):
+        """The owner tracks the segment, the other processes do not."""
+        self.is_owner = is_owner
+        if is_owner and not self.is_tracked:
+            self.memory.track()
+        elif self.is_tracked and not is_owner:
+            self.memory.untrack()
+        self.is_tracked = is_owner
+
+
+
+
+class HBSharedBuffer:
+
+    _segments:Dict[str, _HBSegment] = {}
+    _segments_lock = threading.Lock()
+
+
+    def __init__(self, name:str, take_ownership:bool=False):
+        """Attach an existing segment by name. Use HBSharedBuffer.create() to create a new one.
+
+        Args:
+            name (str): segment name.
+            take_ownership (bool, optional): If True, this process unlinks the segment
+            when it releases its last reference. Defaults to False.
+        """
+        with HBSharedBuffer._segments_lock:
+            segment = HBSharedBuffer._segments.get(name)
+            if segment is None:
+                #attaching registers the segment to the resource tracker.
+                segment = _HBSegment(_HBSharedMemory(name=name), take_ownership)
+                HBSharedBuffer._segments[name] = segment
+            segment.set_owner(segment.is_owner or take_ownership)
+            segment.refcount += 1
+
+        self._name:str = name
+        self._segment:_HBSegment = segment
+        self._is_released:bool = False
+
+        header = self._read_header()
+        self._mode:str = header["mode"]
+        self._size:tuple = tuple(header["size"])
+        self._information:dict = header.get("information", {})
+        self._pixels = segment.memory.buf[HEADER_SIZE:HEADER_SIZE+self.nbytes]
+        self._image:Image.Image = self._map_image()
+
+
+    def __del__(self):
+        self.release()
+
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def image(self) -> Image.Image:
+        """A read-only PIL.Image that reads the pixels in the segment.
+        PIL copies it to private memory before any modification.
+        """
+        return self._image
+
+    @property
+    def information(self) -> dict:
+        return dict(self._information)
+
+    @property
+    def nbytes(self) -> int:
+        width, height = self._size
+        return width * height * self._pixel_size(self._mode)
+
+    @property
+    def is_released(self) -> bool:
+        return self._is_released
+
+
+    @staticmethod
+    def create(pil_image:Image.Image, information:dict=None) -> 'HBSharedBuffer':
+        """Create a new segment, copy pil_image into it and return a reference to it.\n
+        The calling process owns the segment.
+
+        Raises:
+            ValueError: the mode of pil_image cannot be shared.
+        """
+        if pil_image.mode not in SHAREABLE_MODES:
+            raise ValueError(f"Mode {pil_image.mode} cannot be shared. Shareable modes: {list(SHAREABLE_MODES)}")
+
+        width, height = pil_image.size
+        pixel_size = HBSharedBuffer._pixel_size(pil_image.mode)
+        header = json.dumps({
+            "mode":pil_image.mode,
+            "size":[width, height],
+            "information":information or {}
+        }, default=str).encode()
+        if _HEADER_PREFIX.size + len(header) > HEADER_SIZE:
+            raise ValueError("Image information is too long to be shared.")
+
+        memory = _HBSharedMemory(create=True, size=HEADER_SIZE + max(width*height*pixel_size, 1))
+        memory.buf[:_HEADER_PREFIX.size] = _HEADER_PREFIX.pack(MAGIC, len(header))
+        memory.buf[_HEADER_PREFIX.size:_HEADER_PREFIX.size+len(header)] = header
+
+        rawmode = SHAREABLE_MODES[pil_image.mode]
+        row_size = width * pixel_size
+        for y in range(0, height, _COPY_ROWS):
+            rows = pil_image.crop((0, y, width, min(y+_COPY_ROWS, height))).tobytes("raw", rawmode)
+            offset = HEADER_SIZE + y*row_size
+            memory.buf[offset:offset+len(rows)] = rows
+
+        with HBSharedBuffer._segments_lock:
+            HBSharedBuffer._segments[memory.name] = _HBSegment(memory, is_owner=True)
+        return HBSharedBuffer(memory.name)
+
+
+    def release(self):
+        """Release this reference. The segment is closed when all references in this process are released."""
+        if getattr(self, "_is_released", True):
+            return None
+        self._is_released = True
+        self._image = None
+        try:
+            self._pixels.release()
+        except BufferError:
+            pass
+
+        with HBSharedBuffer._segments_lock:
+            self._segment.refcount -= 1
+            if self._segment.refcount > 0:
+                return None
+            del HBSharedBuffer._segments[self._name]
+
+        memory = self._segment.memory
+        if self._segment.is_owner:
+            try:
+                memory.unlink()
+            except FileNotFoundError:
+                #unlinked by another process already.
+                memory.untrack()
+        try:
+            memory.close()
+        except BufferError:
+            #a PIL.Image still reads the segment, the memory is freed when it is garbage collected.
+            pass
+
+
+    def disown(self):
+        """Give up the ownership, so releasing it does not unlink the segment.
+        Used to hand a segment over to another process, which attaches it with take_ownership=True.
+        """
+        with HBSharedBuffer._segments_lock:
+            self._segment.set_owner(False)
+
+
+
+    #--------------private fuctions------------------------------
+
+    @staticmethod
+    def _pixel_size(mode:str) -> int:
+        if mode == "L":
+            return 1
+        if mode == "I;16":
+            return 2
+        return 4
+
+
+    def _read_header(self) -> dict:
+        buf = self._segment.memory.buf
+        magic, header_length = _HEADER_PREFIX.unpack(bytes(buf[:_HEADER_PREFIX.size]))
+        if magic != MAGIC:
+            raise ValueError(f"{self._name} is not a HBSharedBuffer segment.")
+        return json.loads(bytes(buf[_HEADER_PREFIX.size:_HEADER_PREFIX.size+header_length]))
+
+
+    def _map_image(self) -> Image.Image:
+        """Return a read-only PIL.Image on the pixels in the segment, without copying them."""
+        core = Image.core.map_buffer(self._pixels, self._size, "raw", 0, (self._mode, 0, 1))
+        pil_image = Image.new(self._mode, (0, 0))._new(core)
+        pil_image.readonly = 1
+        return pil_image
@@ -0,0 +1,540 @@
+"""
+HBTiledImage is an image too big to be kept in memory (e.g. a 60000x60000 stitched scan).\n
+The pixels are cut into fixed-size tiles (tile_size x tile_size) that are only decoded when they are needed,
+the recently used tiles are kept in memory (LRU, limited by bytes), and the modified tiles that are removed
+from memory are written to a scratch file, so the memory used never depends on the size of the image.\n
+crop() and copy() do not copy any pixel: the images share the tiles,
+and a shared tile is copied the first time one of the images modifies it (copy-on-write).
+read() and write() work tile by tile, so only the tiles of the region being accessed are in memory at a time,
+and to_hbimage() returns a region as an HBImage, to process or show it.\n
+HBTiledImage is a standalone storage API: HBImageBox and the image process commands do not use it
+(they work on HBImage, which needs the whole raster in memory). Showing and editing it in the editor is out of scope.\n
+A tile is decoded from the file without decoding the rest of the image when the file layout allows it:
+uncompressed BMP/PPM/TIFF pixels are read from the mapped file (see HBMappedFile), the strips and tiles of a TIFF
+are decoded alone (see HBRegionDecoder). Otherwise the file is decoded once, cut into tiles and kept in the scratch file:
+a non-interlaced PNG is decoded one row of tiles at a time (see HBRegionDecoder.decode_bands()),
+the other formats are decoded whole, so they are limited by the decompression bomb check of PIL.
+"""
+
+import weakref
+import itertools
+import tempfile
+import threading
+
+from typing import Dict, Iterator, List
+from collections import OrderedDict
+
+from PIL import Image
+
+from . import HBCommon
+from .HBImage import HBImage, _generations
+from .HBImageCache import image_nbytes
+from .HBMappedFile import HBMappedFile, KEEP_MAPPED, open_unchecked
+from .HBRegionDecoder import HBRegionDecoder, intersect_box
+
+
+
+TILE_SIZE = 512
+
+#the layer of the tiles read from the source, the modified tiles are in other layers (see _HBTileStore).
+_SOURCE_LAYER = 0
+_layers = itertools.count(_SOURCE_LAYER+1)
+
+
+
+
+class _HBTileSource:
+    """Decodes regions of the source image, a file or an in-memory PIL.Image."""
+
+    def __init__(self, source):
+        #the pixels of an uncompressed file are read from the mapped file.
+        self._mapped_file:HBMappedFile = None
+        if isinstance(source, Image.Image):
+            self._path:str = None
+            self._image:Image.Image = source
+            self.format:str = (source.format or "png").lower()
+            self.is_region_decodable:bool = True
+            self.is_band_decodable:bool = False
+            pil_image = source
+        else:
+            self._path = source
+            self._image = None
+            self._mapped_file = HBMappedFile.open(source) if KEEP_MAPPED else None
+            pil_image = open_unchecked(source)
+            self.format = pil_image.format.lower()
+            #strips/tiles of a TIFF are decoded independently (see HBRegionDecoder).
+            self.is_region_decodable = (
+                self._mapped_file is not None or len(pil_image.tile) > 1
+                or HBRegionDecoder.block_layout(pil_image) is not None
+            )
+            #a non-interlaced PNG is decoded band by band when it is cut into tiles.
+            self.is_band_decodable = HBRegionDecoder.is_band_decodable(pil_image)
+
+        self.size:tuple = pil_image.size
+        self.mode:str = pil_image.mode
+        self.palette:list = pil_image.getpalette() if pil_image.mode in ("P", "PA") else None
+        if self._path:
+            pil_image.close()
+
+
+    def decode(self, box:tuple) -> Image.Image:
+        """Return the pixels of box. Only the rows/strips/tiles of box are decoded if is_region_decodable."""
+        if self._image is not None:
+            return self._image.crop(box)
+        if self._mapped_file is not None:
+            return self._mapped_file.region(box)
+        return HBRegionDecoder.decode(self._path, box)
+
+
+    def decode_bands(self, band_height:int) -> Iterator[tuple]:
+        """Yield (y, PIL.Image) of the bands of band_height rows of the file, from the top.
+        A file that is not is_band_decodable is decoded whole, as a single band.
+
+        Raises:
+            PIL.Image.DecompressionBombError: If a file that is not is_band_decodable is too big to be decoded whole.
+        """
+        if self.is_band_decodable:
+            yield from HBRegionDecoder.decode_bands(self._path, band_height)
+            return None
+        with open_unchecked(self._path) as pil_image:
+            Image._decompression_bomb_check(pil_image.size)
+            pil_image.load()
+            yield 0, pil_image
+
+
+
+
+class _HBTileStore:
+    """The tiles of a source, shared by all the HBTiledImages cut from it. Thread safe.\n
+    A tile is keyed by (layer, tile_x, tile_y). The tiles of the source layer are decoded when needed,
+    the tiles of the other layers are the modified ones, they are written to the scratch file
+    when they are removed from memory. A modified tile is shared by the images that reference it (retain()),
+    and removed when no image does (release()).
+    """
+
+    def __init__(self, source:_HBTileSource, tile_size:int, max_bytes:int, directory:str=None):
+        self.source:_HBTileSource = source
+        self.tile_size:int = tile_size
+        self._max_bytes:int = max_bytes
+        self._directory:str = directory
+        self._lock = threading.RLock()
+
+        #key : PIL.Image, in memory, least recently used first.
+        self._tiles:OrderedDict = OrderedDict()
+        self._nbytes:int = 0
+        #key : (offset, length), tiles in the scratch file.
+        self._spilled:Dict[tuple, tuple] = {}
+        #keys of the tiles in memory that are not the same as their copy in the scratch file.
+        self._dirty:set = set()
+        #key : number of images that reference the tile.
+        self._references:Dict[tuple, int] = {}
+        #length : offsets of the free slots of the scratch file.
+        self._free_slots:Dict[int, List[int]] = {}
+        self._scratch_file = None
+        self._scratch_size:int = 0
+        #the source tiles cannot be decoded again, they are written to the scratch file too.
+        self._keeps_source_tiles:bool = not source.is_region_decodable
+        self._is_source_cut:bool = False
+
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value:int):
+        with self._lock:
+            self._max_bytes = int(value)
+            self._evict()
+
+    @property
+    def scratch_size(self) -> int:
+        """Bytes of the scratch file."""
+        return self._scratch_size
+
+
+    def tile_box(self, tile_index:tuple) -> tuple:
+        tile_x, tile_y = tile_index
+        width, height = self.source.size
+        x0, y0 = tile_x*self.tile_size, tile_y*self.tile_size
+        return (x0, y0, min(x0+self.tile_size, width), min(y0+self.tile_size, height))
+
+
+    def tile_indices(self, box:tuple) -> List[tuple]:
+        """Return the indices of the tiles that intersect box, row by row."""
+        x0, y0, x1, y1 = box
+        size = self.tile_size
+        return [
+            (tile_x, tile_y)
+            for tile_y in range(y0//size, (y1-1)//size+1)
+            for tile_x in range(x0//size, (x1-1)//size+1)
+        ]
+
+
+    def get(self, key:tuple) -> Image.Image:
+        """Return the tile of key, it must not be modified unless the caller is its only reference."""
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+            if key in self._spilled:
+                tile = self._read_spilled(key)
+                self._add(key, tile, is_dirty=False)
+                return tile
+            if self._keeps_source_tiles and not self._is_source_cut:
+                self._cut_source()
+                return self.get(key)
+
+        #decode without holding the lock, other tiles can be read meanwhile.
+        tile = self.source.decode(self.tile_box(key[1:]))
+        with self._lock:
+            if key not in self._tiles:
+                self._add(key, tile, is_dirty=False)
+            return self._tiles[key]
+
+
+    def put(self, key:tuple, tile:Image.Image):
+        """Add a modified tile, or mark it as modified (after it was modified in place)."""
+        with self._lock:
+            if key in self._tiles:
+                self._nbytes -= image_nbytes(self._tiles.pop(key))
+            self._free_slot(key)
+            self._add(key, tile, is_dirty=True)
+
+
+    def new_key(self, tile_index:tuple) -> tuple:
+        return (next(_layers), *tile_index)
+
+
+    def retain(self, key:tuple):
+        if key[0] == _SOURCE_LAYER:
+            return None
+        with self._lock:
+            self._references[key] = self._references.get(key, 0) + 1
+
+
+    def release(self, keys):
+        """Release the references of keys, the tiles that are not referenced any more are removed."""
+        with self._lock:
+            for key in keys:
+                if key[0] == _SOURCE_LAYER:
+                    continue
+                count = self._references.get(key, 0) - 1
+                if count > 0:
+                    self._references[key] = count
+                    continue
+                self._references.pop(key, None)
+                tile = self._tiles.pop(key, None)
+                if tile is not None:
+                    self._nbytes -= image_nbytes(tile)
+                self._dirty.discard(key)
+                self._free_slot(key)
+
+
+    def is_shared(self, key:tuple) -> bool:
+        return key[0] == _SOURCE_LAYER or self._references.get(key, 0) > 1
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _add(self, key:tuple, tile:Image.Image, is_dirty:bool):
+        self._tiles[key] = tile
+        self._nbytes += image_nbytes(tile)
+        if is_dirty or (self._keeps_source_tiles and key[0] == _SOURCE_LAYER and key not in self._spilled):
+            self._dirty.add(key)
+        self._evict(keep=key)
+
+
+    def _evict(self, keep:tuple=None):
+        #the tile just added is kept even if it is bigger than max_bytes.
+        while self._nbytes > self._max_bytes and len(self._tiles) > 1:
+            key, tile = self._tiles.popitem(last=False)
+            if key == keep:
+                self._tiles[key] = tile
+                continue
+            self._nbytes -= image_nbytes(tile)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                self._write_spilled(key, tile)
+
+
+    def _cut_source(self):
+        """Decode the source once and keep its tiles, in memory or in the scratch file.
+        Only one band of the source (a row of tiles, if the file allows it) is in memory at a time."""
+        self._is_source_cut = True
+        width = self.source.size[0]
+        for y, band in self.source.decode_bands(self.tile_size):
+            for tile_index in self.tile_indices((0, y, width, y+band.height)):
+                x0, y0, x1, y1 = self.tile_box(tile_index)
+                key = (_SOURCE_LAYER, *tile_index)
+                self._add(key, band.crop((x0, y0-y, x1, y1-y)), is_dirty=True)
+            band.close()
+
+
+    def _write_spilled(self, key:tuple, tile:Image.Image):
+        data = tile.tobytes()
+        if self._scratch_file is None:
+            self._scratch_file = tempfile.TemporaryFile(suffix=".tiles", dir=self._directory)
+        free_slots = self._free_slots.get(len(data))
+        if free_slots:
+            offset = free_slots.pop()
+        else:
+            offset = self._scratch_size
+            self._scratch_size += len(data)
+        self._scratch_file.seek(offset)
+        self._scratch_file.write(data)
+        self._spilled[key] = (offset, len(data))
+
+
+    def _read_spilled(self, key:tuple) -> Image.Image:
+        offset, length = self._spilled[key]
+        self._scratch_file.seek(offset)
+        data = self._scratch_file.read(length)
+        x0, y0, x1, y1 = self.tile_box(key[1:])
+        tile = Image.frombytes(self.source.mode, (x1-x0, y1-y0), data)
+        if self.source.palette:
+            tile.putpalette(self.source.palette)
+        return tile
+
+
+    def _free_slot(self, key:tuple):
+        slot = self._spilled.pop(key, None)
+        if slot is not None:
+            offset, length = slot
+            self._free_slots.setdefault(length, []).append(offset)
+
+
+
+
+class HBTiledImage:
+
+    def __init__(self, source, tile_size:int=TILE_SIZE, max_bytes:int=256*1024*1024, directory:str=None):
+        """
+        Args:
+            source (str | PIL.Image.Image | HBImage | HBTiledImage): image file path, or image.
+            An HBTiledImage shares its tiles (see copy()), the other arguments are ignored.
+            tile_size (int, optional): width and height of the tiles. Defaults to 512.
+            max_bytes (int, optional): memory used by the tiles. Defaults to 256 MB.
+            directory (str, optional): directory of the scratch file. Defaults to the system temporary directory.
+        """
+        self._information = dict.fromkeys([
+            "filename","filepath","format","size"
+        ])
+
+        if isinstance(source, HBTiledImage):
+            self._store:_HBTileStore = source._store
+            self._box:tuple = source._box
+            self._tile_keys:dict = dict(source._tile_keys)
+            self._generation:int = source._generation
+            self.information = source.information
+        else:
+            if isinstance(source, HBImage):
+                self.information = source.information
+                source = source.image
+            elif isinstance(source, str):
+                self.information = {
+                    "filename":HBCommon.get_file_basename(source),
+                    "filepath":source,
+                }
+            tile_source = _HBTileSource(source)
+            self._store = _HBTileStore(tile_source, tile_size, max_bytes, directory)
+            #region of the store this image is, in the coordinates of the source.
+            self._box = (0, 0, *tile_source.size)
+            #tile index : key of the modified tiles of this image, the other tiles are the ones of the source.
+            self._tile_keys = {}
+            self._generation = next(_generations)
+            if not self._information["format"]:
+                self._information["format"] = tile_source.format
+
+        for key in self._tile_keys.values():
+            self._store.retain(key)
+        #the tiles are released when this image is gone (the dict is updated in place by write()).
+        weakref.finalize(self, self._store.release, self._tile_keys.values())
+
+
+    @property
+    def size(self) -> tuple:
+        x0, y0, x1, y1 = self._box
+        return (x1-x0, y1-y0)
+
+    @property
+    def mode(self) -> str:
+        return self._store.source.mode
+
+    @property
+    def tile_size(self) -> int:
+        return self._store.tile_size
+
+    @property
+    def generation(self) -> int:
+        """Changes every time the pixels are modified, copies share it while they share the pixels
+        (see HBImage.generation)."""
+        return self._generation
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the tiles (of all the images sharing them)."""
+        return self._store.nbytes
+
+    @property
+    def max_bytes(self) -> int:
+        return self._store.max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value:int):
+        self._store.max_bytes = value
+
+    @property
+    def information(self):
+        self._information["size"] = self.size
+        return self._information
+
+    @information.setter
+    def information(self, infos:dict):
+        if infos:
+            HBCommon.update_dict_only_existing_keys(self._information, infos)
+
+    def copy(self) -> 'HBTiledImage':
+        """Return an image that shares the tiles until one of them is modified."""
+        return HBTiledImage(self)
+
+
+    def crop(self, box:tuple=None) -> 'HBTiledImage':
+        """Return the region box (default: the whole image) as an HBTiledImage sharing the tiles,
+        no pixel is decoded or copied. Use read() or to_hbimage() to get the pixels.
+        """
+        box = self._region(box)
+        hb_tiled_image = HBTiledImage(self)
+        x0, y0 = self._box[:2]
+        hb_tiled_image._box = (x0+box[0], y0+box[1], x0+box[2], y0+box[3])
+        return hb_tiled_image
+
+
+    def read(self, box:tuple=None) -> Image.Image:
+        """Return the pixels of box (default: the whole image), assembled from the tiles."""
+        box = self._region(box)
+        pil_image = Image.new(self.mode, (box[2]-box[0], box[3]-box[1]))
+        if self._store.source.palette:
+            pil_image.putpalette(self._store.source.palette)
+        for tile_index, tile_part, position in self._tile_parts(box):
+            tile = self._store.get(self._key_of(tile_index))
+            pil_image.paste(tile.crop(tile_part), position)
+        return pil_image
+
+
+    def to_hbimage(self, box:tuple=None) -> HBImage:
+        """Return the pixels of box (default: the whole image) as an HBImage."""
+        return HBImage(self.read(box), **self.information)
+
+
+    def write(self, image, position:tuple=(0, 0)):
+        """Write the pixels of image at position, tile by tile, as a new generation.
+
+        Args:
+            image (PIL.Image.Image | HBImage | HBTiledImage): an HBTiledImage is read tile by tile too.
+            position (tuple(int,int), optional): left top point. Defaults to (0, 0).
+        """
+        if isinstance(image, HBTiledImage):
+            for block in image._blocks((0, 0, *image.size)):
+                self._write_pil(image.read(block), (position[0]+block[0], position[1]+block[1]))
+        else:
+            self._write_pil(image.image if isinstance(image, HBImage) else image, position)
+        self._generation = next(_generations)
+
+
+    def restore(self, previous:'HBTiledImage') -> 'HBTiledImage':
+        """Take back the pixels of previous (a copy() taken before write()).
+
+        Returns:
+            HBTiledImage: the replaced pixels, pass it to restore() to redo.
+        """
+        current = self.copy()
+        self._store.release(list(self._tile_keys.values()))
+        self._tile_keys.clear()
+        self._tile_keys.update(previous._tile_keys)
+        for key in self._tile_keys.values():
+            self._store.retain(key)
+        self._box = previous._box
+        self._generation = previous._generation
+        return current
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _limit_box(self, _box):
+        img_W, img_H = self.size
+        x0, y0, x1, y1 = _box
+        x0 = HBCommon.limit_number(x0, 0, img_W)
+        y0 = HBCommon.limit_number(y0, 0, img_H)
+        x1 = HBCommon.limit_number(x1, 0, img_W)
+        y1 = HBCommon.limit_number(y1, 0, img_H)
+        return (x0, y0, x1, y1)
+
+
+    def _region(self, box:tuple) -> tuple:
+        if box:
+            return self._limit_box(box)
+        return (0, 0, *self.size)
+
+
+    def _key_of(self, tile_index:tuple) -> tuple:
+        return self._tile_keys.get(tile_index) or (_SOURCE_LAYER, *tile_index)
+
+
+    def _tile_parts(self, box:tuple):
+        """Yield (tile index, region in the tile, position in box) of the tiles that intersect box."""
+        x0, y0 = self._box[:2]
+        store_box = (x0+box[0], y0+box[1], x0+box[2], y0+box[3])
+        for tile_index in self._store.tile_indices(store_box):
+            tile_box = self._store.tile_box(tile_index)
+            part = intersect_box(tile_box, store_box)
+            if part is None:
+                continue
+            tile_part = (part[0]-tile_box[0], part[1]-tile_box[1], part[2]-tile_box[0], part[3]-tile_box[1])
+            yield tile_index, tile_part, (part[0]-store_box[0], part[1]-store_box[1])
+
+
+    def _blocks(self, box:tuple) -> List[tuple]:
+        """Split box into the blocks that lie in a single tile each, in the coordinates of this image."""
+        return [
+            (box[0]+position[0], box[1]+position[1],
+             box[0]+position[0]+tile_part[2]-tile_part[0], box[1]+position[1]+tile_part[3]-tile_part[1])
+            for _, tile_part, position in self._tile_parts(box)
+        ]
+
+
+    def _writable_tile(self, tile_index:tuple) -> Image.Image:
+        """Return the tile of this image, copied first if it is shared (copy-on-write)."""
+        key = self._key_of(tile_index)
+        tile = self._store.get(key)
+        if self._store.is_shared(key):
+            new_key = self._store.new_key(tile_index)
+            tile = tile.copy()
+            self._store.retain(new_key)
+            self._store.put(new_key, tile)
+            self._store.release([key])
+            self._tile_keys[tile_index] = new_key
+        return tile
+
+
+    def _write_pil(self, pil_image:Image.Image, position:tuple):
+        if pil_image.mode != self.mode:
+            pil_image = pil_image.convert(self.mode)
+        x, y = position
+        box = self._limit_box((x, y, x+pil_image.width, y+pil_image.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        for tile_index, tile_part, block_position in self._tile_parts(box):
+            source_x, source_y = box[0]-x+block_position[0], box[1]-y+block_position[1]
+            part_width, part_height = tile_part[2]-tile_part[0], tile_part[3]-tile_part[1]
+            tile = self._writable_tile(tile_index)
+            tile.paste(pil_image.crop((source_x, source_y, source_x+part_width, source_y+part_height)), tile_part[:2])
+            #mark it modified, it may be the same as the copy in the scratch file.
+            self._store.put(self._tile_keys[tile_index], tile)
@@ -0,0 +1,137 @@
+"""
+HBTransform is a lossless geometric transform of an image: any combination of flips and 90 degree rotations.\n
+These 8 transforms form the dihedral group D4, so any sequence of them is also one of the 8,
+and is applied to the pixels by a single PIL transpose (bit exact, no resampling),
+or not at all if the sequence cancels out.\n
+An HBTransform is stored as "flip left-right first (if flip), then rotate rotation*90 degrees counterclockwise".
+"""
+
+from PIL import Image
+
+
+
+#(rotation, flip) : PIL transpose method
+_TRANSPOSE_METHODS = {
+    (0, False):None,
+    (1, False):Image.Transpose.ROTATE_90,
+    (2, False):Image.Transpose.ROTATE_180,
+    (3, False):Image.Transpose.ROTATE_270,
+    (0, True):Image.Transpose.FLIP_LEFT_RIGHT,
+    (1, True):Image.Transpose.TRANSPOSE,
+    (2, True):Image.Transpose.FLIP_TOP_BOTTOM,
+    (3, True):Image.Transpose.TRANSVERSE,
+}
+
+
+
+class HBTransform:
+
+    def __init__(self, rotation:int=0, flip:bool=False):
+        """
+        Args:
+            rotation (int, optional): number of 90 degree counterclockwise rotations. Defaults to 0.
+            flip (bool, optional): If True, flip left-right before rotating. Defaults to False.
+        """
+        self._rotation:int = rotation % 4
+        self._flip:bool = bool(flip)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, HBTransform):
+            return NotImplemented
+        return (self._rotation, self._flip) == (other._rotation, other._flip)
+
+    def __hash__(self):
+        return hash((self._rotation, self._flip))
+
+    def __repr__(self):
+        return f"HBTransform(rotation={self._rotation}, flip={self._flip})"
+
+
+    @property
+    def rotation(self) -> int:
+        return self._rotation
+
+    @property
+    def flip(self) -> bool:
+        return self._flip
+
+    @property
+    def is_identity(self) -> bool:
+        return self.transpose_method is None
+
+    @property
+    def swaps_axes(self) -> bool:
+        """True if width and height are exchanged."""
+        return self._rotation % 2 == 1
+
+    @property
+    def transpose_method(self) -> Image.Transpose:
+        """The PIL transpose method of this transform, None for the identity."""
+        return _TRANSPOSE_METHODS[(self._rotation, self._flip)]
+
+
+    #-----------------staticmethod-------------------------------
+
+    @staticmethod
+    def identity() -> 'HBTransform':
+        return HBTransform()
+
+    @staticmethod
+    def rotate(angle:int) -> 'HBTransform':
+        """Counterclockwise rotation, as PIL.Image.rotate().
+
+        Raises:
+            ValueError: angle is not a multiple of 90.
+        """
+        if angle % 90:
+            raise ValueError(f"angle must be a multiple of 90, not {angle}")
+        return HBTransform(rotation=angle//90)
+
+    @staticmethod
+    def flip_horizontal() -> 'HBTransform':
+        return HBTransform(flip=True)
+
+    @staticmethod
+    def flip_vertical() -> 'HBTransform':
+        return HBTransform(rotation=2, flip=True)
+
+
+
+    #------------------------------------------------
+
+    def then(self, other:'HBTransform') -> 'HBTransform':
+        """Return the transform that applies self first, then other."""
+        if other._flip:
+            #a flip reverses the direction of the rotations before it.
+            return HBTransform(other._rotation - self._rotation, not self._flip)
+        return HBTransform(other._rotation + self._rotation, self._flip)
+
+    def inverse(self) -> 'HBTransform':
+        if self._flip:
+            #every flip (with a rotation) is a reflection, which is its own inverse.
+            return HBTransform(self._rotation, True)
+        return HBTransform(-self._rotation)
+
+    def transform_size(self, size:tuple) -> tuple:
+        """Return the size of an image of this size after the transform."""
+        width, height = size
+        return (height, width) if self.swaps_axes else (width, height)
+
+    def map_box(self, box:tuple, size:tuple) -> tuple:
+        """Return where the box (x0, y0, x1, y1) of an image of this size is after the transform."""
+        x0, y0, x1, y1 = box
+        width, height = size
+        if self._flip:
+            x0, x1 = width-x1, width-x0
+        for _ in range(self._rotation):
+            #one counterclockwise rotation, (x, y) goes to (y, width-1-x)
+            x0, y0, x1, y1 = y0, width-x1, y1, width-x0
+            width, height = height, width
+        return (x0, y0, x1, y1)
+
+    def apply(self, pil_image:Image.Image) -> Image.Image:
+        """Return the transformed image, or pil_image itself for the identity."""
+        if self.is_identity:
+            return pil_image
+        return pil_image.transpose(self.transpose_method)
@@ -1,3 +1,17 @@
 from .HBImage import HBImage
-from .HBAlbum import HBAlbum
-
+from .HBAlbum import HBAlbum, HBImageDescriptor
+from .HBImageCache import HBImageCache, shared_image_cache
+from .HBLoadScheduler import HBLoadScheduler
+from .HBAlbumLoadTask import HBAlbumLoadTask
+from .HBFetcher import HBFetcher, shared_fetcher
+from .HBHttpCache import HBHttpCache
+from .HBLoadPipeline import HBLoadPipeline
+from .HBSharedBuffer import HBSharedBuffer
+from .HBImagePatch import HBImagePatch
+from .HBTransform import HBTransform
+from .HBOpChain import HBOpChain
+from .HBPyramid import HBPyramid
+from .HBMappedFile import HBMappedFile
+from .HBTiledImage import HBTiledImage
+from .HBRegionDecoder import HBRegionDecoder
+from .HBProgressiveDecoder import HBProgressiveDecoder
@@ -0,0 +1,103 @@
+"""
+HBAlbumLoader loads images into a HBAlbum in background (see HBAlbum.load_async()),
+and reports the progress by Qt signals, so the GUI thread never waits for a whole batch.\n
+The loaded images arrive in worker threads, they are inserted into the album in the thread of the loader (GUI thread).
+
+Require package:
+1. Pyside
+2. HBImage
+"""
+
+from typing import List
+
+from PySide6.QtCore import QObject, Signal
+
+from HBImage import HBAlbum, HBAlbumLoadTask
+
+
+
+class HBAlbumLoader(QObject):
+
+    #signal
+    image_loaded:Signal = Signal(int)         #album index of the loaded image
+    image_failed:Signal = Signal(str, str)    #source, error message
+    progress:Signal = Signal(int, int)        #finished count, total count
+    finished:Signal = Signal()
+
+    #emitted from worker threads, received in the thread of the loader (GUI thread).
+    _item_done:Signal = Signal(int, object, object)
+
+
+    def __init__(self, album:HBAlbum, source, parent:QObject=None):
+        """
+        Args:
+            album (HBAlbum): the album the images are added to.
+            source (str | list[str]): folder path, txt file path, or a list of image files' path or url.
+            parent (QObject, optional)
+        """
+        super().__init__(parent)
+        self._album:HBAlbum = album
+        self._source = source
+        self._task:HBAlbumLoadTask = None
+
+        self._item_done.connect(self._on_item_done)
+
+
+    @property
+    def total(self) -> int:
+        return self._task.total if self._task else 0
+
+    @property
+    def finished_count(self) -> int:
+        return self._task.finished_count if self._task else 0
+
+    @property
+    def failed(self) -> List[tuple]:
+        """List of (source, error message) of the images that could not be loaded."""
+        return self._task.failed if self._task else []
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._task is not None and self._task.is_cancelled
+
+    @property
+    def is_finished(self) -> bool:
+        return self._task is not None and self._task.is_finished
+
+
+    def start(self):
+        """Start loading, connect the signals before.
+
+        Raises:
+            TypeError, FileNotFoundError: see HBAlbum.load_async().
+        """
+        self._task = self._album.load_async(self._source, self._item_done.emit)
+        if self._task.is_finished:
+            self.finished.emit()
+
+
+    def cancel(self):
+        """Stop loading the rest of the batch. The images already added stay in the album."""
+        if self._task is None or self._task.is_finished:
+            return None
+        self._task.cancel()
+        self.finished.emit()
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _on_item_done(self, source_index:int, entry, error):
+        """Called in the GUI thread."""
+        if self._task.is_finished:
+            return None
+
+        album_index = self._task.add(source_index, entry, error)
+        if error is not None:
+            self.image_failed.emit(*self._task.failed[-1])
+        else:
+            self.image_loaded.emit(album_index)
+
+        self.progress.emit(self._task.finished_count, self._task.total)
+        if self._task.is_finished:
+            self.finished.emit()
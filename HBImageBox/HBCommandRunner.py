@@ -0,0 +1,178 @@
+"""
+HBCommandRunner runs the image process commands of HBImageBox in order, without blocking the GUI thread.\n
+A command with a prepare(source) method computes its pixels in a worker thread,
+from a snapshot of the image (a copy-on-write copy, so the image can still be shown and painted meanwhile).
+When it is finished, the command is delivered back to the GUI thread by the signal "command_ready",
+and its redo() only writes the computed pixels into the image.
+The commands without prepare() are delivered at once, but still after the commands submitted before them.\n
+If the full resolution of the image is not decoded yet (see HBImage.decode_for_size()),
+it is decoded in the worker too, before the snapshot is taken, 
+unless the command only reads a region of it (reads_region_only, e.g. crop), which the snapshot decodes by itself.\n
+The ROI of a command is taken again when it starts (see capture_ROI()), after the commands submitted before it.
+The undo/redo steps whose pixels are computed again (see CommandUndoStep) are submitted the same way.\n
+Commands waiting or in the worker can be cancelled (e.g. by undo, or when another image is shown),
+the result of a cancelled command is dropped when it arrives.
+
+Require package:
+1. Pyside
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtGui import QUndoCommand
+
+
+
+class HBCommandRunner(QObject):
+
+    #signal
+    command_ready:Signal = Signal(object)       #the command to push to the undo stack
+    command_failed:Signal = Signal(object, str)  #the command, error message
+    pending_changed:Signal = Signal(int)       #number of commands submitted and not delivered yet
+
+    #emitted from the worker thread, received in the thread of the runner (GUI thread).
+    _prepared:Signal = Signal(int, object, object)
+    _decoded:Signal = Signal(int, object)
+
+
+    def __init__(self, parent:QObject=None):
+        super().__init__(parent)
+        self._queue:deque = deque()
+        #the command in the worker, None if there is none.
+        self._running:QUndoCommand = None
+        #increased by cancel(), a result of an older epoch is dropped.
+        self._epoch:int = 0
+        #one worker, so the commands are prepared in the order they were submitted.
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="HBCommandRunner")
+
+        self._prepared.connect(self._on_prepared)
+        self._decoded.connect(self._on_decoded)
+
+
+    @property
+    def is_busy(self) -> bool:
+        return self._running is not None
+
+    @property
+    def pending_count(self) -> int:
+        """Number of commands submitted and not delivered yet."""
+        return len(self._queue) + (1 if self.is_busy else 0)
+
+
+    @property
+    def last_pending(self) -> QUndoCommand:
+        """The last submitted command that is not delivered yet, None if there is none."""
+        return self._queue[-1] if self._queue else self._running
+
+
+    def submit(self, command:QUndoCommand):
+        """Deliver command by "command_ready" after the commands submitted before it."""
+        pending_count = self.pending_count
+        self._queue.append(command)
+        if not self.is_busy:
+            self._run_next()
+        self._emit_pending_changed(pending_count)
+
+
+    def cancel_last(self) -> bool:
+        """Cancel the last submitted command that is not delivered yet.
+
+        Returns:
+            bool: False if there is no such command.
+        """
+        pending_count = self.pending_count
+        if self._queue:
+            self._queue.pop()
+        elif self.is_busy:
+            self._epoch += 1
+            self._running = None
+        self._emit_pending_changed(pending_count)
+        return pending_count != self.pending_count
+
+
+    def cancel(self):
+        """Cancel all the commands that are not delivered yet."""
+        pending_count = self.pending_count
+        self._queue.clear()
+        if self.is_busy:
+            self._epoch += 1
+            self._running = None
+        self._emit_pending_changed(pending_count)
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _run_next(self):
+        while self._queue:
+            command = self._queue.popleft()
+            #the commands before it have run, the ROI it was created with may not be valid any more.
+            capture_ROI = getattr(command, "capture_ROI", None)
+            if capture_ROI is not None:
+                capture_ROI()
+            if getattr(command, "prepare", None) is None:
+                self.command_ready.emit(command)
+                continue
+            self._running = command
+            if not command.hb_image.is_decoded and not getattr(command, "reads_region_only", False):
+                self._executor.submit(self._decode, self._epoch, command)
+            else:
+                self._submit_prepare(command)
+            return None
+
+
+    def _submit_prepare(self, command:QUndoCommand):
+        #the snapshot is passed in a list, so the worker can drop it before the command is delivered,
+        #otherwise the image would be copied when the command writes it (copy-on-write).
+        sources = [command.hb_image.copy()]
+        self._executor.submit(self._prepare, self._epoch, command, sources)
+
+
+    def _decode(self, epoch:int, command:QUndoCommand):
+        """Run in the worker thread."""
+        try:
+            command.hb_image.decode()
+        except Exception as e:
+            self._prepared.emit(epoch, command, e)
+            return None
+        self._decoded.emit(epoch, command)
+
+
+    def _on_decoded(self, epoch:int, command:QUndoCommand):
+        if epoch != self._epoch or command is not self._running:
+            #cancelled.
+            return None
+        self._submit_prepare(command)
+
+
+    def _prepare(self, epoch:int, command:QUndoCommand, sources:list):
+        """Run in the worker thread."""
+        error = None
+        try:
+            command.prepare(sources.pop())
+        except Exception as e:
+            error = e
+        self._prepared.emit(epoch, command, error)
+
+
+    def _on_prepared(self, epoch:int, command:QUndoCommand, error:Exception):
+        if epoch != self._epoch or command is not self._running:
+            #cancelled.
+            return None
+        pending_count = self.pending_count
+        self._running = None
+        if error is None:
+            self.command_ready.emit(command)
+        else:
+            self.command_failed.emit(command, str(error))
+        #a slot of command_ready may have submitted or cancelled commands.
+        if not self.is_busy:
+            self._run_next()
+        self._emit_pending_changed(pending_count)
+
+
+    def _emit_pending_changed(self, pre_pending_count:int):
+        if pre_pending_count != self.pending_count:
+            self.pending_changed.emit(self.pending_count)
@@ -0,0 +1,121 @@
+"""
+HBHistoryStore keeps the undo histories (HBUndoHistory) of the images that are not shown,
+so every image of an album has its own history, and switching back to an image restores it at once.\n
+The histories put in the store are compressed in a background thread.
+The store is limited by the memory of its histories, when it is exceeded,
+the least recently used histories are moved to files in a temporary directory.
+Their data are read back only when a command needs them (e.g. undo), not when the history is taken.
+"""
+
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .HBUndoStack import HBUndoHistory
+
+
+
+class HBHistoryStore:
+
+    def __init__(self, max_bytes:int=256*1024*1024, directory:str=None):
+        """
+        Args:
+            max_bytes (int, optional): memory budget of the stored histories. Defaults to 256 MB.
+            directory (str, optional): where the histories are spilled.
+            Defaults to a temporary directory, created when it is needed and removed at exit.
+        """
+        self._histories:OrderedDict = OrderedDict()
+        self._max_bytes:int = max_bytes
+        self._directory:str = directory
+        self._temporary_directory:tempfile.TemporaryDirectory = None
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="HBHistoryStore")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._histories)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._histories
+
+    @property
+    def nbytes(self) -> int:
+        """Memory kept by the stored histories (spilled data is not counted)."""
+        with self._lock:
+            histories = list(self._histories.values())
+        return sum(history.nbytes for history in histories)
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value:int):
+        self._max_bytes = int(value)
+        self._executor.submit(self._apply_budget)
+
+
+    def put(self, key, history:HBUndoHistory):
+        """Store history as the most recently used one, empty histories are not stored."""
+        if len(history) == 0:
+            self.discard(key)
+            return None
+        with self._lock:
+            self._histories[key] = history
+            self._histories.move_to_end(key)
+        self._executor.submit(self._compress, key, history)
+
+
+    def take(self, key) -> HBUndoHistory:
+        """Remove the history of key from the store and return it, None if there is no history of key."""
+        with self._lock:
+            return self._histories.pop(key, None)
+
+
+    def discard(self, key):
+        with self._lock:
+            self._histories.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._histories.clear()
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _is_stored(self, key, history:HBUndoHistory) -> bool:
+        with self._lock:
+            return self._histories.get(key) is history
+
+
+    def _compress(self, key, history:HBUndoHistory):
+        #the history may be taken back before the job runs.
+        if self._is_stored(key, history):
+            history.compress()
+        self._apply_budget()
+
+
+    def _apply_budget(self):
+        """Spill the least recently used histories until the store fits in max_bytes."""
+        with self._lock:
+            items = list(self._histories.items())
+        nbytes = sum(history.nbytes for _, history in items)
+        for key, history in items:
+            if nbytes <= self._max_bytes:
+                break
+            if not self._is_stored(key, history):
+                continue
+            history_nbytes = history.nbytes
+            history.spill(self._spill_directory())
+            nbytes -= history_nbytes - history.nbytes
+
+
+    def _spill_directory(self) -> str:
+        if self._directory is None:
+            self._temporary_directory = tempfile.TemporaryDirectory(prefix="HBHistory")
+            self._directory = self._temporary_directory.name
+        return self._directory
@@ -12,8 +12,7 @@ from PySide6.QtCore import Signal,Qt
 from PySide6.QtGui import (
     QDropEvent,
     QDragEnterEvent,
-    QWheelEvent,
-    QUndoStack
+    QWheelEvent
 )
 
 from PySide6.QtWidgets import QWidget,QScrollArea,QFileDialog
@@ -22,6 +21,12 @@ from PySide6.QtWidgets import QWidget,QScrollArea,QFileDialog
 from HBImage import HBImage
 from .HBImageBoxUi import _HBImageBoxUi
 from .HBImageBoxMethods import _HBImageBoxMethods
+from .HBUndoStack import HBUndoStack
+from .HBHistoryStore import HBHistoryStore
+from .HBCommandRunner import HBCommandRunner
+from .HBRenderCache import HBRenderCache
+from .HBZoomRenderer import HBZoomRenderer
+from .HBUrlLoader import HBUrlLoader
 
 
 
@@ -34,6 +39,9 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
     image_loaded:Signal = Signal()
     image_processed:Signal = Signal()
 
+    #emitted from the decoder thread when the full resolution of the image is decoded (generation).
+    _image_decoded:Signal = Signal(int)
+
     def __init__(self, parent:QWidget=None) -> None:
         super().__init__(parent)
 
@@ -42,8 +50,23 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
         self._display_mode = "original_size"
         self._zoom_scale = 1
         self._draw_color = (0,0,255)
-        self._image_process_undo_stack = QUndoStack()
-        self._image_process_undo_stack.setUndoLimit(10)
+        #limited by the memory the commands keep, not the number of commands.
+        self._image_process_undo_stack = HBUndoStack(parent=self)
+        #undo histories of the images that are not shown, by image key (see set_image).
+        self._history_store = HBHistoryStore()
+        self._image_key = None
+        #prepares the commands in a worker thread, then they are pushed to the undo stack.
+        self._image_process_runner = HBCommandRunner(parent=self)
+        #tiles of the shown images, by generation, displayed size and tile index.
+        self._render_cache = HBRenderCache()
+        #renders the high quality visible tiles when the ctrl+wheel zoom stops, a preview is shown meanwhile.
+        self._zoom_renderer = HBZoomRenderer(parent=self)
+        #downloads the urls in a worker thread, the image is shown while it arrives.
+        self._url_loader = HBUrlLoader(parent=self)
+        #True while the shown image is a preview of the url being loaded.
+        self._is_url_preview = False
+        #(image, key, undo history) replaced by the url previews, shown again if the download fails.
+        self._url_replaced:tuple = None
         #print(self._image_process_undo_stack.canUndo())
         self.set_events()
 
@@ -101,15 +124,66 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
         self.actionRotate_90.triggered.connect(self._rotate_90_image)
         self.actionDrawRect.triggered.connect(self._draw_rect)
 
-        self.actionUndo.triggered.connect(self._image_process_undo_stack.undo)
-        self.actionRedo.triggered.connect(self._image_process_undo_stack.redo)
+        self.actionUndo.triggered.connect(self._undo)
+        self.actionRedo.triggered.connect(self._redo)
         self._image_process_undo_stack.canUndoChanged.connect(self.actionUndo.setEnabled)
         self._image_process_undo_stack.canRedoChanged.connect(self.actionRedo.setEnabled)
 
-    def set_image(self, image:'HBImage'):
+        self._image_process_runner.command_ready.connect(self._push_image_process)
+        self._image_process_runner.command_failed.connect(self._image_process_failed)
+        self._image_process_runner.pending_changed.connect(self._image_process_pending_changed)
+
+        self._zoom_renderer.rendered.connect(self._show_zoom_rendered)
+        self._image_decoded.connect(self._show_decoded_image)
+
+        self._url_loader.preview_ready.connect(self._show_url_preview)
+        self._url_loader.loaded.connect(self._show_url_loaded)
+        self._url_loader.failed.connect(self._url_load_failed)
+
+    def set_image(self, image:'HBImage', key=None):
+        """Show image.
+
+        Args:
+            image (HBImage)
+            key (optional): identify the image (e.g. HBAlbum.key_of(index)).
+            The undo history of the shown image is kept under its key, and restored when an image with this key is set again.
+            Without a key, the history of the shown image is cleared.
+        """
         if not isinstance(image, HBImage):
             return None
-        self._image = image
+        #the url being loaded would replace image.
+        self._url_loader.cancel()
+        self._set_image(image, key)
+
+
+    def load_url(self, url:str):
+        """Download the image of url in a worker thread, and show it while it arrives
+        (progressive JPEG scans, first rows of PNG and baseline JPEG).
+        The image cannot be edited until it is complete, then "image_loaded" is emitted.
+        """
+        preview_size = self.scroll_area.viewport().size().toTuple()
+        self._url_loader.load(url, preview_size)
+
+
+    def _set_image(self, image:'HBImage', key=None):
+        """set_image() without cancelling the url being loaded (it shows its previews)."""
+        self._release_url_replaced()
+        self._is_url_preview = False
+        #the processes not finished yet belong to the shown image.
+        self._image_process_runner.cancel()
+        history = self._image_process_undo_stack.detach(self._image)
+        if self._image_key is not None:
+            self._history_store.put(self._image_key, history)
+
+        history = self._history_store.take(key) if key is not None else None
+        if history is not None and history.image is image:
+            #the image is the one the commands modify, keep editing it.
+            self._image = image
+            self._image_process_undo_stack.attach(history)
+        else:
+            #processes modify the image in place, the copy shares the pixels until then.
+            self._image = image.copy()
+        self._image_key = key
         self._display_mode = "original_size"
         self._zoom_scale = 1
 
@@ -118,6 +192,17 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
         self.hb_image_box_label.hide_rubber_band()
         
 
+    def forget_history(self, key):
+        """Remove the undo history of the image with key (e.g. the image was removed from the album)."""
+        if key == self._image_key:
+            self._image_process_undo_stack.clear()
+        elif self._url_replaced is not None and key == self._url_replaced[1]:
+            #the image replaced by the url previews, its history is not stored when it is released.
+            self._url_replaced = (self._url_replaced[0], None, self._url_replaced[2])
+        else:
+            self._history_store.discard(key)
+
+
     def update_widgets_enable(self, enable):
         self.menu_edit.setEnabled(enable)
         self.actionCopy.setEnabled(enable)
@@ -126,6 +211,8 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
         self.actionInformation.setEnabled(enable)
 
     def update_image_box(self):
+        #the image is rendered now, a zoom rendering which is not finished is outdated.
+        self._zoom_renderer.cancel()
         self.show_image()
         if self.display_mode=="zoom":
             pass
@@ -134,6 +221,7 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
 
     def show_image(self):
         if not self.is_image_exist:
+            self.hb_image_box_label.set_view(None)
             self.hb_image_box_label.setText("Drag Image Here")
             return None
 
@@ -172,8 +260,7 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
         if file_abs_path=="":
             return None
         try:
-            self._image = HBImage(file_abs_path)
-            self.set_image(self.image)
+            self.set_image(HBImage(file_abs_path))
         except Exception as e:
             self._show_msg_box('Error!', e)
             return False
@@ -240,8 +327,12 @@ class HBImageBox(_HBImageBoxUi, _HBImageBoxMethods):
         if not event.mimeData().hasUrls():
             return False
 
-        filepath = event.mimeData().urls()[0] 
-        filepath = filepath.toLocalFile()
+        url = event.mimeData().urls()[0] 
+        if not url.isLocalFile():
+            #e.g. an image dragged from a web browser.
+            self.load_url(url.toString())
+            return None
+        filepath = url.toLocalFile()
         
         self.set_image(HBImage(filepath))
         self.image_loaded.emit()
@@ -1,5 +1,7 @@
 """
-HBImageBoxLabel is custom widget inherited from "PySide6.QtWidgets.QLabel".
+HBImageBoxLabel is custom widget inherited from "PySide6.QtWidgets.QLabel".\n
+Its size is the displayed (zoomed) image size, but it keeps no pixmap of that size,
+the image is painted by an HBTileView, only in the exposed region (see set_view()).
 
 Require package:
 1. Pyside
@@ -16,9 +18,11 @@ from PySide6.QtCore import (
     Signal
 )
 
-from PySide6.QtGui import QMouseEvent
+from PySide6.QtGui import QMouseEvent, QPainter, QPaintEvent
 from PySide6.QtWidgets import QLabel, QRubberBand,QSizePolicy
 
+from .HBTileView import HBTileView
+
 
 
 
@@ -40,6 +44,10 @@ class HBImageBoxLabel(QLabel):
         self._selected_area :tuple(int,int,int,int) = (0,0,0,0)
         self._is_selecting :bool = False
         self._rubber_band = QRubberBand(QRubberBand.Rectangle, self)
+        #paints the image, the text is shown if it is None.
+        self._view:HBTileView = None
+        #the previous view, stretched under the tiles of self._view that are not rendered yet (e.g. while zooming).
+        self._preview_view:HBTileView = None
         
         self.setText(f"Drag Image Here")
         
@@ -55,6 +63,29 @@ class HBImageBoxLabel(QLabel):
     def selected_area(self, _box:tuple):
         self._selected_area = self.limit_box(_box)
 
+    @property
+    def view(self) -> HBTileView:
+        return self._view
+
+
+    def set_view(self, view:HBTileView, preview_view:HBTileView=None):
+        """Paint the image by view (None to show the text).
+
+        Args:
+            view (HBTileView)
+            preview_view (HBTileView, optional): painted stretched to the size of view,
+            where the tiles of view are not cached, and view does not render them until end_preview().
+        """
+        self._view = view
+        self._preview_view = preview_view
+        self.update()
+
+    def end_preview(self):
+        """Stop painting the preview view, the tiles of view that are not cached are rendered."""
+        if self._preview_view is not None:
+            self._preview_view = None
+            self.update()
+
 
 
 
@@ -105,6 +136,20 @@ class HBImageBoxLabel(QLabel):
 
     #------------------QEvent--------------------------------
 
+    def paintEvent(self, event:QPaintEvent):
+        if self._view is None:
+            return super().paintEvent(event)
+
+        painter = QPainter(self)
+        rect = event.rect()
+        if self._preview_view is None:
+            self._view.paint(painter, rect)
+            return None
+
+        #the cached tiles of view are painted over the preview.
+        self._paint_preview(painter, rect)
+        self._view.paint(painter, rect, render_missing=False)
+
     def mousePressEvent(self, event:QMouseEvent):
         super().mousePressEvent(event)
         if event.button() == Qt.LeftButton:
@@ -159,5 +204,25 @@ class HBImageBoxLabel(QLabel):
         self.selected_area = self._rubber_band.geometry().getCoords()
         #self.setText(f"selected_area:{self.selected_area}")
 
+    def _paint_preview(self, painter:QPainter, rect:QRect):
+        """Paint the cached tiles of the preview view, stretched (without filtering) to the size of view."""
+        view, preview_view = self._view, self._preview_view
+        x_scale = view.display_size[0] / preview_view.display_size[0]
+        y_scale = view.display_size[1] / preview_view.display_size[1]
+
+        painter.save()
+        painter.translate(*view.offset)
+        painter.scale(x_scale, y_scale)
+        painter.translate(-preview_view.offset[0], -preview_view.offset[1])
+        image_rect = view.image_rect(rect)
+        preview_rect = QRect(
+            int(image_rect.x()/x_scale) - 1 + preview_view.offset[0], 
+            int(image_rect.y()/y_scale) - 1 + preview_view.offset[1],
+            int(image_rect.width()/x_scale) + 3, 
+            int(image_rect.height()/y_scale) + 3
+        )
+        preview_view.paint(painter, preview_rect, render_missing=False)
+        painter.restore()
+
     def _limit_number(self, x, lower, upper):
         return max(lower, min(x, upper))
\ No newline at end of file
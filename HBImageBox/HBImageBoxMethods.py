@@ -6,8 +6,8 @@ Using inheritance let class "HBImageBoxMethods" functions add to the class "HBIm
 
 from abc import ABC, abstractmethod
 
-from PySide6.QtCore import Signal,QSize,QMimeData,QUrl
-from PySide6.QtGui import QPixmap,QImage,QUndoStack,QMovie
+from PySide6.QtCore import Signal,QSize,QMimeData,QUrl,Qt,QRect
+from PySide6.QtGui import QPixmap,QImage,QMovie
 
 from PySide6.QtWidgets import (
     QLabel,
@@ -17,14 +17,21 @@ from PySide6.QtWidgets import (
     QMessageBox
 )
 
-from HBImage import HBImage
+from HBImage import HBImage, HBCommon
 from .HBImageBoxLabel import HBImageBoxLabel
+from .HBUndoStack import HBUndoStack
+from .HBCommandRunner import HBCommandRunner
+from .HBRenderCache import HBRenderCache, tile_indices
+from .HBTileView import HBTileView
+from .HBZoomRenderer import HBZoomRenderer
+from .HBUrlLoader import HBUrlLoader
 from .HBImageProcessCommand import (
     CommandCropImage,
     CommandFlipImage,
     CommandColorImage,
     CommandRotateImage,
-    CommandDrawImage
+    CommandDrawImage,
+    CommandUndoStep
 )
 
 
@@ -60,7 +67,13 @@ class _HBImageBoxMethods():
         self.hb_image_box_label:HBImageBoxLabel
         self.menu_processor:QMenu
         self.menu_bar:QMenuBar
-        self._image_process_undo_stack:QUndoStack
+        self._image_process_undo_stack:HBUndoStack
+        self._image_process_runner:HBCommandRunner
+        self._render_cache:HBRenderCache
+        self._zoom_renderer:HBZoomRenderer
+        self._url_loader:HBUrlLoader
+        self._is_url_preview:bool
+        self._image_decoded:Signal
 
 
 
@@ -92,7 +105,15 @@ class _HBImageBoxMethods():
         ...
 
     @abstractmethod
-    def set_image(self, image:'HBImage'):
+    def set_image(self, image:'HBImage', key=None):
+        ...
+
+    @abstractmethod
+    def _set_image(self, image:'HBImage', key=None):
+        ...
+
+    @abstractmethod
+    def load_url(self, url:str):
         ...
 
     def _show_msg_box(self, title, msg):
@@ -110,12 +131,43 @@ class _HBImageBoxMethods():
             hb_image (HBImage)\n
             q_label (QLabel)
         """
-        pixmap_image = QPixmap(hb_image.to_qt().image)
         image_original_size = hb_image.size
         self._zoom_scale = 1
 
-        q_label.setPixmap(pixmap_image)
         q_label.setFixedSize(QSize(*image_original_size))
+        view = HBTileView(hb_image, image_original_size, self._render_cache)
+        if hb_image.is_decoded:
+            q_label.set_view(view)
+            return None
+
+        preview_view = q_label.view
+        if preview_view is None or preview_view.generation != view.generation:
+            preview_view = self._decoded_preview_view(hb_image)
+        if preview_view is None:
+            q_label.set_view(view)
+            return None
+        #the preview is stretched until the full resolution is decoded in the background.
+        q_label.set_view(view, preview_view)
+        generation = hb_image.generation
+        hb_image.decode_async().add_done_callback(lambda future: self._image_decoded.emit(generation))
+
+
+    def _decoded_preview_view(self, hb_image: 'HBImage') -> HBTileView:
+        """Return a view of hb_image decoded only as big as this box (see HBImage.decode_for_size()),
+        with all its tiles rendered, None if the image cannot be decoded smaller."""
+        box_size = self.size().toTuple()
+        if not hb_image.decode_for_size(box_size):
+            return None
+        preview_size = hb_image.pyramid.level_for(box_size).size
+        preview_view = HBTileView(hb_image, preview_size, self._render_cache)
+        for tile_index in tile_indices(preview_size, QRect(0, 0, *preview_size)):
+            self._render_cache.tile(hb_image, preview_size, tile_index)
+        return preview_view
+
+
+    def _show_decoded_image(self, generation:int):
+        if self.is_image_exist and self.image.generation == generation:
+            self.update_image_box()
     
     def _show_gif_image(self, hb_image:'HBImage', q_label:QLabel):
         if hb_image.information["format"]!="gif":
@@ -134,11 +186,17 @@ class _HBImageBoxMethods():
             hb_image (HBImage): _description_
             q_label (QLabel): _description_
         """
-        label_size = q_label.size().toTuple()
-        resized_image = hb_image.to_fit_container(label_size)
-        resized_image = QPixmap(resized_image.to_qt().image)
-        
-        q_label.setPixmap(resized_image)
+        q_label.set_view(self._resized_view(hb_image, q_label))
+
+
+    def _resized_view(self, hb_image: 'HBImage', q_label: QLabel) -> HBTileView:
+        """Return the view of hb_image resized to fit q_label's size, centered like a pixmap of q_label."""
+        label_width, label_height = q_label.size().toTuple()
+        resized_size = hb_image.fit_container_size((label_width, label_height))
+        #a big JPEG is only decoded as big as it is shown, until the full resolution is needed.
+        hb_image.decode_for_size(resized_size)
+        offset = ((label_width-resized_size[0])//2, (label_height-resized_size[1])//2)
+        return HBTileView(hb_image, resized_size, self._render_cache, offset)
         
 
 
@@ -171,7 +229,12 @@ class _HBImageBoxMethods():
         self.hb_image_box_label.setFixedSize(self.size())
         self.update_image_box()
         self.update_widgets_enable(self.is_image_exist)
+        self._url_loader.cancel()
+        self._release_url_replaced()
+        self._is_url_preview = False
+        self._image_process_runner.cancel()
         self._image_process_undo_stack.clear()
+        self._image_key = None
         self.image_removed.emit()
 
     def _copy_image_to_clipboard(self):
@@ -205,6 +268,10 @@ class _HBImageBoxMethods():
                 return None
             
             #if clipboard_text is url, then try to load it.
+            if HBCommon.is_url(clipboard_text.url()):
+                #shown while it is downloaded, "image_loaded" is emitted when it is complete.
+                self.load_url(clipboard_text.url())
+                return None
             try:
                 clipboard_image = HBImage(clipboard_text.url())
                 is_load_successful = True
@@ -269,19 +336,165 @@ class _HBImageBoxMethods():
         self._scale_label_size(self.image.size, self.zoom_scale)
         #self._show_resized_image(self.image, self.hb_image_box_label)
         self.hide_rubber_band()
+        self._show_zoom_preview()
+
+
+    def _show_zoom_preview(self):
+        """Show the zoomed image at once: the visible tiles if they are all cached,
+        else the tiles of the last view stretched without filtering, 
+        and request the high quality visible tiles (HBZoomRenderer).
+        """
+        q_label = self.hb_image_box_label
+        old_view = q_label.view
+        view = self._resized_view(self.image, q_label)
+        visible_rect = view.image_rect(q_label.visibleRegion().boundingRect())
+        missing = [
+            tile_index for tile_index in tile_indices(view.display_size, visible_rect)
+            if self._render_cache.get(view.generation, view.display_size, tile_index) is None
+        ]
+        if (not missing) or old_view is None or old_view.generation != view.generation:
+            #nothing to stretch, the visible tiles are rendered when painted.
+            self._zoom_renderer.cancel()
+            q_label.set_view(view)
+            return None
+
+        q_label.set_view(view, old_view)
+        self._zoom_renderer.request(self.image, view.display_size, visible_rect)
+
+
+    def _show_zoom_rendered(self, generation:int, display_size:tuple, tiles:list):
+        for tile_index, qimage in tiles:
+            self._render_cache.put(generation, display_size, tile_index, QPixmap.fromImage(qimage))
+        view = self.hb_image_box_label.view
+        if view is None or view.generation != generation or view.display_size != display_size:
+            return None
+        self.hb_image_box_label.end_preview()
+
+
+    def _show_url_preview(self, pil_image):
+        preview = HBImage(pil_image, filepath=self._url_loader.url)
+        if not self._is_url_preview:
+            #the first preview replaces the shown image, it cannot be edited until the download is complete.
+            #the shown image and its history are kept until then, and shown again if the download fails.
+            image, key = self._image, self._image_key
+            self._image_process_runner.cancel()
+            history = self._image_process_undo_stack.detach(image)
+            self._image_key = None
+            self._set_image(preview)
+            self._url_replaced = (image, key, history)
+            self._is_url_preview = True
+            self.update_widgets_enable(False)
+            return None
+        #the next previews keep the zoom and the scroll position.
+        self._image = preview
         self.update_image_box()
 
+    def _show_url_loaded(self, hb_image:'HBImage'):
+        if not self._is_url_preview:
+            self._set_image(hb_image)
+        else:
+            self._release_url_replaced()
+            self._is_url_preview = False
+            #no command may target the preview once the final image replaces it.
+            self._image_process_runner.cancel()
+            self._image_process_undo_stack.clear()
+            self._image = hb_image
+            self.update_image_box()
+            self.update_widgets_enable(self.is_image_exist)
+        self.image_loaded.emit()
+
+    def _url_load_failed(self, url:str, error_msg:str):
+        if self._is_url_preview:
+            #show the image the previews replaced again, with its history.
+            image, key, history = self._url_replaced
+            self._url_replaced = None
+            self._is_url_preview = False
+            self._image = image
+            self._image_key = key
+            self._image_process_undo_stack.attach(history)
+            self._display_mode = "original_size"
+            self._zoom_scale = 1
+            self.update_image_box()
+            self.update_widgets_enable(self.is_image_exist)
+        self._show_msg_box("Error!", f"{url} : {error_msg}")
+
+    def _release_url_replaced(self):
+        """The image replaced by the url previews will not be shown again, keep its history as _set_image() does."""
+        if self._url_replaced is None:
+            return None
+        _, key, history = self._url_replaced
+        self._url_replaced = None
+        if key is not None:
+            self._history_store.put(key, history)
+
 
 
 
     #----------------------image_process--------------------
     
     def _do_image_process(self, command):
-        if self.is_image_exist is False:
+        #a url preview is read-only, the shortcuts of the edit menu are active even when it is disabled.
+        if self.is_image_exist is False or self._is_url_preview:
+            return None
+        #the command is pushed by _push_image_process when its pixels are ready.
+        self._image_process_runner.submit(command)
+
+    def _push_image_process(self, command):
+        if isinstance(command, CommandUndoStep):
+            #the pixels of the step are prepared, the command only writes them.
+            if command.is_undo:
+                self._image_process_undo_stack.undo()
+            else:
+                self._image_process_undo_stack.redo()
             return None
         self._image_process_undo_stack.push(command)
         self.image_processed.emit()
 
+    def _image_process_failed(self, command, error_msg:str):
+        self._show_msg_box("Error!", f"{command.text()} : {error_msg}")
+
+    def _image_process_pending_changed(self, pending_count:int):
+        if pending_count:
+            self.hb_image_box_label.setCursor(Qt.BusyCursor)
+        else:
+            self.hb_image_box_label.unsetCursor()
+        self._update_undo_actions()
+
+    def _update_undo_actions(self):
+        #a process which is not finished yet can be undone (cancelled),
+        #and nothing can be redone before it is pushed (it clears the redo history).
+        #an undo/redo step which is not finished yet can not be cancelled.
+        pending_count = self._image_process_runner.pending_count
+        is_stepping = isinstance(self._image_process_runner.last_pending, CommandUndoStep)
+        self.actionUndo.setEnabled(not is_stepping and (pending_count>0 or self._image_process_undo_stack.canUndo()))
+        self.actionRedo.setEnabled(pending_count==0 and self._image_process_undo_stack.canRedo())
+
+    def _undo(self):
+        if self._is_url_preview or isinstance(self._image_process_runner.last_pending, CommandUndoStep):
+            return None
+        if self._image_process_runner.cancel_last():
+            return None
+        undo_stack = self._image_process_undo_stack
+        if not undo_stack.canUndo():
+            return None
+        command = undo_stack.command(undo_stack.index()-1)
+        if getattr(command, "prepares_steps", False):
+            self._image_process_runner.submit(CommandUndoStep(command, is_undo=True))
+        else:
+            undo_stack.undo()
+
+    def _redo(self):
+        if self._is_url_preview or self._image_process_runner.pending_count:
+            return None
+        undo_stack = self._image_process_undo_stack
+        if not undo_stack.canRedo():
+            return None
+        command = undo_stack.command(undo_stack.index())
+        if getattr(command, "prepares_steps", False):
+            self._image_process_runner.submit(CommandUndoStep(command, is_undo=False))
+        else:
+            undo_stack.redo()
+
     def _crop_image(self):
         self._do_image_process(CommandCropImage(self))
 
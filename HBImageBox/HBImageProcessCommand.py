@@ -1,11 +1,22 @@
 
 from PySide6.QtGui import QUndoCommand
 
-from HBImage import HBImage
+from HBImage import HBImage, HBImagePatch, HBTransform
 
 
 
 class CommandImageProcess(QUndoCommand):
+    """Base class of the image process commands.\n
+    Commands modify the image of the HBImageBox in place. A command whose process has an exact inverse
+    (flips, 90 degree rotations) undoes it by running the inverse and stores nothing,
+    the other commands keep an HBImagePatch of the pixels they replaced (self.patch).\n
+    A command with a prepare(source) method computes its pixels in a worker thread before the first redo()
+    (see HBCommandRunner), source is a snapshot of self.hb_image. The result is kept in self.processed,
+    and redo() only writes it into the image.
+    If its undo/redo must be prepared too (prepares_steps), HBImageBox submits them as CommandUndoStep.\n
+    The ROI a command processes is taken by capture_ROI(), again when HBCommandRunner starts it:
+    the commands submitted before it may have changed the image (e.g. crop clears the ROI).
+    """
     def __init__(self, _hb_image_box, *args):
         super().__init__(args[0])
         self.image_box = _hb_image_box
@@ -13,6 +24,28 @@ class CommandImageProcess(QUndoCommand):
         #Then this ROI will imply when redo was called.
         #(only "redo" action called)
         self.undo_ROI = None
+        self.patch:HBImagePatch = None
+        self.processed:HBImage = None
+
+    def capture_ROI(self):
+        """Take the ROI to process from the image, called by HBCommandRunner when the command starts."""
+        pass
+
+    def nbytes(self) -> int:
+        """Memory kept by this command for undo/redo, used by HBUndoStack."""
+        return self.patch.nbytes if self.patch else 0
+
+    def compress(self):
+        """Called by HBUndoStack (in a background thread) when this command is not likely to run soon."""
+        patch = self.patch
+        if patch:
+            patch.compress()
+
+    def spill(self, directory:str):
+        """Called by HBHistoryStore (in a background thread) when the image of this command is not shown."""
+        patch = self.patch
+        if patch:
+            patch.spill(directory)
 
     def redo(self):
         if self.undo_ROI:
@@ -31,15 +64,33 @@ class CommandImageProcess(QUndoCommand):
 
 #=============================================================================================
 class CommandCropImage(CommandImageProcess):
+    #only the ROI of a file that is not decoded yet is decoded, see HBImage.crop().
+    reads_region_only = True
+
     def __init__(self, _hb_image_box):
         super(CommandCropImage, self).__init__(_hb_image_box, "Crop")
 
-        self.pre_image:'HBImage' = _hb_image_box.image
+        self.hb_image:'HBImage' = _hb_image_box.image
+        self.capture_ROI()
         self.pre_zoom_scale = _hb_image_box.zoom_scale
 
+    def capture_ROI(self):
+        self.ROI = self.hb_image.ROI
+
+    def prepare(self, source:'HBImage'):
+        source.ROI = self.ROI
+        self.processed = source.crop()
+
     def redo(self):
-        super().redo()
-        self.image_box._image = self.pre_image.crop()
+        if self.patch:
+            self.patch = self.hb_image.restore(self.patch)
+            self.hb_image.ROI_clear()
+        else:
+            if self.processed is None:
+                self.prepare(self.hb_image)
+            self.patch = self.hb_image.replace(self.processed)
+            self.processed = None
+        self.image_box._image = self.hb_image
         
         if self.image_box.display_mode=="zoom":
             self.image_box._scale_label_size(self.image_box.image.size, self.image_box.zoom_scale)
@@ -48,45 +99,104 @@ class CommandCropImage(CommandImageProcess):
         self.image_box.hide_rubber_band()
 
     def undo(self):
-        self.image_box._image = self.pre_image
+        self.patch = self.hb_image.restore(self.patch)
+        self.hb_image.ROI = self.ROI
+        self.image_box._image = self.hb_image
         if self.image_box.display_mode=="zoom":
             self.image_box._scale_label_size(self.image_box.image.size, self.pre_zoom_scale)
 
         self.image_box.update_image_box()
-        super().undo()
+        self.image_box.show_ROI()
     
 #=============================================================================================
 
-class CommandFlipImage(CommandImageProcess):
-    def __init__(self, _hb_image_box, direction:str):
-        super().__init__(_hb_image_box, f"Flip {direction}")
+class CommandTransformImage(CommandImageProcess):
+    """Flips and 90 degree rotations of the whole image.\n
+    Consecutive transform commands are merged into one HBTransform, so undo/redo transposes the image once,
+    and the merged command is removed if the transforms cancel out.
+    Undo applies the inverse transform, no pixels are stored.
+    """
+    #same id for all transform commands, so the undo stack merges them.
+    COMMAND_ID = 1
+
+    def __init__(self, _hb_image_box, text:str, hb_transform:HBTransform):
+        super().__init__(_hb_image_box, text)
+        self.hb_image:'HBImage' = _hb_image_box.image
+        self.transform:HBTransform = hb_transform
+
+    def id(self) -> int:
+        return CommandTransformImage.COMMAND_ID
+
+    def mergeWith(self, other) -> bool:
+        if not isinstance(other, CommandTransformImage) or other.id() != self.id():
+            return False
+        if other.hb_image is not self.hb_image:
+            return False
+        self.transform = self.transform.then(other.transform)
+        texts = [f"Rotate {self.transform.rotation*90}"] if self.transform.rotation else []
+        if self.transform.flip:
+            texts.append("Flip H")
+        self.setText(" + ".join(reversed(texts)))
+        self.setObsolete(self.transform.is_identity)
+        return True
+
+    def _set_transformed_image(self):
+        self.image_box._image = self.hb_image
+        if self.transform.swaps_axes:
+            self.image_box._scale_label_size(self.image_box.image.size, self.image_box.zoom_scale)
+        self.image_box.hide_rubber_band()
+        self.image_box.update_image_box()
 
-        self.pre_ROI = _hb_image_box.image.ROI
+    def redo(self):
+        self.hb_image.transform(self.transform, in_place=True)
+        self._set_transformed_image()
 
+    def undo(self):
+        self.hb_image.transform(self.transform.inverse(), in_place=True)
+        self._set_transformed_image()
+
+
+
+#=============================================================================================
+
+class CommandFlipImage(CommandTransformImage):
+    def __init__(self, _hb_image_box, direction:str):
         #direction's value is "H" or "V"
         if direction!="H" and direction!="V":
             raise ValueError(f"direction's value should be 'H' or 'V', not {direction}")
+        hb_transform = HBTransform.flip_horizontal() if direction=="H" else HBTransform.flip_vertical()
+        super().__init__(_hb_image_box, f"Flip {direction}", hb_transform)
         self.direction = direction
 
-    def redo(self):
-        super().redo()
+        self.capture_ROI()
+
+    def capture_ROI(self):
+        #If ROI is set, only the ROI is flipped in place, flipping it again undoes it.
+        self.ROI = self.hb_image.ROI
+        self.is_ROI_flip:bool = not self.hb_image.is_ROI_empty
 
+    def id(self) -> int:
+        return -1 if self.is_ROI_flip else super().id()
+
+    def _flip_ROI(self):
+        self.hb_image.ROI = self.ROI
         if self.direction=="H":
-            self.image_box._image = self.image_box.image.filp_horizontal()
+            self.hb_image.filp_horizontal(in_place=True)
         elif self.direction=="V":
-            self.image_box._image = self.image_box.image.filp_vertical()
+            self.hb_image.filp_vertical(in_place=True)
+        self.image_box._image = self.hb_image
         self.image_box.update_image_box()
+        self.image_box.show_ROI()
+
+    def redo(self):
+        if not self.is_ROI_flip:
+            return super().redo()
+        self._flip_ROI()
         
     def undo(self):
-        self.image_box._image.ROI = self.pre_ROI
-
-        if self.direction=="H":
-            self.image_box._image = self.image_box.image.filp_horizontal()
-        elif self.direction=="V":
-            self.image_box._image = self.image_box.image.filp_vertical()
-
-        self.image_box.update_image_box()
-        super().undo()
+        if not self.is_ROI_flip:
+            return super().undo()
+        self._flip_ROI()
 
 
 
@@ -96,50 +206,99 @@ class CommandColorImage(CommandImageProcess):
     def __init__(self, _hb_image_box, color_process:str):
         super().__init__(_hb_image_box, f"Color {color_process}")
 
-        self.pre_image:'HBImage' = _hb_image_box.image
+        #the ROI (or the whole image) is processed in a worker thread (prepare) and written into the image.
+        #Invert is undone by inverting again, so it stores nothing: its undo and redo are prepared
+        #in the worker thread too (see CommandUndoStep), and put back the generation the pixels had.
+        #Gray keeps the replaced pixels (self.patch), so undo/redo never process the pixels again in the GUI thread.
+        self.hb_image:'HBImage' = _hb_image_box.image
+        self.capture_ROI()
 
         if color_process!="Gray" and color_process!="Invert":
             raise ValueError(f"direction's value should be 'Gray' or 'Invert', not {color_process}")
         self.color_process = color_process
-        
-    def redo(self):
-        super().redo()
+        #generations of the image before and after the first redo.
+        self.undo_generation:int = None
+        self.redo_generation:int = None
+
+    @property
+    def prepares_steps(self) -> bool:
+        """True if undo/redo need prepare() first, see CommandUndoStep."""
+        return self.color_process=="Invert"
+
+    def capture_ROI(self):
+        self.ROI = self.hb_image.ROI
+        self.is_ROI_process:bool = not self.hb_image.is_ROI_empty
+
+    def prepare(self, source:'HBImage'):
+        region_image = source.crop(self.ROI) if self.is_ROI_process else source.copy()
+        region_image.ROI_clear()
         if self.color_process=="Gray":
-            self.image_box._image = self.pre_image.to_gray()
+            self.processed = region_image.to_gray()
         elif self.color_process=="Invert":
-            self.image_box._image = self.pre_image.color_invert()
-
-        self.image_box.update_image_box()
+            self.processed = region_image.color_invert()
+        
+    def redo(self):
+        if self.color_process=="Invert":
+            self.undo_generation = self.hb_image.generation
+            self._write_processed(self.redo_generation)
+            self.redo_generation = self.hb_image.generation
+        elif self.patch:
+            self.patch = self.hb_image.restore(self.patch)
+        else:
+            self.patch = self._write_processed()
+        self._set_processed_image()
 
 
     def undo(self):
-        self.image_box._image = self.pre_image
+        if self.color_process=="Invert":
+            self._write_processed(self.undo_generation)
+        else:
+            self.patch = self.hb_image.restore(self.patch)
+        self._set_processed_image()
+
+    def _write_processed(self, generation:int=None) -> HBImagePatch:
+        if self.processed is None:
+            #not prepared by HBCommandRunner (e.g. the undo stack is used directly).
+            self.prepare(self.hb_image)
+        patch = self.hb_image.write(self.processed, self.ROI if self.is_ROI_process else None,
+                                    generation, keep_patch=self.color_process=="Gray")
+        self.processed = None
+        return patch
+
+    def _set_processed_image(self):
+        self.hb_image.ROI = self.ROI
+        self.image_box._image = self.hb_image
         self.image_box.update_image_box()
-        super().undo()
+        self.image_box.show_ROI()
 
 
 
 #=============================================================================================
 
-class CommandRotateImage(CommandImageProcess):
-    def __init__(self, _hb_image_box, angle:int):
-        super().__init__(_hb_image_box, f"Rotate {angle}")
-        
-        self.image_box = _hb_image_box
-        self.angle = angle
-        
-    def _set_rotated_image(self):
-        self.image_box._scale_label_size(self.image_box.image.size, self.image_box.zoom_scale)
-        self.image_box.hide_rubber_band()
-        self.image_box.update_image_box()   
+class CommandUndoStep:
+    """The undo (or redo) of a command whose prepares_steps is True, submitted to HBCommandRunner like a command.\n
+    The pixels of the step are computed by command.prepare() in the worker thread,
+    HBImageBox runs the step on the undo stack when the runner delivers it, and command.undo()/redo() only writes them.
+    """
+    def __init__(self, command:CommandImageProcess, is_undo:bool):
+        self.command:CommandImageProcess = command
+        self.is_undo:bool = is_undo
+        self.hb_image:'HBImage' = command.hb_image
+
+    def text(self) -> str:
+        return f"{'Undo' if self.is_undo else 'Redo'} {self.command.text()}"
+
+    def prepare(self, source:'HBImage'):
+        self.command.prepare(source)
 
-    def redo(self):
-        self.image_box._image = self.image_box.image.rotate(self.angle)
-        self._set_rotated_image()
 
-    def undo(self):
-        self.image_box._image = self.image_box.image.rotate(360-self.angle)
-        self._set_rotated_image()
+
+#=============================================================================================
+
+class CommandRotateImage(CommandTransformImage):
+    def __init__(self, _hb_image_box, angle:int):
+        super().__init__(_hb_image_box, f"Rotate {angle}", HBTransform.rotate(angle))
+        self.angle = angle
 
 
 
@@ -151,20 +310,32 @@ class CommandDrawImage(CommandImageProcess):
         super().__init__(_hb_image_box, f"Draw {color} {shape}")
         self.color = color
         self.shape = shape
-        self.draw_area = self.image_box._image.ROI
-        self.pre_image:'HBImage' = _hb_image_box.image
+        #the shape is drawn in place, only the pixels under it are kept for undo/redo.
+        self.hb_image:'HBImage' = _hb_image_box.image
+        self.capture_ROI()
+
+    def capture_ROI(self):
+        self.draw_area = self.hb_image.ROI
 
 
     def redo(self):
         #super().redo()
-        if self.shape == "Rect":
-            self.image_box._image = self.image_box.image.copy()
-            self.image_box._image.draw_rect(rect=self.draw_area, outline_color=self.color)
-            
+        if self.patch:
+            self.patch = self.hb_image.restore(self.patch)
+        elif self.shape == "Rect":
+            x0, y0, x1, y1 = self.draw_area
+            width, height = self.hb_image.size
+            #the outline includes x1 and y1.
+            self.patch = self.hb_image.patch((x0, y0, min(x1+1, width), min(y1+1, height)))
+            self.hb_image.ROI = self.draw_area
+            self.hb_image.draw_rect(rect=self.draw_area, outline_color=self.color)
+
+        self.image_box._image = self.hb_image
         self.image_box.update_image_box()
 
     def undo(self):
-        self.image_box._image = self.pre_image
+        self.patch = self.hb_image.restore(self.patch)
+        self.image_box._image = self.hb_image
         self.image_box.update_image_box()
         #super().undo()
 
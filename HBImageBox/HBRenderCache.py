@@ -0,0 +1,150 @@
+"""
+HBRenderCache keeps the tiles (QPixmaps of TILE_SIZE x TILE_SIZE) that HBImageBox paints,
+so painting an image again (scrolling, resizeEvent, page flip, undo back to a shown state)
+does not convert PIL.Image to QPixmap again, and only the tiles that are painted are ever rendered.\n
+A tile is keyed by the generation of the HBImage (see HBImage.generation), the displayed size of the whole image,
+and the tile index, a modified image has a new generation, so it never gets the tiles of its old pixels.
+The cache is limited by the number of bytes of its tiles, the least recently used are removed first.
+Pixmaps can only be created in the GUI thread, so the cache is not thread-safe,
+tiles rendered in other threads (render_tile) are added by put().
+
+Require package:
+1. Pyside
+2. PIL
+"""
+
+from typing import List
+from collections import OrderedDict
+
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QPixmap, QImage
+
+from HBImage import HBImage, HBPyramid
+from HBImage.HBQtBridge import pil_to_qimage
+
+
+
+TILE_SIZE = 256
+
+
+
+def tile_box(display_size:tuple, tile_index:tuple) -> tuple:
+    """Return the region (x0, y0, x1, y1) of tile_index, in the displayed image."""
+    tile_x, tile_y = tile_index
+    x0, y0 = tile_x*TILE_SIZE, tile_y*TILE_SIZE
+    return (x0, y0, min(x0+TILE_SIZE, display_size[0]), min(y0+TILE_SIZE, display_size[1]))
+
+
+def tile_indices(display_size:tuple, rect:QRect) -> List[tuple]:
+    """Return the indices of the tiles of the displayed image that intersect rect."""
+    width, height = display_size
+    x0, y0 = max(rect.left(), 0), max(rect.top(), 0)
+    x1, y1 = min(rect.right(), width-1), min(rect.bottom(), height-1)
+    if x0 > x1 or y0 > y1:
+        return []
+    return [
+        (tile_x, tile_y)
+        for tile_y in range(y0//TILE_SIZE, y1//TILE_SIZE+1)
+        for tile_x in range(x0//TILE_SIZE, x1//TILE_SIZE+1)
+    ]
+
+
+def render_tile(pyramid:HBPyramid, display_size:tuple, tile_index:tuple) -> QImage:
+    """Render a tile of the image of pyramid displayed at display_size. Can run in any thread."""
+    return pil_to_qimage(pyramid.render(display_size, tile_box(display_size, tile_index)))
+
+
+
+
+class HBRenderCache:
+
+    def __init__(self, max_bytes:int = 128*1024*1024):
+        self._tiles:OrderedDict = OrderedDict()
+        self._nbytes:int = 0
+        self._max_bytes:int = max_bytes
+        self._hits:int = 0
+        self._misses:int = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value:int):
+        self._max_bytes = int(value)
+        self._evict()
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        """Number of tiles rendered (converted to QPixmap) by tile()."""
+        return self._misses
+
+
+    def tile(self, hb_image:HBImage, display_size:tuple, tile_index:tuple) -> QPixmap:
+        """Return the tile tile_index of hb_image displayed at display_size, rendered if it is not cached.
+
+        Args:
+            hb_image (HBImage)
+            display_size (tuple(int,int)): size of the whole displayed image.
+            tile_index (tuple(int,int)): column and row of the tile.
+        """
+        generation = hb_image.generation
+        pixmap = self.get(generation, display_size, tile_index)
+        if pixmap is not None:
+            return pixmap
+
+        self._misses += 1
+        pixmap = QPixmap.fromImage(render_tile(hb_image.pyramid, tuple(display_size), tile_index))
+        self.put(generation, display_size, tile_index, pixmap)
+        return pixmap
+
+
+    def get(self, generation:int, display_size:tuple, tile_index:tuple) -> QPixmap:
+        """Return the cached tile, None if it is not cached."""
+        key = (generation, tuple(display_size), tuple(tile_index))
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._hits += 1
+            self._tiles.move_to_end(key)
+        return pixmap
+
+
+    def put(self, generation:int, display_size:tuple, tile_index:tuple, pixmap:QPixmap):
+        """Cache a tile rendered somewhere else (e.g. HBZoomRenderer)."""
+        key = (generation, tuple(display_size), tuple(tile_index))
+        if key in self._tiles:
+            self._nbytes -= self._pixmap_nbytes(self._tiles[key])
+        self._tiles[key] = pixmap
+        self._tiles.move_to_end(key)
+        self._nbytes += self._pixmap_nbytes(pixmap)
+        self._evict()
+
+
+    def clear(self):
+        self._tiles.clear()
+        self._nbytes = 0
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _pixmap_nbytes(self, pixmap:QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
+    def _evict(self):
+        #the most recently used tile is kept even if it is bigger than max_bytes.
+        while self._nbytes > self._max_bytes and len(self._tiles) > 1:
+            _, pixmap = self._tiles.popitem(last=False)
+            self._nbytes -= self._pixmap_nbytes(pixmap)
@@ -0,0 +1,85 @@
+"""
+HBTileView paints an HBImage displayed at a size (e.g. zoomed) on HBImageBoxLabel,
+tile by tile (see HBRenderCache), and only the tiles in the painted rect,
+so the memory and time of painting depend on the viewport, not on the displayed size.
+
+Require package:
+1. Pyside
+2. HBImage
+"""
+
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QPainter
+
+from HBImage import HBImage
+from .HBRenderCache import HBRenderCache, TILE_SIZE, tile_indices
+
+
+
+class HBTileView:
+
+    def __init__(self, hb_image:HBImage, display_size:tuple, render_cache:HBRenderCache, offset:tuple=(0, 0)):
+        """
+        Args:
+            hb_image (HBImage)
+            display_size (tuple(int,int)): size of the whole displayed image.
+            render_cache (HBRenderCache): where the tiles are kept.
+            offset (tuple(int,int), optional): position of the image in the widget. Defaults to (0, 0).
+        """
+        self._hb_image:HBImage = hb_image
+        self._generation:int = hb_image.generation
+        self._display_size:tuple = tuple(display_size)
+        self._render_cache:HBRenderCache = render_cache
+        self._offset:tuple = tuple(offset)
+
+    @property
+    def hb_image(self) -> HBImage:
+        return self._hb_image
+
+    @property
+    def generation(self) -> int:
+        """Generation of the image when the view was created."""
+        return self._generation
+
+    @property
+    def display_size(self) -> tuple:
+        return self._display_size
+
+    @property
+    def offset(self) -> tuple:
+        return self._offset
+
+    @property
+    def is_outdated(self) -> bool:
+        """True if the image was modified after the view was created."""
+        return self._hb_image.generation != self._generation
+
+
+    def image_rect(self, rect:QRect) -> QRect:
+        """Map rect from the widget to the displayed image."""
+        return rect.translated(-self._offset[0], -self._offset[1])
+
+
+    def paint(self, painter:QPainter, rect:QRect, render_missing:bool=True) -> list:
+        """Paint the tiles that intersect rect (in widget coordinates).
+
+        Args:
+            painter (QPainter)
+            rect (QRect)
+            render_missing (bool, optional): render the tiles that are not cached,
+            else they are not painted. Defaults to True.
+
+        Returns:
+            list: indices of the tiles that were not painted.
+        """
+        missing = []
+        x_offset, y_offset = self._offset
+        for tile_index in tile_indices(self._display_size, self.image_rect(rect)):
+            pixmap = self._render_cache.get(self._generation, self._display_size, tile_index)
+            if pixmap is None:
+                if (not render_missing) or self.is_outdated:
+                    missing.append(tile_index)
+                    continue
+                pixmap = self._render_cache.tile(self._hb_image, self._display_size, tile_index)
+            painter.drawPixmap(x_offset + tile_index[0]*TILE_SIZE, y_offset + tile_index[1]*TILE_SIZE, pixmap)
+        return missing
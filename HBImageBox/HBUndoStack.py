@@ -0,0 +1,239 @@
+"""
+HBUndoStack is the undo history of HBImageBox, with the same API as "PySide6.QtGui.QUndoStack"
+(push, undo, redo, canUndo, canRedo, clear and their signals), and it runs the same QUndoCommand objects,
+including id()/mergeWith() merging and obsolete commands.\n
+Unlike QUndoStack, the history is limited by the memory its commands keep (command.nbytes()),
+not by the number of commands, so a small image can have a long history and a huge image a short one.
+The commands that are not next to the current state are "cold",
+they are asked to compress their data (command.compress()) in a background thread.\n
+The history can be detached as an HBUndoHistory (e.g. when the HBImageBox shows another image),
+and attached again later, see HBHistoryStore.
+"""
+
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtGui import QUndoCommand
+
+
+
+class HBUndoHistory:
+    """The commands of an HBUndoStack detached from it, with the image they modify."""
+
+    def __init__(self, commands:List[QUndoCommand], index:int, image=None):
+        """
+        Args:
+            commands (List[QUndoCommand])
+            index (int): number of commands done.
+            image (HBImage, optional): the image the commands modify.
+        """
+        self.commands:List[QUndoCommand] = commands
+        self.index:int = index
+        self.image = image
+
+    def __len__(self):
+        return len(self.commands)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory kept by all the commands."""
+        return sum(_command_nbytes(command) for command in self.commands)
+
+
+    def compress(self):
+        """Compress the data of all the commands. Thread safe."""
+        for command in self.commands:
+            compress = getattr(command, "compress", None)
+            if compress:
+                compress()
+
+    def spill(self, directory:str):
+        """Move the data of all the commands to files in directory. Thread safe."""
+        for command in self.commands:
+            spill = getattr(command, "spill", None)
+            if spill:
+                spill(directory)
+
+
+
+class HBUndoStack(QObject):
+
+    #signal
+    canUndoChanged:Signal = Signal(bool)
+    canRedoChanged:Signal = Signal(bool)
+    indexChanged:Signal = Signal(int)
+
+    def __init__(self, max_bytes:int=512*1024*1024, parent:QObject=None):
+        """
+        Args:
+            max_bytes (int, optional): memory budget of the history.
+            The oldest commands are removed when it is exceeded, the last command is always kept. Defaults to 512 MB.
+            parent (QObject, optional)
+        """
+        super().__init__(parent)
+        self._commands:List[QUndoCommand] = []
+        #number of commands done, self._commands[self._index:] can be redone.
+        self._index:int = 0
+        self._max_bytes:int = max_bytes
+        self._compress_executor = ThreadPoolExecutor(1, thread_name_prefix="HBUndoStack")
+
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value:int):
+        self._max_bytes = value
+        self._apply_budget()
+
+    @property
+    def nbytes(self) -> int:
+        """Memory kept by all the commands."""
+        return sum(_command_nbytes(command) for command in self._commands)
+
+
+    def count(self) -> int:
+        return len(self._commands)
+
+    def index(self) -> int:
+        return self._index
+
+    def canUndo(self) -> bool:
+        return self._index > 0
+
+    def canRedo(self) -> bool:
+        return self._index < len(self._commands)
+
+    def command(self, idx:int) -> QUndoCommand:
+        return self._commands[idx]
+
+    def text(self, idx:int) -> str:
+        return self._commands[idx].text()
+
+    def undoText(self) -> str:
+        return self._commands[self._index-1].text() if self.canUndo() else ""
+
+    def redoText(self) -> str:
+        return self._commands[self._index].text() if self.canRedo() else ""
+
+
+    def push(self, command:QUndoCommand):
+        """Run command.redo() and add it to the history, the commands that could be redone are removed.\n
+        If command has the same id() (not -1) as the last command, and last.mergeWith(command) returns True,
+        they are merged (and removed if the merged command is obsolete).
+        """
+        state = self._state()
+        command.redo()
+        del self._commands[self._index:]
+
+        last = self._commands[-1] if self._commands else None
+        if (last is not None and command.id() != -1 and last.id() == command.id()
+                and last.mergeWith(command)):
+            if last.isObsolete():
+                self._commands.pop()
+        elif not command.isObsolete():
+            self._commands.append(command)
+
+        self._index = len(self._commands)
+        self._apply_budget()
+        self._compress_cold_commands()
+        self._emit_changes(state)
+
+
+    def undo(self):
+        if not self.canUndo():
+            return None
+        state = self._state()
+        self._index -= 1
+        command = self._commands[self._index]
+        command.undo()
+        if command.isObsolete():
+            del self._commands[self._index]
+        self._compress_cold_commands()
+        self._emit_changes(state)
+
+
+    def redo(self):
+        if not self.canRedo():
+            return None
+        state = self._state()
+        command = self._commands[self._index]
+        command.redo()
+        if command.isObsolete():
+            del self._commands[self._index]
+        else:
+            self._index += 1
+        self._compress_cold_commands()
+        self._emit_changes(state)
+
+
+    def clear(self):
+        state = self._state()
+        self._commands.clear()
+        self._index = 0
+        self._emit_changes(state)
+
+
+    def detach(self, image=None) -> HBUndoHistory:
+        """Take all the commands out of the stack (it becomes empty) and return them.
+
+        Args:
+            image (HBImage, optional): the image the commands modify, kept in the history.
+        """
+        state = self._state()
+        history = HBUndoHistory(self._commands, self._index, image)
+        self._commands = []
+        self._index = 0
+        self._emit_changes(state)
+        return history
+
+
+    def attach(self, history:HBUndoHistory):
+        """Replace the commands of the stack by the commands of history (from detach())."""
+        state = self._state()
+        self._commands = list(history.commands)
+        self._index = history.index
+        self._apply_budget()
+        self._emit_changes(state)
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _apply_budget(self):
+        """Remove the oldest commands until the history fits in max_bytes."""
+        while self._index > 1 and self.nbytes > self._max_bytes:
+            self._commands.pop(0)
+            self._index -= 1
+
+
+    def _compress_cold_commands(self):
+        """Compress the commands that are not the next undo or redo."""
+        for i, command in enumerate(self._commands):
+            if i in (self._index-1, self._index):
+                continue
+            compress = getattr(command, "compress", None)
+            if compress:
+                self._compress_executor.submit(compress)
+
+
+    def _state(self) -> tuple:
+        return (self.canUndo(), self.canRedo(), self._index)
+
+
+    def _emit_changes(self, pre_state:tuple):
+        can_undo, can_redo, index = pre_state
+        if can_undo != self.canUndo():
+            self.canUndoChanged.emit(self.canUndo())
+        if can_redo != self.canRedo():
+            self.canRedoChanged.emit(self.canRedo())
+        if index != self._index:
+            self.indexChanged.emit(self._index)
+
+
+
+def _command_nbytes(command:QUndoCommand) -> int:
+    nbytes = getattr(command, "nbytes", None)
+    return nbytes() if nbytes else 0
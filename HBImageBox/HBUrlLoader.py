@@ -0,0 +1,115 @@
+"""
+HBUrlLoader downloads an image url in a worker thread and shows it while it arrives.\n
+The bytes are decoded as they are downloaded (see HBImage.load_progressive and HBProgressiveDecoder):
+the pixels decoded so far (the low resolution scans of a progressive JPEG, the first rows of a PNG or a baseline JPEG)
+are delivered to the GUI thread by the signal "preview_ready", long before the download is finished,
+then the whole image by the signal "loaded".
+A new load() or cancel() stops the download in progress (its previews and result are dropped).
+
+Require package:
+1. Pyside
+2. HBImage
+"""
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+
+from HBImage import HBImage
+
+
+
+class HBUrlLoader(QObject):
+
+    #signal
+    preview_ready:Signal = Signal(object)   #PIL.Image of the pixels decoded so far
+    loaded:Signal = Signal(object)          #HBImage
+    failed:Signal = Signal(str, str)        #url, error message
+
+    #emitted from the worker thread, received in the thread of the loader (GUI thread).
+    _preview:Signal = Signal(int, object)
+    _done:Signal = Signal(int, object, object)
+
+
+    def __init__(self, preview_interval:float=0.25, parent:QObject=None):
+        """
+        Args:
+            preview_interval (float, optional): min seconds between two previews. Defaults to 0.25.
+            parent (QObject, optional)
+        """
+        super().__init__(parent)
+        self.preview_interval:float = preview_interval
+        self._url:str = None
+        #increased by every load() and cancel(), the previews and result of an older epoch are dropped.
+        self._epoch:int = 0
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="HBUrlLoader")
+
+        self._preview.connect(self._on_preview)
+        self._done.connect(self._on_done)
+
+
+    @property
+    def is_loading(self) -> bool:
+        return self._url is not None
+
+    @property
+    def url(self) -> str:
+        """The url being loaded, None if no load is in progress."""
+        return self._url
+
+
+    def load(self, url:str, preview_size:tuple=None):
+        """Download url, "preview_ready" is emitted while it arrives, then "loaded" (or "failed").
+
+        Args:
+            url (str)
+            preview_size (tuple(int,int), optional): size the previews are shown at. Defaults to None.
+        """
+        self._epoch += 1
+        self._url = url
+        self._executor.submit(self._load, self._epoch, url, preview_size)
+
+
+    def cancel(self):
+        self._epoch += 1
+        self._url = None
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _load(self, epoch:int, url:str, preview_size:tuple):
+        """Run in the worker thread."""
+        if epoch != self._epoch:
+            return None
+        try:
+            hb_image = HBImage.load_progressive(
+                url,
+                lambda pil_image: self._preview.emit(epoch, pil_image),
+                preview_size,
+                self.preview_interval,
+                lambda: epoch != self._epoch
+            )
+        except CancelledError:
+            return None
+        except Exception as e:
+            self._done.emit(epoch, None, e)
+            return None
+        self._done.emit(epoch, hb_image, None)
+
+
+    def _on_preview(self, epoch:int, pil_image):
+        if epoch != self._epoch:
+            return None
+        self.preview_ready.emit(pil_image)
+
+
+    def _on_done(self, epoch:int, hb_image:HBImage, error:Exception):
+        if epoch != self._epoch:
+            return None
+        url = self._url
+        self._url = None
+        if error is not None:
+            self.failed.emit(url, str(error))
+        else:
+            self.loaded.emit(hb_image)
@@ -0,0 +1,109 @@
+"""
+HBZoomRenderer renders the high quality tiles of an interactive zoom in a worker thread.\n
+While the wheel is turning, HBImageBox only shows a fast preview (the tiles of the previous zoom stretched without filtering),
+and asks the renderer for the tiles of the visible region with request().
+The requests are coalesced: the rendering starts only when no request came for "delay_ms" milliseconds,
+and a new request cancels the rendering in progress (it stops between tiles, and its result is dropped when it arrives).
+The tiles are resampled from the pyramid of the HBImage (see HBPyramid and HBRenderCache.render_tile),
+and delivered back to the GUI thread as QImages by the signal "rendered".
+
+Require package:
+1. Pyside
+2. HBImage
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, QRect, QTimer, Signal
+
+from HBImage import HBImage, HBPyramid
+from .HBRenderCache import render_tile, tile_indices
+
+
+
+class HBZoomRenderer(QObject):
+
+    #signal
+    rendered:Signal = Signal(int, object, object)   #generation, display size, list of (tile index, QImage)
+
+    #emitted from the worker thread, received in the thread of the renderer (GUI thread).
+    _done:Signal = Signal(int, int, object, object)
+
+
+    def __init__(self, delay_ms:int=120, parent:QObject=None):
+        """
+        Args:
+            delay_ms (int, optional): time without request before rendering. Defaults to 120.
+            parent (QObject, optional)
+        """
+        super().__init__(parent)
+        #(pyramid, generation, display size, tile indices) of the last request.
+        self._request:tuple = None
+        #increased by every request and cancel(), a result of an older epoch is dropped.
+        self._epoch:int = 0
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="HBZoomRenderer")
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay_ms)
+        self._timer.timeout.connect(self._render)
+        self._done.connect(self._on_done)
+
+
+    @property
+    def delay_ms(self) -> int:
+        return self._timer.interval()
+
+    @delay_ms.setter
+    def delay_ms(self, value:int):
+        self._timer.setInterval(value)
+
+
+    def request(self, hb_image:HBImage, display_size:tuple, rect:QRect):
+        """Render the tiles of hb_image displayed at display_size that intersect rect, 
+        when no other request comes for delay_ms.
+
+        Args:
+            hb_image (HBImage)
+            display_size (tuple(int,int)): size of the whole displayed image.
+            rect (QRect): the visible region, in the displayed image.
+        """
+        self._epoch += 1
+        display_size = tuple(display_size)
+        #the pyramid is taken now, hb_image may be modified before the rendering starts.
+        self._request = (hb_image.pyramid, hb_image.generation, display_size, tile_indices(display_size, rect))
+        self._timer.start()
+
+
+    def cancel(self):
+        self._epoch += 1
+        self._request = None
+        self._timer.stop()
+
+
+
+    #--------------private fuctions------------------------------
+
+    def _render(self):
+        if self._request is None:
+            return None
+        request = self._request
+        self._request = None
+        self._executor.submit(self._render_tiles, self._epoch, *request)
+
+
+    def _render_tiles(self, epoch:int, pyramid:HBPyramid, generation:int, display_size:tuple, indices:list):
+        """Run in the worker thread."""
+        tiles = []
+        for tile_index in indices:
+            if epoch != self._epoch:
+                return None
+            tiles.append((tile_index, render_tile(pyramid, display_size, tile_index)))
+        self._done.emit(epoch, generation, display_size, tiles)
+
+
+    def _on_done(self, epoch:int, generation:int, display_size:tuple, tiles:list):
+        if epoch != self._epoch:
+            #a newer request came.
+            return None
+        self.rendered.emit(generation, display_size, tiles)
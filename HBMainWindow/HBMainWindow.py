@@ -31,7 +31,9 @@ class HBMainWindow(QMainWindow, _HBMainWindowMethods):
 
 
     def init_declare_members(self):
-        self.hb_album = HBAlbum()
+        self.hb_album = HBAlbum(lazy=True)
+        self.hb_album.start_prefetch()
+        self.album_loader = None
 
         self.btns_menu = [
             self.ui.btnImageInfos,
@@ -68,7 +70,7 @@ class HBMainWindow(QMainWindow, _HBMainWindowMethods):
         """
         self.ui.hb_image_box.image_removed.connect(self._remove_image)
         self.ui.hb_image_box.image_loaded.connect(self._add_image)
-        self.ui.hb_image_box.image_processed.connect(self._update_label_image_info)
+        self.ui.hb_image_box.image_processed.connect(self._on_image_processed)
         
 
         self.ui.widgetWindowMove.mousePressEvent = self._move_window_mouse_press
@@ -144,6 +146,7 @@ class HBMainWindow(QMainWindow, _HBMainWindowMethods):
             QMessageBox.No)
 
         if reply == QMessageBox.Yes:
+            self._cancel_load_images()
             event.accept()
         else:
             event.ignore()
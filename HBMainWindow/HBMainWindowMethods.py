@@ -20,6 +20,7 @@ from PySide6.QtWidgets import (
 
 
 from HBImageBox import HBImageBox
+from HBImageBox.HBAlbumLoader import HBAlbumLoader
 from HBImage import HBImage, HBAlbum
 from HBDialogLoad import HBDialogLoad
 
@@ -33,6 +34,7 @@ class _HBMainWindowMethods:
         self.ui.hb_image_box:HBImageBox
         self.ui.hb_image_box.is_image_exist:bool
         self.hb_album:HBAlbum
+        self.album_loader:HBAlbumLoader
         self.need_update_widget:tuple
         ...
     
@@ -95,12 +97,19 @@ class _HBMainWindowMethods:
 
     def _update(self, widgets_enable):
         if self.hb_album.is_empty is False:
-            self.ui.hb_image_box.set_image(self.hb_album.marked_image)
+            self.ui.hb_image_box.set_image(self.hb_album.marked_image, self.hb_album.marked_key)
 
         self._update_widgets_enable(widgets_enable)
         self._update_label_image_info()
 
 
+    def _on_image_processed(self):
+        #the album keeps the edited image, so its history can be restored when the image is shown again.
+        if not self.hb_album.is_empty:
+            self.hb_album[self.hb_album.bookmark] = self.ui.hb_image_box.image
+        self._update_label_image_info()
+
+
     def _update_widgets_enable(self, enable):
         if not self.ui.hb_image_box.is_image_exist:
             return None
@@ -137,21 +146,50 @@ class _HBMainWindowMethods:
 
 
     def _load_images(self, filepaths):
-        """Load multiple images.\n
+        """Load multiple images in background.\n
+        The first loaded image is shown immediately, the others are added to the album when they are loaded.\n
         Args:
             filepaths (list[str]): image files' path or url.
         """
+        self._cancel_load_images()
+        self.album_loader = HBAlbumLoader(self.hb_album, filepaths)
+        self._is_first_image_loaded = False
+        self.album_loader.image_loaded.connect(self._on_album_image_loaded)
+        self.album_loader.progress.connect(self._on_album_load_progress)
+        self.album_loader.finished.connect(self._on_album_load_finished)
         try:
-            if self.hb_album.is_empty:
-                self.hb_album.load(filepaths)
-                self.hb_album.bookmark=0
-            else:
-                temp_album = HBAlbum(filepaths)
-                self.hb_album.merge(temp_album)
-                self.hb_album.bookmark = len(self.hb_album)-1
-            self._update(True)
+            self.album_loader.start()
         except Exception as e:
             self.ui.hb_image_box._show_msg_box('Error!', e)
+            return None
+
+
+    def _cancel_load_images(self):
+        if self.album_loader and not self.album_loader.is_finished:
+            self.album_loader.cancel()
+
+
+    def _on_album_image_loaded(self, index:int):
+        if not self._is_first_image_loaded:
+            self._is_first_image_loaded = True
+            self.hb_album.bookmark = index
+            self._update(True)
+            return None
+        #the index of the shown image may be changed by images inserted before it.
+        self._update_widgets_enable(True)
+        self._update_label_image_info()
+
+
+    def _on_album_load_progress(self, finished_count:int, total:int):
+        self.ui.btnLoad.setText(f"Load {finished_count}/{total}")
+
+
+    def _on_album_load_finished(self):
+        self.ui.btnLoad.setText("Load")
+        failed = self.album_loader.failed
+        if failed and not self.album_loader.is_cancelled:
+            failed_msgs = [f"{source} : {error}" for source, error in failed]
+            self.ui.hb_image_box._show_msg_box('Error!', "\n".join(failed_msgs))
 
 
     def _add_image(self):
@@ -167,6 +205,7 @@ class _HBMainWindowMethods:
         if self.hb_album.is_empty:
             raise FileNotFoundError("Try to remove nothing.")
         
+        self.ui.hb_image_box.forget_history(self.hb_album.marked_key)
         self.hb_album.delete(self.hb_album.bookmark)
         
 
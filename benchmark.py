@@ -0,0 +1,186 @@
+"""
+Benchmarks of HBImage.\n
+How to use:\n
+    python benchmark.py decode [--folder FOLDER] [--count 16] [--size 4000 3000]
+    python benchmark.py roi [--size 8000 6000] [--roi 64 256 1024 4096]
+    python benchmark.py qt [--size 4000 3000] [--modes RGB RGBA L]
+
+If no folder is given, test images are generated in a temporary folder.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from PIL import Image
+
+from HBImage import HBAlbum, HBImage, HBCommon
+from HBImage.HBProcessDecoder import shared_process_decoder
+
+
+
+def make_test_images(folder_path:str, count:int, size:tuple, format:str="png") -> list:
+    """Save count noise images (hard to compress, slow to decode) into folder_path."""
+    filepaths = []
+    for i in range(count):
+        filepath = os.path.join(folder_path, f"bench_{i}.{format}")
+        if not os.path.exists(filepath):
+            Image.effect_noise(size, 64).convert("RGB").save(filepath)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def print_table(rows:list):
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+
+#-----------------benchmarks------------------------------
+
+def bench_decode(filepaths:list, repeat:int=3):
+    """Compare HBAlbum loads with decode_backend="thread" and "process"."""
+    rows = [("backend", "best seconds", "images/s", "decode busy seconds")]
+    for backend in ("thread", "process"):
+        if backend == "process":
+            #start the worker processes before timing.
+            HBAlbum(filepaths[:1], decode_backend="process")
+
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            album = HBAlbum(filepaths, decode_backend=backend)
+            seconds = time.perf_counter() - start_time
+            if best is None or seconds < best[0]:
+                best = (seconds, album.pipeline.metrics)
+            del album
+
+        seconds, metrics = best
+        rows.append((backend, f"{seconds:.3f}", f"{len(filepaths)/seconds:.1f}", f"{metrics['decode_seconds']:.3f}"))
+
+    shared_process_decoder().shutdown()
+    print(f"cpu cores: {os.cpu_count()}, images: {len(filepaths)}")
+    print_table(rows)
+
+
+def bench_roi(size:tuple, roi_sides:list, repeat:int=3):
+    """Compare an ROI process that returns a new image with the in-place ROI process (and its undo)."""
+    hb_image = HBImage(Image.effect_noise(size, 64).convert("RGB"))
+    rows = [("roi", "roi / image", "new image s", "in place s", "undo s", "copied MB (new / in place)")]
+    for side in roi_sides:
+        hb_image.ROI = (0, 0, side, side)
+        ratio = (side*side) / (size[0]*size[1])
+
+        HBImage.reset_copy_stats()
+        new_seconds = _best_seconds(repeat, hb_image.color_invert)
+        new_bytes = HBImage.copy_stats()["color_invert"]["bytes"] / repeat
+
+        HBImage.reset_copy_stats()
+        in_place_seconds = undo_seconds = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            patch = hb_image.color_invert(in_place=True)
+            seconds = time.perf_counter() - start_time
+            in_place_seconds = seconds if in_place_seconds is None else min(in_place_seconds, seconds)
+
+            start_time = time.perf_counter()
+            hb_image.restore(patch)
+            seconds = time.perf_counter() - start_time
+            undo_seconds = seconds if undo_seconds is None else min(undo_seconds, seconds)
+        in_place_bytes = HBImage.copy_stats()["color_invert"]["bytes"] / repeat
+
+        rows.append((
+            f"{side}x{side}", f"{ratio:.4%}",
+            f"{new_seconds:.4f}", f"{in_place_seconds:.5f}", f"{undo_seconds:.5f}",
+            f"{new_bytes/1e6:.1f} / {in_place_bytes/1e6:.1f}"
+        ))
+
+    print(f"image: {size[0]}x{size[1]}")
+    print_table(rows)
+
+
+def bench_qt(size:tuple, modes:list, repeat:int=3):
+    """Compare PIL.ImageQt with HBQtBridge, in both directions (PIL.Image -> QImage -> PIL.Image)."""
+    from PIL import ImageQt
+    from PySide6.QtGui import QGuiApplication, QImage
+    from HBImage.HBQtBridge import pil_to_qimage, qimage_to_pil
+
+    app = QGuiApplication.instance() or QGuiApplication([])
+    source = Image.effect_noise(size, 64).convert("RGB")
+    rows = [("source", "to QImage: ImageQt s", "bridge s", "from QImage: ImageQt s", "bridge s")]
+    for mode in modes:
+        pil_image = source.convert(mode)
+        qimage = QImage(pil_to_qimage(pil_image))
+        rows.append((
+            mode,
+            f"{_best_seconds(repeat, lambda: ImageQt.ImageQt(pil_image)):.4f}",
+            f"{_best_seconds(repeat, lambda: pil_to_qimage(pil_image)):.4f}",
+            f"{_best_seconds(repeat, lambda: ImageQt.fromqimage(qimage)):.4f}",
+            f"{_best_seconds(repeat, lambda: qimage_to_pil(qimage)):.4f}"
+        ))
+
+    #the format of most clipboard images.
+    qimage = QImage(pil_to_qimage(source)).convertToFormat(QImage.Format_ARGB32)
+    rows.append((
+        "clipboard ARGB32", "", "",
+        f"{_best_seconds(repeat, lambda: ImageQt.fromqimage(qimage)):.4f}",
+        f"{_best_seconds(repeat, lambda: qimage_to_pil(qimage)):.4f}"
+    ))
+
+    print(f"image: {size[0]}x{size[1]}")
+    print_table(rows)
+
+
+def _best_seconds(repeat:int, function) -> float:
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start_time
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of HBImage.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    decode_parser = subparsers.add_parser("decode", help="thread vs process decode backend of HBAlbum.")
+    decode_parser.add_argument("--folder", help="folder of images to load.")
+    decode_parser.add_argument("--count", type=int, default=16, help="number of generated images.")
+    decode_parser.add_argument("--size", type=int, nargs=2, default=(4000, 3000), help="size of generated images.")
+    decode_parser.add_argument("--repeat", type=int, default=3)
+
+    roi_parser = subparsers.add_parser("roi", help="new image vs in-place ROI process.")
+    roi_parser.add_argument("--size", type=int, nargs=2, default=(8000, 6000), help="size of the generated image.")
+    roi_parser.add_argument("--roi", type=int, nargs="+", default=(64, 256, 1024, 4096), help="side lengths of square ROIs.")
+    roi_parser.add_argument("--repeat", type=int, default=3)
+
+    qt_parser = subparsers.add_parser("qt", help="PIL.ImageQt vs HBQtBridge conversions.")
+    qt_parser.add_argument("--size", type=int, nargs=2, default=(4000, 3000), help="size of the generated image.")
+    qt_parser.add_argument("--modes", nargs="+", default=("RGB", "RGBA", "L"), help="PIL modes of the source image.")
+    qt_parser.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "decode":
+        if args.folder:
+            filepaths = [f"{args.folder}/{f}" for f in HBCommon.list_folder_files(args.folder)]
+            bench_decode(filepaths, args.repeat)
+        else:
+            with tempfile.TemporaryDirectory() as folder_path:
+                bench_decode(make_test_images(folder_path, args.count, tuple(args.size)), args.repeat)
+    elif args.benchmark == "roi":
+        bench_roi(tuple(args.size), args.roi, args.repeat)
+    elif args.benchmark == "qt":
+        bench_qt(tuple(args.size), args.modes, args.repeat)
+
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+"""
+Tests of HBFetcher against a local http.server: connection reuse, redirects, retries, timeouts and the HBHttpCache.
+Run from the repository folder: python -m unittest discover tests
+"""
+
+import time
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from HBImage.HBFetcher import HBFetcher
+from HBImage.HBHttpCache import HBHttpCache
+
+
+
+BODY = b"\x89PNG fake image bytes" * 100
+ETAG = '"v1"'
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    #keep-alive connections.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.client_address, dict(self.headers)))
+            count = sum(1 for path, _, _ in server.requests if path == self.path)
+
+        if self.path == "/redirect":
+            self._respond(302, b"", {"Location": "/image"})
+        elif self.path == "/busy" and count == 1:
+            self._respond(503, b"", {"Retry-After": "1"})
+        elif self.path == "/missing":
+            self._respond(404, b"not found")
+        elif self.path == "/slow":
+            time.sleep(0.5)
+            self._respond(200, BODY)
+        elif self.path == "/etag" and self.headers.get("If-None-Match") == ETAG:
+            self._respond(304, b"", {"ETag": ETAG})
+        else:
+            self._respond(200, BODY, {"ETag": ETAG})
+
+    def _respond(self, status:int, body:bytes, headers:dict=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            #the client gave up waiting (see test_read_timeout_raises).
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+
+
+class _Server(ThreadingHTTPServer):
+    #the handlers of the idle keep-alive connections are not waited for.
+    daemon_threads = True
+    block_on_close = False
+
+
+
+
+class TestHBFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.fetcher = HBFetcher(read_timeout=5.0, retries=2, backoff=0.01)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def paths(self) -> list:
+        return [path for path, _, _ in self.server.requests]
+
+
+    def test_connection_is_reused(self):
+        for _ in range(5):
+            self.assertEqual(self.fetcher.fetch(f"{self.base_url}/image").body, BODY)
+        client_addresses = {client_address for _, client_address, _ in self.server.requests}
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(client_addresses), 1)
+
+    def test_redirect_is_followed(self):
+        response = self.fetcher.fetch(f"{self.base_url}/redirect")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, BODY)
+        self.assertEqual(self.paths(), ["/redirect", "/image"])
+
+    def test_retry_after_is_respected(self):
+        start = time.perf_counter()
+        response = self.fetcher.fetch(f"{self.base_url}/busy")
+        self.assertEqual(response.body, BODY)
+        self.assertEqual(self.paths(), ["/busy", "/busy"])
+        self.assertGreaterEqual(time.perf_counter() - start, 0.9)
+
+    def test_not_found_raises(self):
+        with self.assertRaises(FileNotFoundError):
+            self.fetcher.fetch(f"{self.base_url}/missing")
+        #a 404 is not retried.
+        self.assertEqual(self.paths(), ["/missing"])
+
+    def test_read_timeout_raises(self):
+        fetcher = HBFetcher(read_timeout=0.1, retries=1, backoff=0.01)
+        try:
+            with self.assertRaises(TimeoutError):
+                fetcher.fetch(f"{self.base_url}/slow")
+        finally:
+            fetcher.close()
+        self.assertEqual(self.paths(), ["/slow", "/slow"])
+
+    def test_on_data_receives_the_body(self):
+        chunks = []
+        response = self.fetcher.fetch(f"{self.base_url}/image", on_data=chunks.append)
+        self.assertIsNone(chunks[0])
+        self.assertEqual(b"".join(chunks[1:]), response.body)
+
+
+    def test_cache_revalidates_and_works_offline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.fetcher.cache = HBHttpCache(directory)
+            url = f"{self.base_url}/etag"
+            self.assertEqual(self.fetcher.fetch(url).body, BODY)
+            #the second request is answered 304, the body is read from the cache.
+            self.assertEqual(self.fetcher.fetch(url).body, BODY)
+            self.assertEqual(self.server.requests[1][2].get("If-None-Match"), ETAG)
+
+            self.fetcher.cache.offline = True
+            self.assertEqual(self.fetcher.fetch(url).body, BODY)
+            with self.assertRaises(FileNotFoundError):
+                self.fetcher.fetch(f"{self.base_url}/image")
+            self.assertEqual(len(self.server.requests), 2)
+
+
+
+
+if __name__ == "__main__":
+    unittest.main()